@@ -0,0 +1,145 @@
+#!/usr/bin/python
+'''
+Times the tools on synthetic LDIFs of growing size and keeps the results, so a slowdown or a memory blowup shows up right away
+
+benchmark.py [-p][-t <tool,tool...>][-d <work dir>] <number of entries> [<number of entries>...]
+
+ -p to benchmark on the ldapsearch plaintext format instead of db2ldif
+ -t the tools to run, all by default: inspector,dataextractor,codeextractor,reencrypter
+ -d the folder for the generated ldifs and the results, benchmark by default
+
+The sizes are given as 10k, 100k, 1M, 10M etc. The ldifs are generated once with ldifgen.py and reused by the next runs.
+Each tool runs in its own process and in its own scratch folder. Measured are the wall clock time, the peak memory and the parsing speed from the
+tool's -m metrics. Every run is appended to <work dir>/results.jsonl, together with the date and the git commit, and compared to the previous
+run of the same tool on the same ldif. The reencrypter output is run through reencrypter.py -x again to check that it leaves every value as it is:
+
+    benchmark.py 10k 100k 1M
+    benchmark.py -t inspector,reencrypter 1M
+
+'''
+import sys, os, json, time, shutil, subprocess, filecmp
+from ldifgen import LdifGenerator, entryCount
+
+tools=['inspector','dataextractor','codeextractor','reencrypter']
+password="password" # ldifgen default
+aeskey="MDEyMzQ1Njc4OWFiY2RlZg==" # any 16 bytes
+
+class Benchmark:
+
+    def __init__(self,workdir,plaintext=False):
+        self.workdir=workdir
+        self.plaintext=plaintext
+        self.resultsfile=os.path.join(workdir,"results.jsonl")
+        self.here=os.path.dirname(os.path.abspath(__file__))
+        self.commit=self.gitCommit()
+
+    def gitCommit(self):
+        try:
+            return subprocess.check_output(["git","rev-parse","--short","HEAD"],cwd=self.here,stderr=open(os.devnull,'w')).strip()
+        except (OSError,subprocess.CalledProcessError):
+            return ""
+
+    def ldif(self,size):
+        # generated once per size and format
+        filename=os.path.join(self.workdir,"bench-%s%s.ldif" % (size,"-plain" if self.plaintext else ""))
+        if not os.path.exists(filename):
+            LdifGenerator(filename,entryCount(size),self.plaintext,1,password).generate()
+        return filename
+
+    def command(self,tool,ldif):
+        script=os.path.join(self.here,tool+".py")
+        if tool == "inspector":
+            return [sys.executable,script,"-n","-m","metrics.json",ldif]
+        if tool == "reencrypter":
+            return [sys.executable,script,"-m","metrics.json",ldif,password,aeskey]
+        return [sys.executable,script,"-m","metrics.json",ldif]
+
+    def run(self,tool,size):
+        # runs a tool in a scratch folder, so the output of the tools does not mix
+        ldif=self.ldif(size)
+        scratch=os.path.join(self.workdir,"run-"+tool)
+        if os.path.exists(scratch):
+            shutil.rmtree(scratch)
+        os.makedirs(scratch)
+        os.symlink(os.path.abspath(ldif),os.path.join(scratch,"bench.ldif"))
+        print "%s on %s..." % (tool,os.path.basename(ldif)),
+        with open(os.path.join(scratch,"output.log"),'w') as log:
+            start=time.time()
+            process=subprocess.Popen(self.command(tool,"bench.ldif"),cwd=scratch,stdout=log,stderr=subprocess.STDOUT)
+            (pid,status,usage)=os.wait4(process.pid,0) # the usage of this one process, not all the children so far
+            elapsed=time.time()-start
+        result={'date':time.strftime("%Y-%m-%d %H:%M:%S"),'commit':self.commit,'tool':tool,'size':size,'plaintext':self.plaintext,'bytes':os.path.getsize(ldif),
+                'seconds':round(elapsed,2),'cpu seconds':round(usage.ru_utime+usage.ru_stime,2),'peak MB':round(usage.ru_maxrss/1024.0,1),'status':os.WEXITSTATUS(status)}
+        try:
+            with open(os.path.join(scratch,"metrics.json")) as f:
+                metrics=json.load(f)
+            result['entries']=metrics['entries']
+            result['entries/s']=round(metrics['entries/s'])
+            result['phases']=dict([(k,round(v,2)) for (k,v) in metrics['phases'].items()])
+        except (IOError,ValueError,KeyError):
+            pass
+        if tool == "reencrypter" and result['status'] == 0:
+            result['-x unchanged']=self.crossCheck(scratch)
+        if result['status'] == 0 and result.get('-x unchanged',True):
+            shutil.rmtree(scratch)
+        elif result['status'] == 0:
+            print "-x changed the reencrypted values, see %s" % scratch,
+        else:
+            print "failed, see %s" % os.path.join(scratch,"output.log"),
+        self.report(result,self.previous(result))
+        with open(self.resultsfile,'a') as f:
+            f.write(json.dumps(result)+"\n")
+        return result
+
+    def crossCheck(self,scratch):
+        # True if reencrypter.py -x leaves the reencrypted ldif as it is, none of the values are taken for the old encryption
+        with open(os.path.join(scratch,"crosscheck.log"),'w') as log:
+            status=subprocess.call([sys.executable,os.path.join(self.here,"reencrypter.py"),"-x","bench-rec.ldif",password,aeskey],cwd=scratch,stdout=log,stderr=subprocess.STDOUT)
+        return status == 0 and filecmp.cmp(os.path.join(scratch,"bench-rec.ldif"),os.path.join(scratch,"bench-rec-rec.ldif"),shallow=False)
+
+    def previous(self,result):
+        # the last stored run of the same tool on the same ldif
+        last=None
+        if os.path.exists(self.resultsfile):
+            with open(self.resultsfile) as f:
+                for line in f:
+                    old=json.loads(line)
+                    if (old['tool'],old['size'],old['plaintext']) == (result['tool'],result['size'],result['plaintext']):
+                        last=old
+        return last
+
+    def report(self,result,last):
+        print "%.1fs, %.0f MB" % (result['seconds'],result['peak MB']),
+        if result.get('entries'):
+            print "%.0f entries/s" % result['entries/s'],
+        if last is not None and last['seconds'] and last['peak MB']:
+            print "(%+.0f%% time, %+.0f%% memory against %s %s)" % ((result['seconds']/last['seconds']-1)*100,(result['peak MB']/last['peak MB']-1)*100,last['commit'],last['date']),
+        print
+
+if __name__ == '__main__':
+    sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+    args=sys.argv[1:]
+    plaintext=False
+    workdir="benchmark"
+    selected=tools
+    while args and args[0].startswith("-"):
+        arg=args.pop(0)
+        if arg == "-p":
+            plaintext=True
+        elif arg == "-t" and args:
+            selected=args.pop(0).split(",")
+        elif arg == "-d" and args:
+            workdir=args.pop(0)
+        else:
+            print __doc__
+            sys.exit(1)
+    if not args or [t for t in selected if t not in tools]:
+        print __doc__
+        sys.exit(1)
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+    benchmark=Benchmark(workdir,plaintext)
+    for size in args:
+        for tool in selected:
+            benchmark.run(tool,size)
+    print "Results are in %s" % benchmark.resultsfile
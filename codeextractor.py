@@ -14,18 +14,141 @@ Exported are:
 
 Provide the name of the ldif, exported per directions in the README
 
+codeextractor.py [-m <metrics file>][-o <archive>][--stdout][<entry filter options>] <name of the ldif>
+ -m to save the timings and the parsing speed to a json file
+ -o to write the files into one archive instead of to the folders, by its extension a .zip, a .tar, .tar.gz or .tar.bz2, or a .db sqlite database with
+    an artifacts table of name, type, dn, erglobalid and content. The name is the path the file would have in the folders, the type the folder
+ --stdout to write the files to stdout as a tar stream instead of to the folders, e.g. | tar -x -C <folder>. - for the name of the ldif reads it from stdin
+ The entry filter options --base <dn>, --scope base|one|sub, --objectclass <class> and --filter <ldap filter> limit it to some of the entries, see ldifreader.py
+
+Only the files that changed are written, by a few threads. code-manifest.json next to the folders keeps the md5, size and modification time of every file.
+The files with the same md5 are not touched, a file whose size or modification time is not the same as in there any more is read again to tell, and
+one that is gone is written again. The manifest lists the files added, changed and deleted by the run. The files of the last run that were not extracted this time
+are deleted, unless the entry filter options are given. Without the manifest the files are compared with what is on the disk
+
 2012-2017
 @author: Alex Ivkin
 '''
-import base64,sys,re,traceback,os,math,pprint
+import base64,sys,re,traceback,os,pprint,tarfile,zipfile,time,cStringIO,hashlib,json
+from collections import deque, OrderedDict
+from multiprocessing.pool import ThreadPool
+from ldifreader import LdifReader, Metrics, metricsOption, filterOption, stdoutOption, dataOutput
 
-class LdifParser:
+# attributes analyzeEntry reads the values of, the values of the rest are not parsed
+attributes=['cn','erglobalid','ertype','erprocessname','erobjectprofilename','ercategory','erxml','eroperationnames','erassemblyline','eralconfig',
+            'erpolicyitemname','erpolicymembership','erpolicytarget','erreqpolicytarget','erentitlements','erformname','erxhtml','ertemplatename',
+            'ersubject','erenabled','ertext','eracl']
+
+def writeFile(name,text):
+    # in a thread of the pool
+    with open(name,'w') as f:
+        f.write(text)
+
+def outputOption(args):
+    # takes -o <archive> out of the command line arguments, returns the file name or None. Exits on an extension there is no archive for
+    if "-o" in args[:-1]:
+        i=args.index("-o")
+        output=args[i+1]
+        del args[i:i+2]
+        if archiveType(output) is None:
+            print "-o should end with one of %s, not %s" % (", ".join([ext for (ext,archive) in archives]),output)
+            sys.exit(1)
+        return output
+    return None
+
+def archiveType(filename):
+    for (ext,archive) in archives:
+        if filename.lower().endswith(ext):
+            return archive
+    return None
+
+# the archives write to <name>.tmp and rename it at the end, so whatever reads the archive never sees half of one
+
+class TarArchive:
+    # the files in a tar file, compressed by its extension, or in a tar stream
+
+    def __init__(self,filename=None,fileobj=None):
+        self.filename=filename
+        self.mtime=time.time()
+        if fileobj is not None:
+            self.tar=tarfile.open(fileobj=fileobj,mode='w|')
+        else:
+            self.tar=tarfile.open(filename+".tmp",'w:gz' if filename.lower().endswith(('.tar.gz','.tgz')) else 'w:bz2' if filename.lower().endswith('.tar.bz2') else 'w')
+
+    def add(self,name,type,dn,erglobalid,text):
+        info=tarfile.TarInfo(name)
+        info.size=len(text)
+        info.mtime=self.mtime
+        self.tar.addfile(info,cStringIO.StringIO(text))
+
+    def close(self):
+        self.tar.close()
+        if self.filename is not None:
+            os.rename(self.filename+".tmp",self.filename)
+
+class ZipArchive:
+
+    def __init__(self,filename):
+        self.filename=filename
+        self.date=time.localtime()[:6]
+        self.zip=zipfile.ZipFile(filename+".tmp",'w',zipfile.ZIP_DEFLATED,True)
+
+    def add(self,name,type,dn,erglobalid,text):
+        info=zipfile.ZipInfo(name,self.date)
+        info.compress_type=zipfile.ZIP_DEFLATED
+        info.external_attr=0644 << 16 # rw-r--r-- when extracted, instead of none
+        self.zip.writestr(info,text)
+
+    def close(self):
+        self.zip.close()
+        os.rename(self.filename+".tmp",self.filename)
+
+class SqliteArchive:
+    # the files as the rows of the artifacts table, the last one of the same name wins as in the folders
 
     def __init__(self,filename):
+        import sqlite3 # not in every python build, only needed here
+        self.filename=filename
+        if os.path.exists(filename+".tmp"): # from a run that failed
+            os.remove(filename+".tmp")
+        self.db=sqlite3.connect(filename+".tmp")
+        self.db.text_factory=str # the content is bytes as decoded from base64, not always utf-8
+        self.db.execute("create table artifacts (name text primary key, type text, dn text, erglobalid text, content text)")
+        self.db.execute("create index artifacts_type on artifacts (type)")
+
+    def add(self,name,type,dn,erglobalid,text):
+        self.db.execute("insert or replace into artifacts values (?,?,?,?,?)",(name,type,dn,erglobalid,text))
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+        os.rename(self.filename+".tmp",self.filename)
+
+archives=[('.zip',ZipArchive),('.tar',TarArchive),('.tar.gz',TarArchive),('.tgz',TarArchive),('.tar.bz2',TarArchive),('.db',SqliteArchive),('.sqlite',SqliteArchive)]
+
+class LdifParser:
+
+    def __init__(self,filename,entryfilter=None,stdout=False,output=None):
         self.ldif=filename
+        self.entryfilter=entryfilter
+        self.stdout=stdout # the files go to stdout in a tar stream
+        self.output=output # archive the files go to instead of the folders
+        self.archive=None # TarArchive, ZipArchive or SqliteArchive
         prefix = "" # create subfolders under the same dir that the ldif is in or the current dir
-        if os.path.dirname(filename) != "":
+        if os.path.dirname(filename) != "" and not stdout and not output:
             prefix = os.path.dirname(filename)+'/' # otherwise use the folder name
+        self.prefix=prefix
+        self.manifestfile=prefix+'code-manifest.json'
+        self.previous={} # file name without the prefix -> md5, size and mtime, from the manifest of the last run
+        self.hashes={} # file name without the prefix -> md5 of the files of this run
+        self.stats={} # file name without the prefix -> (size, mtime) of the files of this run that are not written, the others are looked at at the end
+        self.before={} # md5 of the files of this run as they were before it, None for the new ones
+        self.ondisk={} # md5 of the files of this run as they are now, with the writes in the pool
+        self.folders=set() # the ones known to be there
+        self.threads=4
+        self.pool=None
+        self.writes=deque() # results of the writes in the pool, oldest first
+        self.writing={} # file name -> result of its last write
         self.GlobalWorkflowExportFolder   = prefix+'Workflows'
         self.CategoryWorkflowExportFolder = prefix+'CategoryWorkflows'
         self.PPExportFolder               = prefix+'ProvisioningPolicies'
@@ -35,93 +158,37 @@ class LdifParser:
         self.ACLExportFolder              = prefix+'ACLs'
         self.other={}
         self.plaintext=False; # false for db2ldif, true for ldapsearch formatted files
+        self.metrics=Metrics("codeextractor",filename)
 
     def parseOut(self):
-        i=0
-        last=-1
         try:
+            self.metrics.phase("parse and save")
             print "Opening...",
-            ldiffile = open(self.ldif,'r')
-            num_lines = sum(1 for _ in ldiffile)
-            print "%s lines." % num_lines
-            ldiffile.seek(0)
+            reader=LdifReader(self.ldif,label="Parsing and saving",attributes=attributes,entryfilter=self.entryfilter)
+            self.plaintext=reader.plaintext
+            print "%s%s." % (reader.sizeText()," plaintext format" if self.plaintext else "")
+            self.openFiles()
             entry={}
-            key=''
             try:
-                for fullline in ldiffile:
-                    line=fullline.rstrip('\n\r') # keep spaces but remove EOLs
-                    if not self.plaintext and not entry and line.startswith("erglobalid="):
-                        self.plaintext=True;
-                        print "plaintext format ",
-                    if self.plaintext: # ldapsearch plaintext format
-                        if re.match("erglobalid=.*DC=COM$",line,re.I): # analyze old and start a new entry
-                            if entry:
-                                if 'objectclass' in entry and "ou=recycleBin" not in entry['dn'][0] : # if it is a valid entry and not in the trash
-                                    self.analyzeEntry(entry)
-                                entry={}
-                            entry['dn']=[line]
-                        elif re.match(r"[a-zA-Z]+=.*[^;]$",line): # it's so specific to make sure we ignore any javascript - the side effect is skipping the ldap attributes that have values ending in ;
-                            (key,value)=line.split("=",1)
-                            key=key.lower() # ldap is case insensitive
-                            value=value.strip("=")
-                            if value <> "NOT ASCII": # this means this value is lost in ldapsearch export
-                                if key in entry:
-                                    entry[key].append(value)
-                                else:
-                                    entry[key]=[value]
-                        elif len(line)>0 and len(entry) > 0: # tag line onto the last value. Skipping empty lines to make sure we dont duplicate \n, but the sideeffect is removal of blank lines from the multiline attribute values
-                            #line=line.lstrip(' ') # remove the leading space
-                            if len(entry[key]) == 1:
-                                entry[key]=[entry[key][0]+line+"\n"] #  add \n for readability (it's plaintext not base64)
-                            else:
-                                entry[key][-1]+=line+"\n" # extend the last value
-                        #else:
-                        #    print "Error: ", line
-                    else: # classical format (softerra, db2ldif)
-                        if line=='': # end of an entry
-                            if 'objectclass' in entry and "ou=recycleBin" not in entry['dn'][0] : # if it is a valid entry and not in the trash
-                                self.analyzeEntry(entry)
-                            entry={}
-                        elif line.startswith("#"): # skip comment
-                            continue
-                        elif ":" in line:
-                            (key,value)=line.split(":",1)
-                            key=key.lower() # ldap is case insensitive
-                            value=value.strip(": ")
-                            if key in entry:
-                                # convert to a set
-                                entry[key].append(value)
-                            else:
-                                entry[key]=[value]
-                        elif len(entry) > 0: # tag line onto the last value
-                            line=line.lstrip(' ') # remove the leading space
-                            if len(entry[key]) == 1:
-                                entry[key]=[entry[key][0]+line]
-                            else:
-                                entry[key][-1]+=line # extend the last value
-                    # print progress
-                    #if i>160009: break
-                    percent = math.ceil(i/float(num_lines)*100*1000)/1000 # round to the tenth of a percent
-                    #print "%s\r" % (math.ceil(percent*1000)/1000),
-                    if percent > last :# cant simply us module because of freaky float imprecision
-                        sys.stdout.write('\rParsing and saving %s: %s' % (self.ldif, "{:>5.1f}%".format(percent)))
-                        last=percent
-                    i+=1
+                for entry in reader.entries():
+                    if "ou=recycleBin" not in entry['dn'][0] : # if it is a valid entry and not in the trash
+                        self.analyzeEntry(entry)
             except:
-                print "\nFailure parsing \"%s\" for %s\n%s, %s" % (line, entry, sys.exc_info()[0],sys.exc_info()[1])
+                print "\nFailure parsing %s at byte %s\n%s, %s" % (entry, reader.offset, sys.exc_info()[0],sys.exc_info()[1])
                 traceback.print_exc()
                 sys.exit(2)
-
-            if self.plaintext: # plaintext parser is backfilling, need to process the last entry
-                if 'objectclass' in entry and "ou=recycleBin" not in entry['dn'][0]:
-                    self.analyzeEntry(entry)
         except IOError:
             print "can't open %s!" % self.ldif
         else:
             print " done."
-            print "Entries skipped:"
-            pprint.pprint(self.other)
-            ldiffile.close()
+            self.closeFiles()
+            self.printSkipped()
+            reader.close()
+            self.metrics.measure(reader)
+
+    def printSkipped(self):
+        print "Entries skipped:"
+        pprint.pprint(self.other)
 
     def analyzeEntry(self,entry):
         #filename=name.replace(/[\\\/\[\]:;\|=,\+\*\?<>\_"]/g,"~"); // to sanitize the name
@@ -143,15 +210,15 @@ class LdifParser:
                     + "_" + guid +".xml"
                 #if 'erxml' in entry:
                 data=base64.b64decode(entry['erxml'][0]) if not self.plaintext else entry['erxml'][0]
-                self.save(name,data)
+                self.save(name,data,entry)
             elif 'erALOperation'.lower() in entryObjectclass:
                 filename="%s-%s-%s" % (re.search('ou=(.+),ou=assembly',entry["dn"][0]).group(1),entry['eroperationnames'][0],entry['cn'][0])
                 name=self.ALExportFolder+"/"+filepattern.sub("~", filename)+".cfg"
                 data=base64.b64decode(entry['eralconfig'][0]) if not self.plaintext else entry['eralconfig'][0]
-                self.save(name,data)
+                self.save(name,data,entry)
                 name=self.ALExportFolder+"/"+filepattern.sub("~", filename)+".xml"
                 data=base64.b64decode(entry['erassemblyline'][0]) if not self.plaintext else entry['erassemblyline'][0]
-                self.save(name,data)
+                self.save(name,data,entry)
             elif 'erProvisioningPolicy'.lower() in entryObjectclass: # Provisioinig Policies - ou=policies,erglobalid=00000000000000000000,ou=....
                 name=self.PPExportFolder+"/"+filepattern.sub("~",entry["erpolicyitemname"][0])+"_"+entry["erglobalid"][0]+".xml";
                 data=base64.b64decode(entry['erentitlements'][0]) if not self.plaintext else entry['erentitlements'][0]
@@ -167,11 +234,11 @@ class LdifParser:
 
                     erreqpolicytarget contains prerequisites in the same format
                 '''
-                self.save(name,data)
+                self.save(name,data,entry)
             elif 'erFormTemplate'.lower() in entryObjectclass: # Forms - ou=formTemplates,ou=itim,ou=....
                 name=self.FormsExportFolder+"/"+filepattern.sub("~",entry["erformname"][0])+".xml"; # "_"+entry["erglobalid"][0]+
                 data=base64.b64decode(entry['erxml'][0]) if not self.plaintext else entry['erxml'][0]
-                self.save(name,data)
+                self.save(name,data,entry)
             elif 'erTemplate'.lower() in entryObjectclass: # mail templates - ou=config,ou=itim,ou=...
                 if 'ertemplatename' in entry:
                     templatename=filepattern.sub("~",entry["ertemplatename"][0])
@@ -187,7 +254,7 @@ class LdifParser:
                     data+="Text:\n"+base64.b64decode(entry['ertext'][0]) if not self.plaintext else entry['ertext'][0]
                 if 'erxhtml' in entry:
                     data+="\n-------------------------------------\nXHTML:\n"+base64.b64decode(entry['erxhtml'][0]) if not self.plaintext else entry['erxhtml'][0]
-                self.save(name,data)
+                self.save(name,data,entry)
             elif 'erObjectCategory'.lower() in entryObjectclass: # Operational and lifecycle workflows
                 if 'erxml' in entry:
                     name=self.CategoryWorkflowExportFolder+"/"+filepattern.sub("~",entry["ertype"][0])+".xml"; # +"_"+entry["cn"][0]
@@ -213,7 +280,7 @@ class LdifParser:
                         #print name
                         #save erxml'''
                         data += base64.b64decode(erxml)+"\n------------------------------------------------------------------\n"
-                    self.save(name,data)
+                    self.save(name,data,entry)
             elif 'eracl' in entry: # acls are attributes on other objects
                 name=self.ACLExportFolder+"/"+filepattern.sub("~",entry["dn"][0])+".xml"; # +"_"+entry["cn"][0]
                 data=""
@@ -241,7 +308,7 @@ class LdifParser:
                     # dn=work.getString("containerdn");
                     # depending on which one is defined
                     # filename=getExternalProperty("ACLExportFolder")+"\\"+filename+"_"+containertype+"_"+containername+".xml";
-                self.save(name,data)
+                self.save(name,data,entry)
             else:
                 key=", ".join([o for o in sorted(entryObjectclass) if o <> "top" and o <> "ermanageditem"]) # a key to count all other object classes
                 if key in self.other:
@@ -264,21 +331,117 @@ class LdifParser:
             traceback.print_exc()
             sys.exit(2)
 
-    def save(self,name,data):
+    def openFiles(self):
+        # the tar stream with --stdout, the archive with -o, otherwise the manifest of the last run and the threads to write the files
+        if self.stdout:
+            self.archive=TarArchive(fileobj=dataOutput())
+            return
+        if self.output is not None:
+            self.archive=archiveType(self.output)(self.output)
+            return
+        if os.path.exists(self.manifestfile):
+            try:
+                with open(self.manifestfile) as f:
+                    self.previous=json.load(f)['files']
+            except (ValueError,KeyError):
+                print "can't read %s, comparing the files on the disk" % self.manifestfile,
+        self.pool=ThreadPool(self.threads)
+
+    def closeFiles(self):
+        # waits for the writes, deletes the files that are not extracted any more and saves the manifest
+        if self.archive is not None:
+            self.archive.close()
+            if self.stdout:
+                dataOutput().close()
+            else:
+                print "Saved to %s" % self.output
+            return
+        self.pool.close()
+        self.pool.join()
+        while self.writes:
+            self.writes.popleft().get() # raises the errors of the writes
+        files=dict(self.previous) if self.entryfilter is not None else {} # the files of the entries filtered out stay
+        for (name,md5) in self.hashes.iteritems():
+            (size,mtime)=self.stats[name] if name in self.stats else self.stat(self.prefix+name) # the written ones as they are now
+            files[name]=OrderedDict([('md5',md5),('size',size),('mtime',mtime)])
+        added=sorted([name for name in self.hashes if self.before[name] is None and name not in self.previous])
+        changed=sorted([name for name in self.hashes if self.before[name] != self.hashes[name] and name not in added]) # with the ones deleted or edited on the disk
+        deleted=sorted([name for name in self.previous if name not in files])
+        for name in deleted:
+            if os.path.exists(self.prefix+name):
+                os.remove(self.prefix+name)
+        manifest=json.dumps(OrderedDict([('added',added),('changed',changed),('deleted',deleted),('files',OrderedDict(sorted(files.items())))]),indent=1)+"\n"
+        if self.fileHash(self.manifestfile) != hashlib.md5(manifest).hexdigest(): # left alone when nothing changed
+            with open(self.manifestfile,'w') as f:
+                f.write(manifest)
+        print "%s files added, %s changed, %s deleted, %s unchanged." % (len(added),len(changed),len(deleted),len(self.hashes)-len(added)-len(changed))
+
+    def stat(self,name):
+        stat=os.stat(name)
+        return (stat.st_size,stat.st_mtime)
+
+    def diskHash(self,key,name):
+        # md5 of a file as it is on the disk, None if it is not there. Taken from the manifest if the size and the modification time are the same
+        try:
+            self.stats[key]=(size,mtime)=self.stat(name)
+        except OSError:
+            return None
+        previous=self.previous.get(key)
+        if type(previous) is dict and (previous.get('size'),previous.get('mtime')) == (size,mtime):
+            return previous['md5']
+        return self.fileHash(name)
+
+    def fileHash(self,name):
+        # md5 of a file as it is on the disk, None if it is not there
+        try:
+            with open(name,'rb') as f:
+                return hashlib.md5(f.read()).hexdigest()
+        except IOError:
+            return None
+
+    def save(self,name,data,entry):
         #if name is not None:
         #print "Saving "+ name
+        text=str(data)+"\n"
+        if self.archive is not None:
+            dn=entry['dn'][0]
+            if entry.get('erglobalid'):
+                erglobalid=entry['erglobalid'][0]
+            else: # the workflows have it only in the dn
+                erglobalid=dn[dn.find("=")+1:dn.find(",")] if dn.lower().startswith("erglobalid=") else None
+            self.archive.add(name,os.path.dirname(name),dn,erglobalid,text)
+            return
+        md5=hashlib.md5(text).hexdigest()
+        key=name[len(self.prefix):] # the manifest is the same wherever the folders are
+        if key not in self.ondisk: # the first time in this run
+            self.before[key]=self.ondisk[key]=self.diskHash(key,name)
+        self.hashes[key]=md5
+        if self.ondisk[key] == md5:
+            return
+        self.ondisk[key]=md5
+        self.stats.pop(key,None)
         d = os.path.dirname(name)
-        if not os.path.exists(d):
-            os.makedirs(d)
-        outfile=open(name,'w')
-        print >> outfile, data
-        outfile.close()
+        if d not in self.folders:
+            if not os.path.exists(d):
+                os.makedirs(d)
+            self.folders.add(d)
+        if name in self.writing: # the same name twice, the last one has to win
+            self.writing[name].wait()
+        self.writing[name]=result=self.pool.apply_async(writeFile,(name,text))
+        self.writes.append(result)
+        while len(self.writes) > self.threads*16: # not to keep too much in memory when the disk is slow
+            self.writes.popleft().get()
 
 if __name__ == '__main__':
     # reopen stdout file descriptor with write mode and 0 as the buffer size (unbuffered output)
     sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
-    if len(sys.argv) < 2:
+    metricsfile=metricsOption(sys.argv)
+    entryfilter=filterOption(sys.argv)
+    output=outputOption(sys.argv)
+    stdout=stdoutOption(sys.argv)
+    if len(sys.argv) < 2 or (stdout and output):
         print __doc__
         sys.exit(1)
-    parser=LdifParser(sys.argv[1])
+    parser=LdifParser(sys.argv[1],entryfilter,stdout,output)
     parser.parseOut()
+    parser.metrics.finish(metricsfile)
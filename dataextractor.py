@@ -1,15 +1,23 @@
 #!/usr/bin/python
 '''
-Extracts data from LDIF into subfiles. Skips over people and accounts, disables services unless -a is given. Picks random 10 people to create an import
+Extracts data from LDIF into subfiles. Skips over people and accounts, disables services unless -a is given. Picks random 10 people to create an import,
+with the people, accounts and other held back entries the extracted data refers to, so the subset is consistent
 
 Useful for converting Prod data to a subset that is safe and confidential for importing into Dev and QA
 
-dataextractor.py [-a][-d] <name of the ldif>
+dataextractor.py [-a][-d][-z <compression>][-m <metrics file>][--rules <rules file>][--stdout <file>][<entry filter options>] <name of the ldif>
  -a to extract all data. If no -a is supplied the data is truncated and modified for non-Prod environments. E.g only 10 random people are exported, services are disabled by modifying erurl, service supporting data (groups etc) is skipped.
  -d to create removal ldifs, so data can be replaced. It uses DNs from the input LDIF. The side effect is that any DNs that are in the LDAP, but not in input LDIF will not be removed.
    To clean all of the existing entries run dataextractor on the ldapdump from the current LDAP or just use the build-cleaner-from-ldif.sh script
+ -z gzip, bzip2, xz or zstd to compress the output files as they are written. pigz, lbzip2 or pbzip2 are used if installed
+ -m to save the timings and the parsing speed to a json file
+ --rules to route the entries with other rules than dataextractor.rules next to this script
+ --stdout to write only one of the files to stdout, by its name in the rules, e.g. --stdout config for what goes to extract-config.ldif. The others and
+   the manifest are not written. - for the name of the ldif reads it from stdin, without -a the entries held back are kept in a temporary file until the end
+ The entry filter options --base <dn>, --scope base|one|sub, --objectclass <class> and --filter <ldap filter> limit it to some of the entries, see ldifreader.py
 
-This code assumes the base DN is dn=com. Recycle bin is always skipped.
+extract-manifest.json lists the files with the number of entries and bytes written to each and their size on the disk.
+Recycle bin is always skipped. Which entries go to which file is set in dataextractor.rules, by dn suffix and object classes. By default:
 
 * extract-acletc.ldif, extract-acletc-del.ldif - ou=[name],DC=COM and eracl attributes of erglobalid=00000000000000000000,ou=[name],DC=COM
 * extract-system.ldif, extract-system-del.ldif - ou=systemUser,ou=itim,ou=[name],DC=COM
@@ -38,22 +46,234 @@ This code assumes the base DN is dn=com. Recycle bin is always skipped.
 	* ou=roles
 	* ou=orgchart
 	* ou=workflow
-* extract-other.ldif - everything else that did not fit into the above categories
+* extract-others.ldif - everything else that did not fit into the above categories
 
 
 2012-2017
 @author: Alex Ivkin
 '''
-import base64, sys, re, traceback, os, pprint, operator, csv, math, subprocess, random, textwrap
-from collections import defaultdict # dicts that need no pre-init, for simpler code
+import base64, sys, re, traceback, os, pprint, operator, csv, random, textwrap, mmap, json, tempfile
+from array import array
+from hashlib import md5
+from itertools import izip
+from collections import defaultdict, namedtuple # dicts that need no pre-init, for simpler code
+from collections import OrderedDict
+from ldifreader import LdifReader, LdifWriter, Metrics, metricsOption, filterOption, compressOption, dataOutput, normalDn
+
+attributes=['dc','eracl','owner','erxml'] # the attribute values dumpBlock reads, the rest of the entries is copied as is
+
+defaultrules=os.path.join(os.path.dirname(os.path.abspath(__file__)),"dataextractor.rules")
+transforms=['copy','disable','sample','hold','tenant','acl'] # see LdifParser.transforms
+needfile=['tenant','acl'] # the ones that need a file to write to
+
+# a line of the rules file. path are the rdns from the root down, classes the object classes an entry needs, without the ones it can't have.
+# mode is True for -a, False for !-a and None for both, file and delete None for -
+Rule=namedtuple('Rule',['path','scope','classes','without','mode','file','transform','delete','line'])
+
+def rulesOption(args):
+    # takes --rules <rules file> out of the command line arguments, returns the file name or None
+    if "--rules" in args[:-1]:
+        i=args.index("--rules")
+        rulesfile=args[i+1]
+        del args[i:i+2]
+        return rulesfile
+    return None
+
+def stdoutOption(args):
+    # takes --stdout <file> out of the command line arguments, returns the name of the file in the rules or None. See ldifreader.dataOutput
+    if "--stdout" in args[:-1]:
+        i=args.index("--stdout")
+        name=args[i+1]
+        del args[i:i+2]
+        dataOutput()
+        return name
+    return None
+
+def loadRules(filename):
+    # reads the routing rules, see dataextractor.rules for the format. Raises ValueError on a bad rule
+    rules=[]
+    with open(filename) as f:
+        for (number,line) in enumerate(f,1):
+            line=line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields=line.split()
+            if len(fields) != 6:
+                raise ValueError("%s:%s: a rule is <dn suffix> <scope> <conditions> <file> <transform> <delete file>, not %s" % (filename,number,line))
+            (suffix,scope,conditions,name,transform,delete)=fields
+            if scope not in ["base","one","sub"]:
+                raise ValueError("%s:%s: scope should be base, one or sub, not %s" % (filename,number,scope))
+            if transform not in transforms:
+                raise ValueError("%s:%s: transform should be one of %s, not %s" % (filename,number,", ".join(transforms),transform))
+            if transform in needfile and name == "-":
+                raise ValueError("%s:%s: %s needs a file" % (filename,number,transform))
+            path=re.split(r'(?<!\\),',normalDn(suffix)) # by , but not \,
+            path.reverse()
+            (classes,without,mode)=([],[],None)
+            for condition in conditions.lower().split(",") if conditions != "-" else []:
+                if condition in ["-a","!-a"]:
+                    mode=condition == "-a"
+                elif condition.startswith("!"):
+                    without.append(condition[1:])
+                else:
+                    classes.append(condition)
+            rules.append(Rule(path,scope,classes,without,mode,name if name != "-" else None,transform,delete if delete != "-" else None,number))
+    return rules
+
+class DnRouter:
+    # the rules compiled into a trie keyed on the rdns from the root down, with * for any rdn. An entry is routed in a few dict lookups per level of its dn,
+    # however many rules there are
+
+    def __init__(self,rules,allpeople):
+        self.root=({},[]) # a node is (rdn -> child node, [(order, rule) of the rules for the suffix])
+        for (order,rule) in enumerate(rules):
+            if rule.mode is not None and rule.mode != allpeople:
+                continue
+            node=self.root
+            for rdn in rule.path:
+                node=node[0].setdefault(rdn,({},[]))
+            node[1].append((order,rule))
+        self.parents={} # parent dn as a tuple -> what walk() found for it
+
+    def route(self,dnlist,classes):
+        # the rules that fit an entry, the longest suffix first and in the file order for the same one. dnlist is from the root down.
+        # What comes from the parent dn is worked out once per parent
+        parent=tuple(dnlist[:-1])
+        known=self.parents.get(parent)
+        if known is None:
+            known=self.parents[parent]=self.walk(parent)
+        (nodes,above)=known
+        rdn=dnlist[-1]
+        found=[]
+        for (children,rules) in nodes:
+            for child in (children.get(rdn),children.get('*')):
+                if child is not None:
+                    found.extend([(order,rule) for (order,rule) in child[1] if rule.scope != "one"])
+        found.sort()
+        for rule in [rule for (order,rule) in found]+above:
+            if (not rule.classes or all(c in classes for c in rule.classes)) and not (rule.without and any(c in classes for c in rule.without)):
+                yield rule
+
+    def walk(self,parent):
+        # the trie nodes for a parent dn and the rules its children get from above it, the deepest first
+        nodes=[self.root]
+        found=[]
+        for (level,rdn) in enumerate(parent,1):
+            matched=[]
+            for (children,rules) in nodes:
+                for child in (children.get(rdn),children.get('*')):
+                    if child is not None:
+                        matched.append(child)
+                        for (order,rule) in child[1]:
+                            if rule.scope == "sub" or (rule.scope == "one" and level == len(parent)):
+                                found.append((-level,order,rule))
+            nodes=matched
+        found.sort()
+        return (nodes,[rule for (level,order,rule) in found])
+
+ownerattributes=frozenset(['owner','erparent']) # an entry held back that points to a pulled in one with these comes along, e.g. the accounts of a person
+memberattributes=frozenset(['erroles']) # an entry held back that is a member of a role named in an acl is pulled in
+
+class ReferenceIndex:
+    # dn references between the entries, to pull in the entries held back that the extracted ones need: the people the roles and workflows name,
+    # their supervisors, accounts and so on. The dns are kept as their md5 digests numbered in the order they are seen, the rest in arrays by
+    # that number, so it takes about a hundred and fifty bytes per entry. Not python hash(), two dns with the same one would be taken for one entry. The references of an entry held back are read from the ldif again if it gets
+    # pulled in, only the ownership and membership ones are kept, unless the ldif can't be read back (compressed), then all of them are.
+    # The offsets of the entries held back from stdin are in the temporary file they are kept in
+
+    def __init__(self,complete):
+        self.complete=complete # all the references of the entries held back are kept
+        self.ids={} # md5 digest of the normalized dn -> number
+        self.offsets=array('l') # by number, where an entry held back is in the ldif, -1 for the others
+        self.lengths=array('i')
+        self.files=array('b') # by number, the file an entry held back goes to, see filenames
+        self.filenames=[]
+        self.edges={} # number -> (first,last) of the references of an entry held back in targets, when complete
+        self.targets=array('l')
+        self.owners=(array('l'),array('l')) # entry held back, what it belongs to
+        self.members=(array('l'),array('l')) # entry held back, role it is a member of
+        self.wanted=set() # numbers of the dns the extracted entries refer to
+        self.aclroles=set() # numbers of the dns in the acls
+        self.held=0
+
+    def id(self,dn,add=True):
+        key=md5(dn).digest()
+        i=self.ids.get(key)
+        if i is None and add:
+            i=self.ids[key]=len(self.offsets)
+            self.offsets.append(-1)
+            self.lengths.append(0)
+            self.files.append(0)
+        return i
+
+    def want(self,references):
+        # references of an extracted entry
+        for (attr,dn) in references:
+            i=self.id(dn)
+            self.wanted.add(i)
+            if attr == "eracl":
+                self.aclroles.add(i)
+
+    def hold(self,dn,offset,length,filename,references):
+        # an entry that is not extracted, unless something needs it
+        i=self.id(dn)
+        if self.offsets[i] >= 0:
+            return # the same dn twice
+        if filename not in self.filenames:
+            self.filenames.append(filename)
+        self.offsets[i]=offset
+        self.lengths[i]=length
+        self.files[i]=self.filenames.index(filename)
+        self.held+=1
+        first=len(self.targets)
+        for (attr,target) in references:
+            t=self.id(target)
+            if attr in ownerattributes:
+                self.owners[0].append(i)
+                self.owners[1].append(t)
+            elif attr in memberattributes:
+                self.members[0].append(i)
+                self.members[1].append(t)
+            if self.complete:
+                self.targets.append(t)
+        if self.complete:
+            self.edges[i]=(first,len(self.targets))
+
+    def isHeld(self,i):
+        return i is not None and self.offsets[i] >= 0
+
+    def references(self,i,text):
+        # numbers of what an entry held back refers to, read from its text unless they are kept
+        if self.complete:
+            (first,last)=self.edges[i]
+            return self.targets[first:last]
+        return [self.id(dn,False) for (attr,dn) in text(i)]
+
+    def closure(self,seeds,text):
+        # numbers of the entries held back that the seeds and the extracted entries need, directly or through each other.
+        # text(i) gives the references of a held entry that are not kept
+        selected=set()
+        pending=[i for i in self.wanted|set(seeds) if self.isHeld(i)]
+        pending+=[i for (i,role) in izip(*self.members) if role in self.aclroles]
+        while pending:
+            while pending:
+                i=pending.pop()
+                if i in selected:
+                    continue
+                selected.add(i)
+                pending+=[t for t in self.references(i,text) if self.isHeld(t) and t not in selected]
+            # what belongs to the selected entries, a pass over all the ownership references for each level of ownership
+            pending=[i for (i,owner) in izip(*self.owners) if owner in selected and i not in selected]
+        return selected
 
 def Tree(): # recursive dict storage representing an [ldap] tree
     return defaultdict(Tree)
 
 class LdifParser:
 
-    def __init__(self,filename,allpeople,deldata):
+    def __init__(self,filename,allpeople,deldata,entryfilter=None,rulesfile=None,compression=None,stdout=None):
         self.ldif=filename
+        self.entryfilter=entryfilter
         self.allpeople=allpeople
         self.deldata=deldata
         self.testcount=10 # how many random test people to export/generate
@@ -61,271 +281,317 @@ class LdifParser:
         # hash-o-hashes
         self.accounts={}
         self.services={}
-        self.people={}
-        self.neededpeople={}
+        self.peoplecount=0
+        self.testpeople=[] # reservoir sample of the normalized dns of the people, see samplePerson
+        self.index=None # ReferenceIndex of the entries held back, made by openFiles
+        self.heldattributes=ownerattributes|memberattributes # the references kept for the entries held back
         self.roles={}
         self.ppolicies={}
         self.ous={}
         self.other={}
         self.objects=defaultdict(int) # a dict that auto inits to 0 for new keys
-        self.peoplebyclass=defaultdict(list)
+        self.peoplebyclass={} # set of object classes -> [number of people, reservoir sample of them]
         self.ldaptree=Tree()
         self.serviceprofiles={'eritimservice':'Built-in'} # init in with a default entry
         self.serviceprofileskeys={}
         self.plaintext=False; # false for db2ldif, true for ldapsearch formatted files
-        self.tenant_dns=["ou=policies","ou=sysroles","ou=roles","ou=orgchart","ou=workflow"]
-        self.people_dns=["ou=people","ou=accounts"]
-        self.system_dns=["ou=systemuser"]
-        self.srvics_dns=["ou=services"]
-        self.custom_dns=["ou=data","*"] # star means all non-parent (i.e. leaf) entries
-        self.config_dns=["ou=constraints","erdictionaryname=password","ou=policies","ou=config","ou=accesstype","ou=assemblyline","ou=privilegerules","cn=challenges","ou=operations","ou=objectprofile","ou=serviceprofile","ou=lifecycleprofile","ou=formtemplates","ou=category","ou=joindirectives"]
+        self.rules=loadRules(rulesfile or defaultrules) # which entries go to which file, see dataextractor.rules
+        self.router=DnRouter(self.rules,allpeople)
+        self.stdout=stdout # the name of the one file written to stdout, None to write them all
+        if stdout is not None and stdout not in [rule.file for rule in self.rules]+([rule.delete for rule in self.rules] if deldata else []):
+            raise ValueError("there is no %s file in the rules" % stdout)
+        self.transforms={'copy':self.copyEntry,'disable':self.disableService,'sample':self.sampleEntry,'hold':self.holdEntry,'tenant':self.tenantModify,'acl':self.aclModify}
+        self.files={} # extract-<name>.ldif LdifWriters by the names in the rules
+        self.deletefiles={}
+        self.compression=compression # of the output files, None for plain ldifs
         # the following is in enrole.properties password.attributes. Lowercase it
         self.encrypted_attributes=['ersynchpassword','erservicepassword','erservicepwd1','erservicepwd2','erservicepwd3','erservicepwd4','eraddomainpassword','erpersonpassword','ernotespasswdaddcert','eritamcred','erep6umds','erposixpassphrase']
         self.extradc=False # true if there is a one more [useless] dc below dc=com
+        self.reader=None
+        self.mm=None # the ldif mapped to memory to read the entries held back
+        self.spill=None # temporary file of the entries held back from stdin, it can't be read back
+        self.buffersize=1024*1024 # entries are copied to the output files as they are, big buffers keep it at the disk speed
+        self.metrics=Metrics("dataextractor",filename)
 
     def parseOut(self):
-        i=0
-        last=-1
-
-        with open("extract-tenant.ldif","w") as self.tenantfh, open("extract-srvics.ldif","w") as self.srvicsfh, open("extract-custom.ldif","w") as self.customfh,open("extract-system.ldif","w") as self.systemfh,\
-             open("extract-people.ldif","w") as self.peoplefh, open("extract-config.ldif","w") as self.configfh, open("extract-acletc.ldif","w") as self.aclsfh,  open("extract-others.ldif","w") as self.othersfh, open(self.ldif,'r') as ldiffile:
-            print "Opening...",
-            # fastest line count using wc
-            p = subprocess.Popen(['wc', '-l', self.ldif], stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-            result, err = p.communicate()
-            if p.returncode != 0:
-                raise IOError(err)
-            num_lines=int(result.strip().split()[0]) # 118593960
-            print "%s lines." % num_lines
-            if self.deldata:
-                self.tenantdfh = open("extract-tenant-del.ldif","w")
-                self.srvicsdfh = open("extract-srvics-del.ldif","w")
-                self.customdfh = open("extract-custom-del.ldif","w")
-                self.configdfh = open("extract-config-del.ldif","w")
-                self.aclsdfh   = open("extract-acletc-del.ldif","w")
-                self.systemdfh = open("extract-system-del.ldif","w")
-            # ldiffile.seek(0)
-            entry=defaultdict(list)
-            key=''
-            try:
-                for fullline in ldiffile:
-                    line=fullline.rstrip('\n\r') # keep spaces but remove EOLs
-                    if not self.plaintext and not entry and line.startswith("erglobalid="):
-                        self.plaintext=True;
-                        print "plaintext format ",
-                    if self.plaintext: # ldapsearch plaintext format
-                        if re.match("erglobalid=.*DC=COM$",line,re.I): # analyze old and start a new entry
-                            if entry:
-                                if 'objectclass' in entry and "ou=recycleBin" not in entry['dn'][0] : # if it is a valid entry and not in the trash
-                                    self.dumpEntry(entry)
-                                entry={}
-                            entry['dn']=[line]
-                        elif re.match(r"[a-zA-Z]+=.*[^;]$",line): # it's so specific to make sure we ignore any javascript - the side effect is skipping the ldap attributes that have values ending in ;
-                            (key,value)=line.split("=",1)
-                            key=key.lower() # ldap is case insensitive
-                            value=value.strip("=")
-                            if value <> "NOT ASCII": # this means this value is lost in ldapsearch export
-                                if key in entry:
-                                    entry[key].append(value)
-                                else:
-                                    entry[key]=[value]
-                        elif len(line)>0 and len(entry) > 0: # tag line onto the last value. Skipping empty lines to make sure we dont duplicate \n, but the sideeffect is removal of blank lines from the multiline attribute values
-                            #line=line.lstrip(' ') # remove the leading space
-                            if len(entry[key]) == 1:
-                                entry[key]=[entry[key][0]+line+"\n"] #  add \n for readability (it's plaintext not base64)
-                            else:
-                                entry[key][-1]+=line+"\n" # extend the last value
-                        #else:
-                        #    print "Error: ", line
-                    else: # classical format (softerra, db2ldif)
-                        if line=='': # end of an entry
-                            if 'objectclass' in entry and "ou=recycleBin" not in entry['dn'][0] : # if it is a valid entry and not in the trash
-                                self.dumpEntry(entry)
-                            entry=defaultdict(list)
-                            entry['raw']=""
-                        elif line.startswith("#"): # skip comment
-                            continue
-                        elif ":" in line:
-                            (key,value)=line.split(":",1)
-                            key=key.lower() # ldap is case insensitive
-                            value=value.strip(": ")
-                            entry[key].append(value)
-                        elif len(entry) > 0: # tag line onto the last value
-                            line=line.lstrip(' ') # remove the leading space
-                            if len(entry[key]) == 1:
-                                entry[key]=[entry[key][0]+line]
-                            else:
-                                entry[key][-1]+=line # extend the last value
-                        entry['raw']+=fullline
-                    #if i>16000090: break
-                    # print progress
-                    percent = math.ceil(i/float(num_lines)*100*1000)/1000 # round to the tenth of a percent
-                    if percent > last :# cant simply us module because of freaky float imprecision
-                        sys.stdout.write('\rParsing %s: %s' % (self.ldif, "{:>5.1f}%".format(percent)))
-                        last=percent
-                    i+=1
-            except:
-                print "\nFailure pasing \"%s\" for %s\n%s, %s" % (line, entry, sys.exc_info()[0],sys.exc_info()[1])
-                traceback.print_exc()
-                sys.exit(2)
-
-            if self.plaintext: # plaintext parser is backfilling, need to process the last entry
-                if 'objectclass' in entry and "ou=recycleBin" not in entry['dn'][0]:
-                    self.dumpEntry(entry)
-            # second pass to dump required people records
-            if not allpeople:
-                if len(self.people.keys()) == 0:
-                    print "Could not find any person records to export"
-                else:
-                    print "\nExporting people...%s from roles, %s from workflows, %s test." % (len([k for k,v in self.neededpeople.items() if v==1]),len([k for k,v in self.neededpeople.items() if v==2]),self.testcount)
-                    # extract required entries
-                    for k in self.neededpeople.keys():
-                        #print "%s=%s" % (k,self.neededpeople[k])
-                        if k in self.people:
-                            print >> self.peoplefh, self.people[k]['raw'],
-                        else:
-                            print "Missing %s" % k
-                    print >> self.peoplefh, ""
-                    # now extract random ppl, and mix in their attributes from other random people
-                    for i in range(self.testcount):
-                        print >> self.peoplefh, self.people[random.choice(self.people.keys())]['raw']
-
-                        # mix their attributes with random people of the same set of object classes
-                        '''
-                        person=self.people[random.choice(self.people.keys())]
-                        personClasses=tuple(sorted([o.lower() for o in person['objectclass']]))
-                        print >> self.peoplefh, "dn:", person['dn'][0]
-                        cndonor=self.people[random.choice(self.peoplebyclass[personClasses])]
-                        for k in person.keys():
-                            if k=='raw' or k=='dn':
-                                continue
-                            if k=='cn' or k=='sn' or k.lower()=='givenname' or k.lower()=='displayname':
-                                similarperson=cndonor
-                            else:
-                                similarperson=self.people[random.choice(self.peoplebyclass[personClasses])]
-                            if k in similarperson:
-                                person[k]=similarperson[k]
-                            #else:
-                            #    print "Person %s: Similar person %s is missing %s" % (person['cn'],similarperson['cn'],k)
-                            for j in person[k]:
-                                print >> self.peoplefh, "%s: %s" % (k,"\n ".join(textwrap.wrap(text, 100))
-                        '''
-
-            print "done"
-        #except IOError:
-        #    print "can't open %s!" % self.ldif
-        #else:
-        #    ldiffile.close()
-
-    def dumpEntry(self,entry):
-        entryObjectclass=[o.lower() for o in entry['objectclass']]
-        dn=entry['dn'][0] if ',' in entry['dn'][0] or ('=' in entry['dn'][0] and '=' <> entry['dn'][0][-1]) else base64.b64decode(entry['dn'][0]) # guessing if it's base64
+        self.metrics.phase("parse")
+        print "Opening...",
+        reader=LdifReader(self.ldif,entryfilter=self.entryfilter)
+        self.reader=reader
+        self.plaintext=reader.plaintext
+        print "%s%s." % (reader.sizeText()," plaintext format" if self.plaintext else "")
+        try:
+            self.openFiles()
+        except IOError:
+            print sys.exc_info()[1]
+            sys.exit(2)
+        block=""
+        try:
+            for block in reader.blocks():
+                if self.dumpBlock(block):
+                    reader.entrycount+=1
+        except:
+            print "\nFailure pasing %s at byte %s\n%s, %s" % (block[:200], reader.offset, sys.exc_info()[0],sys.exc_info()[1])
+            traceback.print_exc()
+            sys.exit(2)
+        reader.close()
+        self.metrics.measure(reader)
+        self.metrics.phase("people")
+        self.dumpPeople()
+        self.closeFiles()
+        print "done"
+
+    def openFiles(self):
+        # every file in the rules is made, even if nothing goes there. The people one always is, for the test people
+        for name in set([rule.file for rule in self.rules if rule.file]+["people"]):
+            self.files[name]=self.openFile(name)
+        self.peoplefh=self.files["people"]
+        if self.reader.stdin and not self.allpeople:
+            self.spill=tempfile.TemporaryFile()
+        self.index=ReferenceIndex(not self.reader.seekable and self.spill is None) # compressed ldif can't be read back, all the references are kept
+        if self.deldata:
+            for name in set([rule.delete for rule in self.rules if rule.delete]):
+                self.deletefiles[name]=self.openFile(name)
+
+    def openFile(self,name):
+        # with --stdout the one file goes to stdout and the rest nowhere
+        if self.stdout is None:
+            return LdifWriter("extract-%s.ldif" % name,self.compression,self.buffersize)
+        if name == self.stdout:
+            return LdifWriter("-",self.compression,self.buffersize)
+        return LdifWriter(os.devnull,None,self.buffersize)
+
+    def closeFiles(self):
+        # and the manifest of what went into them
+        manifest=OrderedDict()
+        for fh in sorted(self.files.values()+self.deletefiles.values(),key=lambda fh:fh.filename):
+            fh.close()
+            manifest[fh.filename]=fh.manifest()
+        if self.stdout is None:
+            with open("extract-manifest.json","w") as f:
+                json.dump(OrderedDict([('ldif',self.ldif),('allpeople',self.allpeople),('files',manifest)]),f,indent=1)
+                f.write("\n")
+        if self.mm is not None:
+            self.mm.close()
+        if self.spill is not None:
+            self.spill.close()
+        elif self.mm is not None:
+            self.ldiffile.close()
+
+    def samplePerson(self,dn,classes):
+        # reservoir sampling, so only testcount people are kept however many are in the ldif. The same for each set of object classes
+        self.peoplecount+=1
+        self.sample(self.testpeople,self.peoplecount,dn)
+        byclass=self.peoplebyclass.setdefault(classes,[0,[]])
+        byclass[0]+=1
+        self.sample(byclass[1],byclass[0],dn)
+
+    def sample(self,samples,seen,item):
+        # the seen-th item replaces a random one of the samples with the probability of testcount/seen
+        if len(samples) < self.testcount:
+            samples.append(item)
+        else:
+            i=random.randrange(seen)
+            if i < self.testcount:
+                samples[i]=item
+
+    def pickTestPeople(self):
+        # a person of each set of object classes first, so every kind of person gets in the test data, then the rest of the sample
+        picked=[]
+        for classes in sorted(self.peoplebyclass):
+            dn=random.choice(self.peoplebyclass[classes][1])
+            if len(picked) < self.testcount and dn not in picked:
+                picked.append(dn)
+        for dn in self.testpeople:
+            if len(picked) < self.testcount and dn not in picked:
+                picked.append(dn)
+        return picked
+
+    def heldBlock(self,i):
+        # entries held back are not kept in memory, they are read back from the ldif by their offset. Not through ldifindex.py, the offsets are
+        # taken in the one pass over the ldif, for the held back entries only and from stdin too, and kept by number next to their references
+        if self.mm is None:
+            if self.spill is not None:
+                self.spill.flush()
+                self.mm=mmap.mmap(self.spill.fileno(),0,access=mmap.ACCESS_READ)
+            else:
+                self.ldiffile=open(self.ldif,'rb')
+                self.mm=mmap.mmap(self.ldiffile.fileno(),0,access=mmap.ACCESS_READ)
+        offset=self.index.offsets[i]
+        return self.mm[offset:offset+self.index.lengths[i]]
+
+    def heldReferences(self,i):
+        return self.reader.references(self.heldBlock(i))
+
+    def readHeld(self,selected):
+        # second pass over the ldif for the entries held back when it can't be read back by the offsets, only the dn lines are looked at
+        reader=LdifReader(self.ldif,label="Reading referred entries from")
+        for block in reader.blocks():
+            dn=reader.blockDn(block)
+            i=self.index.id(dn,False) if dn is not None else None
+            if i in selected:
+                selected.remove(i) # the first one of the same dn, as in the index
+                yield (i,reader.rawText(block))
+        reader.close()
+
+    def dumpPeople(self):
+        # the test people and the entries held back that the extracted ones refer to, the people in the roles and workflows, their managers, accounts and so on
+        if not self.allpeople:
+            if self.peoplecount == 0:
+                print "Could not find any person records to export"
+            testpeople=self.pickTestPeople()
+            index=self.index
+            selected=index.closure([index.id(dn) for dn in testpeople],self.heldReferences)
+            print "\nExporting people...%s test of %s, %s more referred entries of %s held back." % (len(testpeople),self.peoplecount,len(selected)-len(testpeople),index.held)
+            if not index.complete:
+                held=((i,self.reader.rawText(self.heldBlock(i))) for i in sorted(selected,key=index.offsets.__getitem__)) # in the ldif order
+            else:
+                held=self.readHeld(selected)
+            for (i,text) in held:
+                self.files[index.filenames[index.files[i]]].add(text)
+
+                # mix their attributes with random people of the same set of object classes
+                '''
+                person=self.people[random.choice(self.people.keys())]
+                personClasses=tuple(sorted([o.lower() for o in person['objectclass']]))
+                print >> self.peoplefh, "dn:", person['dn'][0]
+                cndonor=self.people[random.choice(self.peoplebyclass[personClasses])]
+                for k in person.keys():
+                    if k=='raw' or k=='dn':
+                        continue
+                    if k=='cn' or k=='sn' or k.lower()=='givenname' or k.lower()=='displayname':
+                        similarperson=cndonor
+                    else:
+                        similarperson=self.people[random.choice(self.peoplebyclass[personClasses])]
+                    if k in similarperson:
+                        person[k]=similarperson[k]
+                    #else:
+                    #    print "Person %s: Similar person %s is missing %s" % (person['cn'],similarperson['cn'],k)
+                    for j in person[k]:
+                        print >> self.peoplefh, "%s: %s" % (k,"\n ".join(textwrap.wrap(text, 100))
+                '''
+
+    def dumpBlock(self,block,entry=None):
+        # entries copied unchanged are written out as they are in the ldif, only the ones that are changed or looked into get parsed. entry if it is already parsed
+        if entry is None:
+            entryObjectclass=self.reader.objectClasses(block)
+            rawdn=self.reader.rawDn(block)
+        else:
+            entryObjectclass=[o.lower() for o in entry.get('objectclass',[])]
+            rawdn=entry['dn'][0] if 'dn' in entry else None
+        if not entryObjectclass or rawdn is None:
+            return False # not an entry
+        if "ou=recycleBin" in rawdn: # trash is skipped
+            return True
+        raw=self.reader.rawText(block)
+        dn=rawdn if ',' in rawdn or ('=' in rawdn and '=' <> rawdn[-1]) else base64.b64decode(rawdn) # guessing if it's base64
         dnlist=re.split(r'(?<!\\),',dn.lower()) # split by , but not \,
         dnlist.reverse() # LDAP tree style addressing (root at the beginning)
-        if "domain" in entryObjectclass and len(entry["dc"])>1:
-            self.extradc=True
-        if self.extradc:
+        if "domain" in entryObjectclass:
+            entry=entry or self.reader.parse(block)
+            if len(entry.get("dc",[]))>1:
+                self.extradc=True
+        if self.extradc and len(dnlist) > 1:
             dnlist.pop(1) # remove extra dc if present
-        # todo refactor for a more elegant way is to tie dn lists to filehandles and do the output it in a generic way
-        if len(dnlist) == 2 and dnlist[0] == "dc=com":
-            if "ertenant" in entryObjectclass:
-                # grab the tenant props
-                print >> self.aclsfh, "dn: "+dn
-                print >> self.aclsfh, "changetype: modify"
-                for (attr,val) in entry.items():
-                    if attr not in ["dn","control","ou","objectclass","ibm-entryuuid","raw"]: # raw is the one we create
-                        print >> self.aclsfh, "replace: "+attr
-                        print >> self.aclsfh, attr+": "+val[0]
-                        print >> self.aclsfh, "-"
-                print >> self.aclsfh, ""
-            elif "*" in self.custom_dns and "ibm-replicaGroup" not in entryObjectclass:
-                print >> self.configfh, entry['raw'],
-        elif len(dnlist) == 3 and dnlist[2] == "erglobalid=00000000000000000000" and "eracl" in entry and len(entry["eracl"]) > 0:
-            # special format - start with the ldapmodify header
-            print >> self.aclsfh, "dn: "+dn
-            print >> self.aclsfh, "changetype: modify"
-            for acl in entry["eracl"]:
-                print >> self.aclsfh, "add: eracl"
-                print >> self.aclsfh, "eracl:: "+acl # double colon to indicate base64 encoded data
-                print >> self.aclsfh, "-"
-            if self.deldata:
-                # nukem all
-                print >> self.aclsdfh, "dn: "+dn
-                print >> self.aclsdfh, "changetype: modify"
-                print >> self.aclsdfh, "delete: eracl"
-        elif len(dnlist) > 3:
-            if dnlist[2] == "erglobalid=00000000000000000000":
-                if dnlist[3] in self.tenant_dns:
-                    print >> self.tenantfh, entry['raw'],
-                    if self.deldata:
-                        print >> self.tenantdfh, "dn: "+dn
-                        print >> self.tenantdfh, "changetype: delete\n"
-                if allpeople:
-                    if dnlist[3] in self.people_dns:
-                        if not (len(dnlist)==4 or (len(dnlist)==5 and dnlist[4]=="ou=0")): # or dnlist[5]=="erglobalid=00000000000000000007"): # skip already existing base entries and System Administrator
-                            print >> self.peoplefh, entry['raw'],
-                else:
-                    if dnlist[3] == "ou=people":
-                        self.people[dn.lower()]=entry       # hash ppl for later
-                        self.peoplebyclass[tuple(sorted(entryObjectclass))].append(dn.lower())
-                    if dnlist[3] == "ou=roles" and "owner" in entry: # for maintaining referential integrity
-                        self.neededpeople[entry["owner"][0].lower()]=1
-                if dnlist[3] in self.srvics_dns:
-                    if allpeople:
-                        print >> self.srvicsfh, entry['raw'],
-                    else:
-                        if len(dnlist) > 4 and 'erITIMService' not in entry['objectclass']:  # skip over the basic itim service and the main OU container
-                            # add len(dnlist) == 5 to skip over subentries (service groups)
-                            disabledservice=re.sub(r'er(itdi|)*url: (.*)',r'er\1url: disabled|\2',entry['raw'],flags=re.IGNORECASE)
-                            #print disabledservice
-                            print >> self.srvicsfh, disabledservice,
-                    if self.deldata:
-                        print >> self.srvicsdfh, "dn: "+dn
-                        print >> self.srvicsdfh, "changetype: delete\n"
-            elif dnlist[2] == "ou=itim":
-                if dnlist[3] in self.config_dns:
-                    print >> self.configfh, entry['raw'],
-                    if self.deldata:
-                        print >> self.configdfh, "dn: "+dn
-                        print >> self.configdfh, "changetype: delete\n"
-                if allpeople and dnlist[3] in self.system_dns:
-                    print >> self.systemfh, entry['raw'],
-                    if self.deldata:
-                        print >> self.systemdfh, "dn: "+dn
-                        print >> self.systemdfh, "changetype: delete\n"
-                if 'erWorkflowDefinition'.lower() in entryObjectclass and 'erxml' in entry: # Lifecycle workflows, grep them for people references
-                    data=base64.b64decode(entry['erxml'][0]) if not self.plaintext else entry['erxml'][0]
-                    #print "Unwrapping ", entry["erprocessname"][0]
-                    persondn=re.search("erglobalid=[^,]*,ou=0,ou=people,erglobalid=00000000000000000000,ou=[^,]*,dc=com",data,flags=re.MULTILINE|re.IGNORECASE)
-                    if persondn is not None:
-                        self.neededpeople[persondn.group()]=2
-            elif dnlist[2] in self.config_dns: # for entries under the ou=itim,dc=com
-                print >> self.configfh, entry['raw'],
-                if self.deldata:
-                    print >> self.configdfh, "dn: "+dn
-                    print >> self.configdfh, "changetype: delete\n"
-            elif dnlist[2] in self.custom_dns: # dumpall
-                print >> self.customfh, entry['raw'],
-                if self.deldata:
-                    print >> self.customdfh, "dn: "+dn
-                    print >> self.customdfh, "changetype: delete\n"
-            else:
-                print >> self.othersfh, entry['raw'],
+        for rule in self.router.route(dnlist,entryObjectclass):
+            if self.transforms[rule.transform](rule,dn,entryObjectclass,block,raw,entry):
+                break
         else:
-            print >> self.othersfh, entry['raw'],
-            # remove encrypted attributes
-            #enc_att=[x in entry for x in self.encrypted_attributes]
-            #if any(enc_att):
-            #    print "%s matches %s" % (dn,[x for x,e in zip(self.encrypted_attributes,enc_att) if e])
+            rule=None
+        # what the extracted entries and the workflows refer to, for maintaining referential integrity
+        if not self.allpeople and rule is not None and ((rule.file and rule.transform not in ['sample','hold']) or 'erworkflowdefinition' in entryObjectclass):
+            self.index.want(self.reader.references(block))
+        # remove encrypted attributes
+        #enc_att=[x in entry for x in self.encrypted_attributes]
+        #if any(enc_att):
+        #    print "%s matches %s" % (dn,[x for x,e in zip(self.encrypted_attributes,enc_att) if e])
+        return True
+
+    # the transforms of the rules. Each writes an entry to the file of the rule and the removal to the delete file, and returns False if the rule does not fit
+
+    def deleteEntry(self,rule,dn):
+        if self.deldata and rule.delete:
+            self.deletefiles[rule.delete].add("dn: %s\nchangetype: delete\n\n" % dn)
+
+    def copyEntry(self,rule,dn,classes,block,raw,entry):
+        if rule.file:
+            self.files[rule.file].add(raw)
+        self.deleteEntry(rule,dn)
+        return True
+
+    def disableService(self,rule,dn,classes,block,raw,entry):
+        if rule.file:
+            disabledservice=re.sub(r'er(itdi|)*url: (.*)',r'er\1url: disabled|\2',raw,flags=re.IGNORECASE)
+            self.files[rule.file].add(disabledservice)
+        self.deleteEntry(rule,dn)
+        return True
+
+    def sampleEntry(self,rule,dn,classes,block,raw,entry):
+        # test people, held back and written out at the end by dumpPeople
+        if self.allpeople:
+            return self.copyEntry(rule,dn,classes,block,raw,entry)
+        self.samplePerson(normalDn(dn),tuple(sorted(classes)))
+        return self.holdEntry(rule,dn,classes,block,raw,entry)
+
+    def holdEntry(self,rule,dn,classes,block,raw,entry):
+        # left out unless an extracted entry refers to it, then dumpPeople writes it out. Copied with -a
+        if self.allpeople:
+            return self.copyEntry(rule,dn,classes,block,raw,entry)
+        if rule.file:
+            reader=self.reader
+            offset=reader.offset
+            if self.spill is not None:
+                offset=self.spill.tell()
+                self.spill.write(block)
+            references=reader.references(block) if self.index.complete else reader.references(block,self.heldattributes)
+            self.index.hold(normalDn(dn),offset,len(block),rule.file,references)
+        self.deleteEntry(rule,dn)
+        return True
+
+    def tenantModify(self,rule,dn,classes,block,raw,entry):
+        # grab the tenant props
+        entry=self.reader.parse(block,frozenset(self.reader.parse(block))) # all of its values, the reader may be parsing only some
+        lines=["dn: "+dn,"changetype: modify"]
+        for (attr,val) in sorted(entry.items()): # in the same order every time
+            if attr not in ["dn","control","ou","objectclass","ibm-entryuuid"]:
+                lines+=["replace: "+attr,attr+": "+val[0],"-"]
+        self.files[rule.file].add("\n".join(lines)+"\n\n")
+        return True
+
+    def aclModify(self,rule,dn,classes,block,raw,entry):
+        if "eracl" not in block.lower():
+            return False
+        entry=entry or self.reader.parse(block)
+        if not entry.get("eracl"):
+            return False
+        # special format - start with the ldapmodify header
+        lines=["dn: "+dn,"changetype: modify"]
+        for acl in entry["eracl"]:
+            lines+=["add: eracl","eracl:: "+acl,"-"] # double colon to indicate base64 encoded data
+        self.files[rule.file].add("\n".join(lines)+"\n")
+        if self.deldata and rule.delete:
+            # nukem all
+            self.deletefiles[rule.delete].add("dn: %s\nchangetype: modify\ndelete: eracl\n" % dn)
+        return True
 
 if __name__ == '__main__':
     # reopen stdout file descriptor with write mode and 0 as the buffer size (unbuffered output)
     sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+    metricsfile=metricsOption(sys.argv)
+    entryfilter=filterOption(sys.argv)
+    rulesfile=rulesOption(sys.argv)
+    compression=compressOption(sys.argv)
+    stdout=stdoutOption(sys.argv)
     if len(sys.argv) < 2:
         print __doc__
         sys.exit(1)
     filename=sys.argv[len(sys.argv)-1] # last argument
     allpeople=True if sys.argv[1] == "-a" or (len(sys.argv)>=3 and sys.argv[2] == "-a") else False
     deldata=True if sys.argv[1] == "-d" or (len(sys.argv)>=3 and sys.argv[2] == "-d") else False
-    parser=LdifParser(filename,allpeople,deldata)
+    try:
+        parser=LdifParser(filename,allpeople,deldata,entryfilter,rulesfile,compression,stdout)
+    except (IOError,ValueError):
+        print sys.exc_info()[1]
+        sys.exit(1)
     parser.parseOut()
+    parser.metrics.finish(metricsfile)
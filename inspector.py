@@ -1,11 +1,34 @@
 #!/usr/bin/python
 '''
 Analyzes LDIF and produces many stats and an LDAP tree overview
-Uses a bunch of memory - close to the size of the original ldif
+People are not kept, they are counted as they are parsed by the combinations of their object classes, attributes and roles, and by OU.
+So the memory grows with the number of services, roles, OUs and such, and with the number of distinct combinations, not with the number of people
 
-inspector.py [-c] <name of the ldif>
+inspector.py [-c][-n][-f][-k][-p <previous ldif>][-j <processes>][-d <depth>][-m <metrics file>][--stdout][<entry filter options>] <name of the ldif>
 
  -c to output stats as csv files
+ -n to ignore the cache and parse the ldif again. The cache is still saved, with the hashes if -k is given
+ -f to check the cache against an md5 of the whole ldif instead of samples of it, see below
+ -k to keep a hash of every entry in the cache, so the next dump can be inspected incrementally
+ -p to inspect incrementally against the previous dump that was inspected with -k or -p. Implies -k
+ -j to parse the ldif in parallel with the given number of processes. Each process parses its own piece of the ldif and the results are merged at the end
+ -d to print the LDAP tree only down to the given depth, branches only, each with the number of its children and of all the entries under it
+ -m to save the timings of the parse, remap and save phases and the parsing speed to a json file
+ --stdout to write the .stats report to stdout, the other stats files are not written then
+
+The entry filter options --base <dn>, --scope base|one|sub, --objectclass <class> and --filter <ldap filter> limit the inspection to some of the entries,
+see ldifreader.py. The cache is kept for one set of the filter options at a time
+
+The parsed data is cached in <name of the ldif>.cache, so the next run on the same ldif goes straight to the stats. The cache is used only if the size,
+modification time, inode and a hash of 17 samples of 64KB of the ldif have not changed. The samples are a guess: an edit in place that keeps the size,
+falls between the samples and is done within the resolution of the file system time is not seen, and the old stats are reported. Use -f when that can
+happen, it reads the whole ldif to hash it.
+
+- for the name of the ldif reads it from stdin. It is parsed every time then, the cache is saved to stdin.ldif.cache for the next run to use with -p
+
+In the incremental mode the parsed data of the previous dump is loaded from its cache, the previous ldif itself does not need to be around. The new dump is
+only hashed entry by entry, the entries that were removed or changed are taken out of the data and only the new and changed entries are analyzed.
+The stats come out the same as of a full run, for the nightly dumps with a few changes it is several times faster.
 
 Needs PrettyTable
 sudo apt-get install python-prettytable
@@ -13,251 +36,545 @@ sudo apt-get install python-prettytable
 2012-2017
 @author: Alex Ivkin
 '''
-import base64, sys, re, traceback, os, pprint, operator, csv, math, prettytable, subprocess
+import base64, sys, re, traceback, os, pprint, operator, csv, prettytable, multiprocessing, cPickle, gc
 from collections import defaultdict # dicts that need no pre-init, for simpler code
+from ldifreader import LdifReader, Metrics, fingerprint, digest, plainName, metricsOption, filterOption, stdoutOption, dataOutput
+
+cacheversion=4 # goes into the cache with the ldif fingerprint, bump when the collected data changes shape
+# attributes analyzeEntry reads the values of. The values of the rest, like the huge erxml and eracl, are not parsed. Add here when analyzing a new attribute
+attributes=['ercustomclass','erserviceproviderfactory','erurl','host','ersapnwlhostname','eroraservicehost','erservicename','eruid','erservice','eraccountstatus',
+            'erpolicyitemname','erpolicymembership','erreqpolicytarget','erpolicytarget','erroles','erparent','erpersonstatus','errolename','description','ou','o']
+
+class DnTree(object):
+    # a trie of the ldap tree, keyed by the lowercase rdns from the top down. An entry with nothing under it is kept as a plain int, the number
+    # of entries with that dn, so the millions of leaves stay small. A branch knows how many entries it has under it and how many children
+    # of each height, both updated as the entries go in and out, so the report does not have to walk the tree again
+    __slots__=('children','entries','total','heights')
+
+    def __init__(self,entries=0):
+        self.children={} # rdn -> DnTree or int
+        self.entries=entries # entries with the dn of the branch itself, 0 for a branch that is only there for the entries under it
+        self.total=entries # entries in the whole subtree
+        self.heights={} # height -> number of children with that height
+
+    def height(self):
+        return max(self.heights)+1 if self.heights else 0
+
+    def moveHeight(self,old,new):
+        # a child changed its height from old to new. None for a child that is new or gone
+        if old == new:
+            return
+        if old is not None:
+            self.heights[old]-=1
+            if not self.heights[old]:
+                del self.heights[old]
+        if new is not None:
+            self.heights[new]=self.heights.get(new,0)+1
+
+    def add(self,path):
+        # add an entry, path is the list of its rdns from the top down
+        node=self
+        branches=[self]
+        for rdn in path[:-1]:
+            child=node.children.get(rdn)
+            if type(child) is not DnTree:
+                break
+            branches.append(child)
+            node=child
+        else: # the usual case, all the branches are there so no height changes
+            for branch in branches:
+                branch.total+=1
+            rdn=path[-1]
+            child=node.children.get(rdn)
+            if type(child) is DnTree:
+                child.entries+=1
+                child.total+=1
+            elif child:
+                node.children[rdn]=child+1
+            else:
+                node.children[rdn]=1
+                node.heights[0]=node.heights.get(0,0)+1
+            return
+        node=self
+        node.total+=1
+        trail=[] # (branch, rdn, height of the child before the change)
+        for (i,rdn) in enumerate(path):
+            child=node.children.get(rdn)
+            trail.append((node,rdn,None if child is None else nodeHeight(child)))
+            if i == len(path)-1:
+                if type(child) is DnTree:
+                    child.entries+=1
+                    child.total+=1
+                else:
+                    node.children[rdn]=(child or 0)+1
+                break
+            if type(child) is not DnTree: # a leaf that gets something under it, or a branch made for the entry below
+                child=node.children[rdn]=DnTree(child or 0)
+            child.total+=1
+            node=child
+        self.reheight(trail)
+
+    def remove(self,path):
+        # take an entry out. The branches left with nothing under them go back to leaves or go away. False if there is no such entry
+        node=self
+        trail=[]
+        for rdn in path[:-1]:
+            child=node.children.get(rdn)
+            if type(child) is not DnTree:
+                return False
+            trail.append((node,rdn,child.height()))
+            node=child
+        rdn=path[-1]
+        child=node.children.get(rdn)
+        if child is None or (type(child) is DnTree and not child.entries):
+            return False
+        trail.append((node,rdn,nodeHeight(child)))
+        self.total-=1
+        for (branch,r,old) in trail[:-1]:
+            branch.children[r].total-=1
+        if type(child) is DnTree:
+            child.entries-=1
+            child.total-=1
+        elif child > 1:
+            node.children[rdn]=child-1
+        else:
+            del node.children[rdn]
+        for (branch,r,old) in reversed(trail):
+            child=branch.children.get(r)
+            if type(child) is DnTree and not child.children:
+                if child.entries:
+                    child=branch.children[r]=child.entries
+                else:
+                    del branch.children[r]
+                    child=None
+            branch.moveHeight(old,None if child is None else nodeHeight(child))
+        return True
+
+    def reheight(self,trail):
+        # bottom up, stops at the first child that kept its height, nothing above it changes then
+        for (branch,rdn,old) in reversed(trail):
+            new=nodeHeight(branch.children[rdn])
+            if new == old:
+                break
+            branch.moveHeight(old,new)
+
+    def merge(self,other):
+        # add the entries of another tree, e.g. of another piece of the ldif. other is taken apart
+        self.entries+=other.entries
+        self.total+=other.total
+        for (rdn,theirs) in other.children.iteritems():
+            mine=self.children.get(rdn)
+            old=None if mine is None else nodeHeight(mine)
+            if mine is None:
+                mine=theirs
+            elif type(mine) is not DnTree and type(theirs) is not DnTree:
+                mine+=theirs
+            else:
+                if type(mine) is not DnTree:
+                    mine=DnTree(mine)
+                mine.merge(theirs if type(theirs) is DnTree else DnTree(theirs))
+            self.children[rdn]=mine
+            self.moveHeight(old,nodeHeight(mine))
 
-def Tree(): # recursive dict storage representing an [ldap] tree
-    return defaultdict(Tree)
+def nodeHeight(node):
+    return node.height() if type(node) is DnTree else 0
+
+def treePath(rawdn):
+    # the lowercase rdns of a dn from the top down
+    dn=rawdn if ',' in rawdn or ('=' in rawdn and '=' <> rawdn[-1]) else base64.b64decode(rawdn) # guessing if it's base64
+    path=re.split(r'(?<!\\),',dn.lower()) # split by , but not \,
+    path.reverse()
+    return path
 
 class LdifParser:
 
-    def __init__(self,filename,csvformat):
+    def __init__(self,filename,csvformat,processes=1,usecache=False,keephashes=False,previous=None,treedepth=None,entryfilter=None,stdout=False,fullhash=False):
         self.ldif=filename
         self.csvformat=csvformat
+        self.processes=processes
+        self.usecache=usecache # load the cache, it is saved after every parse
+        self.fullhash=fullhash # the cache is checked against an md5 of the whole ldif, not of the samples
+        self.keephashes=keephashes or previous is not None
+        self.previous=previous # ldif the incremental run is against
+        self.cachefile=plainName(filename)+".cache" if filename == "-" else filename+".cache"
+        self.stdout=stdout # the .stats report goes to stdout, the rest is not saved
+        self.treedepth=treedepth # print the ldap tree down to this depth, with the entry counts of the branches
+        self.entryfilter=entryfilter # only the entries it matches are inspected
+        self.filterspec=entryfilter.spec if entryfilter is not None else None # goes into the cache, the data of another filter can't be reused
+        self.metrics=Metrics("inspector",filename)
         #self.accountsf=os.path.splitext(filename)[0]+".accounts"+ext
         # hash-o-hashes
         self.accounts={}
         self.services={}
-        self.people={}
+        # people counts. A combination is a sorted tuple of names (object classes, attributes or role dns), stored once and referred to by its id
+        self.combos={} # combination -> id
+        self.combolist=[] # id -> combination
+        self.peoplecount={'Active':0,'Suspended':0}
+        self.peoplebyclass=defaultdict(int) # class combination id -> number of people
+        self.peoplebyattributes=defaultdict(int) # attribute combination id -> number of people
+        self.peoplebyroles=defaultdict(int) # role dn combination id -> number of people
+        self.peoplebyou=defaultdict(int) # ou dn -> number of people
         self.roles={}
         self.ppolicies={}
         self.ous={}
         self.other={}
         self.objects=defaultdict(int) # a dict that auto inits to 0 for new keys
-        self.ldaptree=Tree()
+        self.ldaptree=DnTree()
         self.serviceprofiles={'eritimservice':'Built-in'} # init in with a default entry
         self.serviceprofileskeys={}
         self.plaintext=False; # false for db2ldif, true for ldapsearch formatted files
+        self.digests=None # entry hash -> what the entry added to the data (see analyzeEntry), when the hashes are kept
+        self.classsets={} # one tuple per set of objectclasses, for the entry records
 
     def parseOut(self):
-        i=0
-        last=-1
         try:
-            print "Opening...",
-            # fastest line count using wc
-            p = subprocess.Popen(['wc', '-l', self.ldif], stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-            result, err = p.communicate()
-            if p.returncode != 0:
-                raise IOError(err)
-            num_lines=int(result.strip().split()[0])
-            #for num_lines,l in enumerate(ldiffile):
-            #   pass
-            #num_lines+=1
-            #num_lines = sum(1 for _ in ldiffile)
-            #print llen/float(num_lines)
-            print "%s lines." % num_lines
-            ldiffile = open(self.ldif,'r')
-            ldiffile.seek(0)
-            entry={}
-            key=''
-            try:
-                for fullline in ldiffile:
-                    line=fullline.rstrip('\n\r') # keep spaces but remove EOLs
-                    if not self.plaintext and not entry and line.startswith("erglobalid="):
-                        self.plaintext=True;
-                        print "plaintext format ",
-                    if self.plaintext: # ldapsearch plaintext format
-                        if re.match("erglobalid=.*DC=COM$",line,re.I): # analyze old and start a new entry
-                            if entry:
-                                if 'objectclass' in entry:
-                                    if "ou=recycleBin" not in entry['dn'][0] : # if it is a valid entry and not in the trash
-                                        self.analyzeEntry(entry)
-                                    else:
-                                        self.countEntry(entry) # just add it to the tree, dont analyze
-                                entry={}
-                            entry['dn']=[line]
-                        elif re.match(r"[a-zA-Z]+=.*[^;]$",line): # it's so specific to make sure we ignore any javascript - the side effect is skipping the ldap attributes that have values ending in ;
-                            (key,value)=line.split("=",1)
-                            key=key.lower() # ldap is case insensitive
-                            value=value.strip("=")
-                            if value <> "NOT ASCII": # this means this value is lost in ldapsearch export
-                                if key in entry:
-                                    entry[key].append(value)
-                                else:
-                                    entry[key]=[value]
-                        elif len(line)>0 and len(entry) > 0: # tag line onto the last value. Skipping empty lines to make sure we dont duplicate \n, but the sideeffect is removal of blank lines from the multiline attribute values
-                            #line=line.lstrip(' ') # remove the leading space
-                            if len(entry[key]) == 1:
-                                entry[key]=[entry[key][0]+line+"\n"] #  add \n for readability (it's plaintext not base64)
-                            else:
-                                entry[key][-1]+=line+"\n" # extend the last value
-                        #else:
-                        #    print "Error: ", line
-                    else: # classical format (softerra, db2ldif)
-                        if line=='': # end of an entry
-                            if 'objectclass' in entry:
-                                if "ou=recycleBin" not in entry['dn'][0] : # if it is a valid entry and not in the trash
-                                    self.analyzeEntry(entry)
-                                else:
-                                    self.countEntry(entry) # just add it to the tree, dont analyze
-                            entry={}
-                        elif line.startswith("#"): # skip comment
-                            continue
-                        elif ":" in line:
-                            (key,value)=line.split(":",1)
-                            key=key.lower() # ldap is case insensitive
-                            value=value.strip(": ")
-                            if key in entry:
-                                # convert to a set
-                                entry[key].append(value)
-                            else:
-                                entry[key]=[value]
-                        elif len(entry) > 0: # tag line onto the last value
-                            line=line.lstrip(' ') # remove the leading space
-                            if len(entry[key]) == 1:
-                                entry[key]=[entry[key][0]+line]
-                            else:
-                                entry[key][-1]+=line # extend the last value
-                    #if i>1600009: break
-                    # print progress
-                    percent = math.ceil(i/float(num_lines)*100*1000)/1000 # round to the tenth of a percent
-                    if percent > last :# cant simply us module because of freaky float imprecision
-                        sys.stdout.write('\rParsing %s: %s' % (self.ldif, "{:>5.1f}%".format(percent)))
-                        last=percent
-                    i+=1
-            except:
-                print "\nFailure pasing \"%s\" for %s\n%s, %s" % (line, entry, sys.exc_info()[0],sys.exc_info()[1])
-                traceback.print_exc()
-                sys.exit(2)
-
-            if self.plaintext: # plaintext parser is backfilling, need to process the last entry
-                if 'objectclass' in entry and "ou=recycleBin" not in entry['dn'][0]:
-                    self.analyzeEntry(entry)
-            # second pass to fill in the values the first pass missed
-            print "\nRemapping ...",
-            # servicetypes do not backreference well, so we do a second pass and readability conversion right here
-            #print self.serviceprofiles
-            #print self.services
-            for (k,v) in self.services.items():
-                if v['type'] in self.serviceprofiles:
-                    serviceclass=self.serviceprofiles[v['type']]
-                    if serviceclass == 'com.ibm.itim.remoteservices.provider.itdiprovider.ItdiServiceProviderFactory':
-                        serviceclass='TDI'
-                    elif serviceclass == 'com.ibm.itim.remoteservices.provider.dsml2.DSML2ServiceProviderFactory':
-                        serviceclass='DSML'
-                    elif serviceclass == 'com.ibm.itim.remoteservices.provider.feedx.InetOrgPersonToTIMxPersonFactory':
-                        serviceclass='LDAPPersonFeed'
-                    elif serviceclass == 'com.ibm.itim.remoteservices.provider.manualservice.ManualServiceConnectorFactory':
-                        serviceclass='Manual'
-                    elif serviceclass == 'com.ibm.itim.remoteservices.provider.feedx.ADToTIMxPersonFactory':
-                        serviceclass='ADPersonFeed'
-                    elif serviceclass == 'com.ibm.itim.remoteservices.provider.feedx.CSVFileProviderFactory':
-                        serviceclass='CSV'
-                    self.services[k]['class']=serviceclass
-            # process provisioning policies
-            for (k,v) in self.ppolicies.items():
-                if v['members'] is not None: # convert role dns to names
-                    rolelist=[]
-                    for role in v['members']: # loop over req targets
-                        if role[2:].lower() in self.roles:
-                            rolelist.append(self.roles[role[2:].lower()]['name']) # convert dn to name
-                        else:
-                            rolelist.append(role[2:])
-                    self.ppolicies[k]['members']=rolelist
-                if v['required'] is not None: # convert service dns to service names
-                    svclist=[]
-                    for service in v['required']: # loop over req targets
-                        if service[2:].lower() in self.services:
-                            svclist.append(self.services[service[2:].lower()]['name']) # convert dn to name
-                        else:
-                            svclist.append(service[2:])
-                    self.ppolicies[k]['required']=svclist
-                if v['target'] is not None: # convert services in target types to service names
-                    svclist=[]
-                    for service in v['target']: # loop over req targets
-                        if service[2:].lower() in self.services:
-                            svclist.append(self.services[service[2:].lower()]['name']) # convert dn to name
-                        else:
-                            svclist.append(service[2:])
-                    self.ppolicies[k]['target']=svclist
-            # OUs
-            for (k,v) in self.ous.items():
-                #if 'parent' in v
-                allparents=self.ouLineage(v['parent'])
-                self.ous[k]['name']=((allparents+" > ") if allparents is not None else '')+v['name']
-            for (k,v) in self.ous.items(): # after we're done parsing...
-                self.ous[k].pop('parent') # Fratricide. we have them remembered thou
-
-            # common classes and attributes for ppl
-            pplcount={"Total":0,"Active":0,"Suspended":0}
-            classonly=defaultdict(int)
-            attronly=defaultdict(int)
-            for (k,v) in self.people.items():
-                for c in v['class']:
-                    classonly[c]+=1
-                for c in v['attributes']:
-                    attronly[c]+=1
-                pplcount["Total"]+=1
-                pplcount["Active" if v['status']=='0' else "Suspended"]+=1
-
-            commonclasses=set()
-            for (k,v) in classonly.items():
-                if v == pplcount['Total']:
-                    commonclasses.add(k)
-            commonattributes=set()
-            for (k,v) in attronly.items():
-                if v == pplcount['Total']:
-                    commonattributes.add(k)
-            # process statistics
-            pplbyroles=defaultdict(int) # 0 for any new key
-            pplbyclass=defaultdict(int)
-            pplbyou=defaultdict(int)
-            pplbyattributes=defaultdict(int)
-            for (k,v) in self.people.items():
-                # add people counts to roles
-                newroles=[]
-                for r in v['roles']:
-                    if r in self.roles:
-                        self.roles[r]['members']+=1
-                        newroles.append(self.roles[r]['name'])
+            if self.usecache:
+                self.metrics.phase("load cache")
+            if self.usecache and self.loadCache():
+                print "Loaded parsed data from %s" % self.cachefile,
+            else:
+                incremental=self.previous is not None and self.loadPrevious()
+                self.metrics.phase("parse")
+                print "Opening...",
+                reader=LdifReader(self.ldif,attributes=attributes,entryfilter=self.entryfilter)
+                self.plaintext=reader.plaintext
+                print "%s%s." % (reader.sizeText()," plaintext format" if self.plaintext else "")
+                if incremental:
+                    self.parseIncremental(reader)
+                else:
+                    if self.keephashes:
+                        self.digests={}
+                    if self.processes > 1 and reader.seekable: # a compressed ldif can't be split
+                        self.parseParallel(reader)
+                    else:
+                        self.parseEntries(reader)
+                reader.close()
+                self.metrics.measure(reader)
+                self.metrics.phase("save cache") # also with -n, so the next run and -p get the data and the hashes of this one
+                self.saveCache()
+            self.saveStats()
+        except IOError:
+            print "can't open %s!" % self.ldif
+
+    def loadCache(self):
+        # load the parsed data of an earlier run if it was made from the same ldif. There is no telling if stdin is
+        if self.ldif == "-" or not os.path.exists(self.cachefile):
+            return False
+        gc.disable() # the garbage collector keeps rescanning the millions of new objects, doubling the load time
+        try:
+            with open(self.cachefile,'rb') as f:
+                if cPickle.load(f) != (cacheversion,fingerprint(self.ldif,self.fullhash),self.filterspec): # the fingerprint goes first so the rest is not loaded for nothing
+                    return False
+                self.plaintext=cPickle.load(f)
+                state=cPickle.load(f)
+                if self.keephashes and state.get('digests') is None: # parse again to get the hashes
+                    return False
+                self.setState(state)
+        except (cPickle.UnpicklingError,EOFError,AttributeError,ImportError,KeyError):
+            return False
+        finally:
+            gc.enable()
+        return True
+
+    def loadPrevious(self):
+        # the parsed data and the entry hashes of the previous dump
+        cachefile=self.previous+".cache"
+        gc.disable()
+        try:
+            with open(cachefile,'rb') as f:
+                header=cPickle.load(f) # the fingerprint of the previous ldif is not checked, that one may be gone by now
+                cPickle.load(f)
+                state=cPickle.load(f) if type(header) is tuple and header[0] == cacheversion else {}
+                if state and header[2:] != (self.filterspec,):
+                    print "%s was inspected with other entry filter options, doing a full run" % self.previous
+                    return False
+        except (IOError,cPickle.UnpicklingError,EOFError,AttributeError,ImportError,KeyError):
+            print "can't load %s, doing a full run" % cachefile
+            return False
+        finally:
+            gc.enable()
+        if state.get('digests') is None:
+            print "no entry hashes in %s, doing a full run. Inspect %s with -k first" % (cachefile,self.previous)
+            return False
+        self.setState(state)
+        print "Loaded parsed data of %s" % self.previous
+        return True
+
+    def saveCache(self):
+        # has to be done before saveStats, that one changes the data in place
+        gc.disable()
+        with open(self.cachefile,'wb') as f:
+            cPickle.dump((cacheversion,fingerprint(self.ldif,self.fullhash) if self.ldif != "-" else None,self.filterspec),f,2)
+            cPickle.dump(self.plaintext,f,2)
+            cPickle.dump(self.getState(),f,2)
+        gc.enable()
+
+    def parseEntries(self,reader):
+        block=''
+        try:
+            for block in reader.blocks():
+                self.analyzeBlock(reader,block)
+        except:
+            print "\nFailure pasing %s at byte %s\n%s, %s" % (block, reader.offset, sys.exc_info()[0],sys.exc_info()[1])
+            traceback.print_exc()
+            sys.exit(2)
+
+    def analyzeBlock(self,reader,block):
+        entry=reader.parse(block)
+        record=None
+        if 'objectclass' in entry:
+            reader.entrycount+=1
+            if "ou=recycleBin" not in entry['dn'][0] : # if it is a valid entry and not in the trash
+                record=self.analyzeEntry(entry)
+            else:
+                record=self.countEntry(entry) # just add it to the tree, dont analyze
+        if self.digests is not None:
+            self.digests[self.entryKey(block)]=record
+
+    def entryKey(self,block):
+        # hash of the entry text. A copy of an entry that is already there gets the hash of the hash, so each copy has its own record
+        key=digest(block)
+        while key in self.digests:
+            key=digest(key)
+        return key
+
+    def parseIncremental(self,reader):
+        # hash the entries and analyze only the ones that were not in the previous dump
+        previous=self.digests
+        self.digests={}
+        changed=[] # offsets and lengths of the new and changed entries, the entries themselves for a compressed ldif
+        for block in reader.blocks():
+            key=self.entryKey(block)
+            if key in previous:
+                self.digests[key]=previous.pop(key)
+            else:
+                changed.append((reader.offset,len(block)) if reader.seekable else block)
+        print "\n%s entries unchanged, %s removed or changed, %s new or changed" % (len(self.digests),len(previous),len(changed))
+        # the old versions go first, so a changed service gets its details back on top of the account counters
+        for record in previous.itervalues():
+            if record is not None:
+                self.removeEntry(record)
+        block=''
+        try:
+            f=open(self.ldif,'rb') if reader.seekable else None
+            for change in changed:
+                if reader.seekable:
+                    f.seek(change[0])
+                    block=f.read(change[1])
+                else:
+                    block=change
+                self.analyzeBlock(reader,block)
+            if f is not None:
+                f.close()
+        except:
+            print "\nFailure pasing %s\n%s, %s" % (block, sys.exc_info()[0],sys.exc_info()[1])
+            traceback.print_exc()
+            sys.exit(2)
+
+    def parseParallel(self,reader):
+        # more pieces than processes to even out the load and to show the progress
+        ranges=reader.split(self.processes*4)
+        pool=multiprocessing.Pool(self.processes)
+        done=0
+        for (state,entrycount) in pool.imap(parseRange,[(self.ldif,start,end,self.keephashes,self.entryfilter) for (start,end) in ranges]): # in order, so the merged results are the same as of a single pass
+            self.mergeState(state)
+            reader.entrycount+=entrycount
+            done+=1
+            sys.stdout.write('\rParsing %s: %s' % (self.ldif, "{:>5.1f}%".format(done*100.0/len(ranges))))
+        pool.close()
+        pool.join()
+
+    def getState(self):
+        # everything analyzeEntry collects. Plain dicts, so it can be loaded by any script that imports inspector
+        return {'services':self.services,'roles':self.roles,'ppolicies':self.ppolicies,'ous':self.ous,'other':self.other,
+                'objects':dict(self.objects),'ldaptree':self.ldaptree,'serviceprofiles':self.serviceprofiles,'digests':self.digests,
+                'combolist':self.combolist,'peoplecount':self.peoplecount,'peoplebyclass':dict(self.peoplebyclass),'peoplebyattributes':dict(self.peoplebyattributes),
+                'peoplebyroles':dict(self.peoplebyroles),'peoplebyou':dict(self.peoplebyou)}
+
+    def setState(self,state):
+        for (k,v) in state.items():
+            if k in ['objects','peoplebyclass','peoplebyattributes','peoplebyroles','peoplebyou']:
+                setattr(self,k,defaultdict(int,v))
+            else:
+                setattr(self,k,v)
+        self.combos=dict([(c,i) for (i,c) in enumerate(self.combolist)])
+
+    def mergeState(self,state):
+        # add the results of parsing another piece of the ldif
+        for (k,v) in state['services'].items():
+            if k not in self.services:
+                self.services[k]=v
+                continue
+            service=self.services[k]
+            if service['type'] == 'unknown' and v['type'] != 'unknown': # guessed from an account, and the other piece has the real service
+                for f in ['name','type','url','class']:
+                    service[f]=v[f]
+            for f in ['active accounts','suspended accounts','orphan accounts']:
+                service[f]+=v[f]
+        self.roles.update(state['roles'])
+        self.ppolicies.update(state['ppolicies'])
+        self.ous.update(state['ous'])
+        # combination ids of the other piece are its own
+        ids=[self.comboId(c) for c in state['combolist']]
+        for (k,v) in state['peoplecount'].items():
+            self.peoplecount[k]+=v
+        for f in ['peoplebyclass','peoplebyattributes','peoplebyroles']:
+            counts=getattr(self,f)
+            for (k,v) in state[f].items():
+                counts[ids[k]]+=v
+        for (k,v) in state['peoplebyou'].items():
+            self.peoplebyou[k]+=v
+        self.serviceprofiles.update(state['serviceprofiles'])
+        for (k,v) in state['other'].items():
+            if k in self.other:
+                self.other[k]+=v
+            else:
+                self.other[k]=v
+        for (k,v) in state['objects'].items():
+            self.objects[k]+=v
+        self.ldaptree.merge(state['ldaptree'])
+        if state['digests'] is not None:
+            for (k,record) in state['digests'].iteritems():
+                if record is not None and record[2] == 'people':
+                    (classes,attributes,roles,ou,status)=record[3]
+                    record=record[:3]+((ids[classes],ids[attributes],ids[roles],ou,status),)
+                while k in self.digests: # the same entry in several pieces
+                    k=digest(k)
+                self.digests[k]=record
+
+    def saveStats(self):
+        # second pass to fill in the values the first pass missed
+        self.metrics.phase("remap")
+        print "\nRemapping ...",
+        # servicetypes do not backreference well, so we do a second pass and readability conversion right here
+        #print self.serviceprofiles
+        #print self.services
+        for (k,v) in self.services.items():
+            if v['type'] in self.serviceprofiles:
+                serviceclass=self.serviceprofiles[v['type']]
+                if serviceclass == 'com.ibm.itim.remoteservices.provider.itdiprovider.ItdiServiceProviderFactory':
+                    serviceclass='TDI'
+                elif serviceclass == 'com.ibm.itim.remoteservices.provider.dsml2.DSML2ServiceProviderFactory':
+                    serviceclass='DSML'
+                elif serviceclass == 'com.ibm.itim.remoteservices.provider.feedx.InetOrgPersonToTIMxPersonFactory':
+                    serviceclass='LDAPPersonFeed'
+                elif serviceclass == 'com.ibm.itim.remoteservices.provider.manualservice.ManualServiceConnectorFactory':
+                    serviceclass='Manual'
+                elif serviceclass == 'com.ibm.itim.remoteservices.provider.feedx.ADToTIMxPersonFactory':
+                    serviceclass='ADPersonFeed'
+                elif serviceclass == 'com.ibm.itim.remoteservices.provider.feedx.CSVFileProviderFactory':
+                    serviceclass='CSV'
+                self.services[k]['class']=serviceclass
+        # process provisioning policies
+        for (k,v) in self.ppolicies.items():
+            if v['members'] is not None: # convert role dns to names
+                rolelist=[]
+                for role in v['members']: # loop over req targets
+                    if role[2:].lower() in self.roles:
+                        rolelist.append(self.roles[role[2:].lower()]['name']) # convert dn to name
+                    else:
+                        rolelist.append(role[2:])
+                self.ppolicies[k]['members']=rolelist
+            if v['required'] is not None: # convert service dns to service names
+                svclist=[]
+                for service in v['required']: # loop over req targets
+                    if service[2:].lower() in self.services:
+                        svclist.append(self.services[service[2:].lower()]['name']) # convert dn to name
+                    else:
+                        svclist.append(service[2:])
+                self.ppolicies[k]['required']=svclist
+            if v['target'] is not None: # convert services in target types to service names
+                svclist=[]
+                for service in v['target']: # loop over req targets
+                    if service[2:].lower() in self.services:
+                        svclist.append(self.services[service[2:].lower()]['name']) # convert dn to name
                     else:
-                        newroles.append(r)
-                #self.people[k]['roles']=newroles
-                self.people[k]['roles']=len(newroles)
-                fr=tuple(sorted(newroles)) # tuple instead of the frozenset, since sets are unordered and show up randomly even when created from a sorted list
-                #pplpyroles.setdefault(fr,[]).append(p)
-                pplbyroles[fr]+=1
-                pplbyclass[tuple(sorted(set(v['class'])-commonclasses))]+=1
-                pplbyattributes[tuple(sorted(set(v['attributes'])-commonattributes))]+=1
-
-                if v['ou'] in self.ous:
-                    self.ous[v['ou']]['people']+=1
-                    self.people[k]['ou']=self.ous[v['ou']]['name']
-
-                pplbyou[self.people[k]['ou']]+=1
-            # print collected stats
-            print "done\nSaving :",
+                        svclist.append(service[2:])
+                self.ppolicies[k]['target']=svclist
+        # OUs
+        lineage={} # resolve all names first, renaming while resolving makes the result depend on the order of the hash
+        for (k,v) in self.ous.items():
+            #if 'parent' in v
+            allparents=self.ouLineage(v['parent'])
+            lineage[k]=((allparents+" > ") if allparents is not None else '')+v['name']
+        for (k,v) in self.ous.items(): # after we're done parsing...
+            self.ous[k]['name']=lineage[k]
+            self.ous[k].pop('parent') # Fratricide. we have them remembered thou
+
+        # common classes and attributes for ppl
+        pplcount={"Total":self.peoplecount["Active"]+self.peoplecount["Suspended"],"Active":self.peoplecount["Active"],"Suspended":self.peoplecount["Suspended"]}
+        classonly=defaultdict(int)
+        attronly=defaultdict(int)
+        for (k,v) in self.peoplebyclass.items():
+            if v: # the combinations of the people removed in an incremental run stay with 0
+                for c in self.combolist[k]:
+                    classonly[c]+=v
+        for (k,v) in self.peoplebyattributes.items():
+            if v:
+                for c in self.combolist[k]:
+                    attronly[c]+=v
+
+        commonclasses=set()
+        for (k,v) in classonly.items():
+            if v == pplcount['Total']:
+                commonclasses.add(k)
+        commonattributes=set()
+        for (k,v) in attronly.items():
+            if v == pplcount['Total']:
+                commonattributes.add(k)
+        # process statistics
+        pplbyroles=defaultdict(int) # 0 for any new key
+        pplbyclass=defaultdict(int)
+        pplbyou=defaultdict(int)
+        pplbyattributes=defaultdict(int)
+        for (k,v) in self.peoplebyroles.items():
+            if not v:
+                continue
+            # add people counts to roles
+            newroles=[]
+            for r in self.combolist[k]:
+                if r in self.roles:
+                    self.roles[r]['members']+=v
+                    newroles.append(self.roles[r]['name'])
+                else:
+                    newroles.append(r)
+            fr=tuple(sorted(newroles)) # tuple instead of the frozenset, since sets are unordered and show up randomly even when created from a sorted list
+            pplbyroles[fr]+=v
+        for (k,v) in self.peoplebyclass.items():
+            if v:
+                pplbyclass[tuple(sorted(set(self.combolist[k])-commonclasses))]+=v
+        for (k,v) in self.peoplebyattributes.items():
+            if v:
+                pplbyattributes[tuple(sorted(set(self.combolist[k])-commonattributes))]+=v
+        for (k,v) in self.peoplebyou.items():
+            if not v:
+                continue
+            if k in self.ous:
+                self.ous[k]['people']+=v
+                pplbyou[self.ous[k]['name']]+=v
+            else:
+                pplbyou[k]+=v
+        # print collected stats
+        self.metrics.phase("save")
+        print "done\nSaving :",
+        if not self.stdout:
             self.saveDict(self.services,"services")
             self.saveDict(self.roles,"roles")
             self.saveDict(self.ppolicies,"ppolicies")
             self.saveDict(self.ous,"ous")
             #self.saveDict(self.people,"people",issorted=False) # sorting takes too long
             self.saveMultiDict(self.other,"other")
-            with open(os.path.splitext(filename)[0]+".stats",'w') as o:
-                self.ptTree("LDAP Tree",self.ldaptree,o)
-                self.ptDict("People",pplcount,o)
-                self.ptDict("Objects",self.objects,o)
-                self.ptDict("Object class used by people",classonly,o)
-                self.ptDict("Person Object classes",pplbyclass,o)
-                self.ptDict("Person OUs",pplbyou,o)
-                self.ptDict("Person Roles",pplbyroles,o)
-                self.ptDict("Attribute used by people",attronly,o)
-                self.ptDict("Person Attributes",pplbyattributes,o)
-            print "done"
-        except IOError:
-            print "can't open %s!" % self.ldif
-        else:
-            ldiffile.close()
+        with (dataOutput() if self.stdout else open(os.path.splitext(plainName(self.ldif))[0]+".stats",'w')) as o:
+            self.ptTree("LDAP Tree",self.ldaptree,o)
+            self.ptDict("People",pplcount,o)
+            self.ptDict("Objects",self.objects,o)
+            self.ptDict("Object class used by people",classonly,o)
+            self.ptDict("Person Object classes",pplbyclass,o)
+            self.ptDict("Person OUs",pplbyou,o)
+            self.ptDict("Person Roles",pplbyroles,o)
+            self.ptDict("Attribute used by people",attronly,o)
+            self.ptDict("Person Attributes",pplbyattributes,o)
+        print "done"
 
     def ptDict(self,name, dicttosave,filehandle):
         print "%s %s..." % (len(dicttosave),name),
@@ -273,7 +590,10 @@ class LdifParser:
     def saveDict(self,dicttosave,filename,issorted=True):
         print "%s %s..." % (len(dicttosave),filename),
         # save/print a dict values (not keys)
-        fields=dicttosave.itervalues().next().keys()
+        if not dicttosave: # none of these in the ldif or in the filtered entries
+            open(os.path.splitext(plainName(self.ldif))[0]+"."+filename+(".csv" if self.csvformat else ""),'w').close()
+            return
+        fields=sorted(dicttosave.itervalues().next().keys()) # sorted, so the columns are the same from run to run
         #if issorted:
         #    dicttosave=sorted(indict.items(),key=operator.itemgetter(1)) # sort by key - alternatively could sort in prettytable using x.sortby = "name"
         #else:
@@ -282,7 +602,7 @@ class LdifParser:
             fields.remove('name')
             fields.insert(0,'name')
 
-        with open(os.path.splitext(self.ldif)[0]+"."+filename+(".csv" if self.csvformat else ""),'w') as o:
+        with open(os.path.splitext(plainName(self.ldif))[0]+"."+filename+(".csv" if self.csvformat else ""),'w') as o:
             if self.csvformat:
                 #print >> self.drf, "".join(["Service Name".ljust(50),"Service type (class)".ljust(40),"URL".ljust(50),"Active".ljust(10),"Suspended".ljust(10),"Orphans".ljust(10)])
                 c=csv.DictWriter(o,fields) # get keys of a hash of a random element
@@ -303,7 +623,7 @@ class LdifParser:
 
     def saveMultiDict(self,dicttosave,filename):
         print "%s %s..." % (len(dicttosave),filename),
-        with open(os.path.splitext(self.ldif)[0]+"."+filename,'w') as o:
+        with open(os.path.splitext(plainName(self.ldif))[0]+"."+filename,'w') as o:
             for (k,v) in dicttosave.items():
                 print >> o, "%s (%s items):" % (k,len(v))
                 for i in v:
@@ -318,64 +638,36 @@ class LdifParser:
     def ptTree(self,name, treetosave,filehandle):
         # print an LDAP tree
         print "%s..." % name,
-        print >> filehandle, "%s : \n" % name #%s leafs\n" % (name,len(dicttosave))
-        #pprint.pprint(treetosave, stream=filehandle)
-        print >> filehandle, self.treePrinter(treetosave)
+        print >> filehandle, "%s : %s entries\n" % (name,treetosave.total)
+        lines=[]
+        self.treePrinter(treetosave,lines)
+        print >> filehandle, "\n".join(lines)
         print >> filehandle, "\n"
 
-    def treePrinter(self,tree,level=0,full=False): # full to print leaves
-        # recursive tree printer
-        strtree=""
-        for (k,v) in tree.items():
-            strtree+="%s%s: %s items\n" % ('   '*level,k,len(v) if type(v) is dict else 0)
-            if type(v) is dict:
-                if full or self.maxheight(v)>1:
-                    strtree+=self.treePrinter(v,level+1)
-            else:
-                if full:
-                    strtree+="%s%s\n" % ('   '*(level+1),v)
-        return strtree
-
-    def maxheight(self,tree,h=0):
-        # find max tree height
-        #print "%s:%s" % (tree,h)
-        if type(tree) is not dict:
-            return h
-        return max(self.maxheight(v,h+1) for k,v in tree.iteritems())
-
-    def toBranch(self,branch,val):
-        # convert a dc list into a tree of nested hashes
-        if len(branch):
-            x=branch.pop(0) # branch is modified by pop
-            return {x:self.toBranch(branch,val)}
-        else:
-            return val
-
-    def updateBranch(self,tree,branch):
-        # tree is a nested hash of hashes, branch is a list of items
-        #print "updating %s with %s" % (tree,branch)
-        if type(tree) is int: # matched to a leaf
-            if len(branch):
-                tree=self.toBranch(branch,1)
-            #tree['leaf']=1 # add the leaf
-            return tree
-        x=branch.pop(0) # branch is modified by pop
-        if x in tree:
-            tree[x]=self.updateBranch(tree[x],branch)
-        else:
-            tree[x]=self.toBranch(branch,1)
-        return tree
+    def treePrinter(self,tree,lines,level=0,full=False): # full to print leaves
+        # recursive tree printer. Without a depth goes down the branches that have more than just leaves under them,
+        # with a depth prints only the branches down to that depth, the leaves are in the counts
+        for k in sorted(tree.children):
+            v=tree.children[k]
+            isbranch=type(v) is DnTree
+            if self.treedepth is not None and not isbranch:
+                continue
+            lines.append("%s%s: %s items, %s entries" % ('   '*level,k,len(v.children) if isbranch else 0,v.total if isbranch else v))
+            if isbranch:
+                if self.treedepth is not None:
+                    if level+1 < self.treedepth:
+                        self.treePrinter(v,lines,level+1)
+                elif full or v.height()>1:
+                    self.treePrinter(v,lines,level+1,full)
 
     def countEntry(self,entry):
         try:
-            dn=entry['dn'][0] if ',' in entry['dn'][0] or ('=' in entry['dn'][0] and '=' <> entry['dn'][0][-1]) else base64.b64decode(entry['dn'][0]) # guessing if it's base64
-            treelist=re.split(r'(?<!\\),',dn.lower()) # split by , but not \,
-            treelist.reverse()
-            self.ldaptree=self.updateBranch(self.ldaptree,treelist);
+            self.ldaptree.add(treePath(entry['dn'][0]))
         except:
             print "\nFailure processing %s\n%s, %s" % (entry,sys.exc_info()[0],sys.exc_info()[1])
             traceback.print_exc()
             sys.exit(2)
+        return (entry['dn'][0],(),'recycled',None)
 
     def analyzeEntry(self,entry):
         filepattern=re.compile(r'[\\/:"*?<>|]+') # invalid filename characters on windows
@@ -388,6 +680,7 @@ class LdifParser:
                 serviceprofilename=entry['ercustomclass'][0]
                 serviceclass=entry['erserviceproviderfactory'][0] if 'erserviceproviderfactory' in entry else 'Native/DAML' # '''','.join(entry['erproperties'])
                 self.serviceprofiles[serviceprofilename.lower()]=serviceclass
+                effect=('serviceprofile',serviceprofilename.lower())
                 #self.serviceprofiles[entry['dn'][0].lower()]=entry
                 #self.serviceprofileskeys.update(dict(zip(entry.keys(),[1 for _ in entry.keys()])))
             elif 'erServiceItem'.lower() in entryObjectclass: # service
@@ -403,6 +696,7 @@ class LdifParser:
                     self.services[servicedn]['type']=servicetype
                     self.services[servicedn]['url']=serviceurl
                     self.services[servicedn]['class']=serviceclass
+                effect=('service',servicedn)
             elif 'erAccountItem'.lower() in entryObjectclass: # service
                 #accounttype="+".join([t for t in entry["objectclass"] if t != "erAccountItem" and t!="top" and t!="erManagedItem" and t!="erRemoteServiceItem"])
                 #if accounttype not in self.accounts:
@@ -413,23 +707,25 @@ class LdifParser:
                 #self.accounts[entry['dn'][0].lower()]=entry
                 if 'erservice' not in entry:
                     print "Missing erservice in "+entry['eruid'][0]
-                    return
-                servicedn=entry['erservice'][0].lower()
+                    return None
+                servicedn=intern(entry['erservice'][0].lower()) # one string shared by all the accounts of a service
                 #if 'eraccountstatus' not in entry: # this is probably an orphan - ignore for now
                 #    return # can further check if thats an oprhan by doing
                 accountstatus=entry['eraccountstatus'][0] if 'eraccountstatus' in entry else ''
                 if servicedn not in self.services: # we found an account before we found a serveice
-                    serviceuid=re.search('erglobalid=(.+),ou=services',servicedn).group(1)
-                    self.services[servicedn]={'name':serviceuid,'type':'unknown','url':'unknown','active accounts':0,'suspended accounts':0,'orphan accounts':0,'class':'unknown'}
+                    self.services[servicedn]=self.guessService(servicedn)
                 if "ou=orphans," in entry['dn'][0]:
-                    self.services[servicedn]['orphan accounts']+=1
+                    counter='orphan accounts'
                 elif accountstatus=='0': # active if 0, suspended if 1
-                    self.services[servicedn]['active accounts']+=1
+                    counter='active accounts'
                 else:
-                    self.services[servicedn]['suspended accounts']+=1
+                    counter='suspended accounts'
+                self.services[servicedn][counter]+=1
+                effect=('account',(servicedn,counter))
             elif 'erProvisioningPolicy'.lower() in entryObjectclass: # Provisioinig Policies - ou=policies,erglobalid=00000000000000000000,ou=...
                 #self.ppolicies[entry['dn'][0].lower()]=entry
-                self.ppolicies[entry['dn'][0].lower()]={'name':entry["erpolicyitemname"][0],'members':entry["erpolicymembership"],'required':entry["erreqpolicytarget"] if 'erreqpolicytarget' in entry else None,'target':entry["erpolicytarget"] if 'erpolicytarget' in entry else None}
+                effect=('ppolicies',entry['dn'][0].lower())
+                self.ppolicies[effect[1]]={'name':entry["erpolicyitemname"][0],'members':entry["erpolicymembership"],'required':entry["erreqpolicytarget"] if 'erreqpolicytarget' in entry else None,'target':entry["erpolicytarget"] if 'erpolicytarget' in entry else None}
                 ''' for erpolicymembership:
 
                     for erpolicytarget:
@@ -441,49 +737,146 @@ class LdifParser:
                     erreqpolicytarget contains prerequisites in the same format
                 '''
             elif 'erPersonItem'.lower() in entryObjectclass or 'erbppersonitem' in entryObjectclass: # person
-                person={'name':entry['cn'][0], 'status':entry['erpersonstatus'][0],'roles':[]}
-                if 'erroles' in entry:
-                    person['roles']=[r.lower() for r in entry['erroles']]
-                person['ou']=entry['erparent'][0].lower()
-                person['class']=[o.lower() for o in entryObjectclass]#set([o.lower() for o in entryObjectclass])-set(['top','ermanageditem','inetorgperson','organizationalperson','person','erpersonitem'])
-                person['attributes']=[k.lower() for k in entry.keys()]#set([k.lower() for k in entry.keys()])-set(['dn','cn','sn','displayname','ercreatedate','erglobalid','erparent','erpersonstatus','erlastmodifiedtime','erroles','ibm-entryuuid','control'])#[k.lower() for k in entry.keys()]
-                person['num of attributes']=len(person['attributes'])
-                self.people[entry['dn'][0].lower()]=person
+                # the person is only counted. The keys are interned by the reader already
+                person=(self.comboId([intern(o) for o in entryObjectclass]),self.comboId(entry.keys()),self.comboId([intern(r.lower()) for r in entry.get('erroles',[])]),
+                        intern(entry['erparent'][0].lower()),'Active' if entry['erpersonstatus'][0] == '0' else 'Suspended')
+                self.countPerson(person,1)
+                effect=('people',person)
             elif 'erRole'.lower() in entryObjectclass: # role
                 self.roles[entry['dn'][0].lower()]={'name':entry['errolename'][0],'description':entry['description'][0] if 'description' in entry else '','members':0} # last item is a membership counter to be filled later
+                effect=('roles',entry['dn'][0].lower())
             elif 'erOrgUnitItem'.lower() in entryObjectclass or 'organizationalUnit'.lower() in entryObjectclass:
                 self.ous[entry['dn'][0].lower()]={'name':entry['ou'][0],'parent':entry['erparent'][0].lower() if 'erparent' in entry else '','people':0}
+                effect=('ous',entry['dn'][0].lower())
             elif 'organization'.lower() in entryObjectclass:
                 self.ous[entry['dn'][0].lower()]={'name':entry['o'][0],'parent':'','people':0}
+                effect=('ous',entry['dn'][0].lower())
             else:
                 key=", ".join([o for o in sorted(entryObjectclass) if o <> "top" and o <> "ermanageditem"]) # a key to count all other object classes
                 if key in self.other:
                     self.other[key]+=[entry['dn'][0]]
                 else:
                     self.other[key]=[entry['dn'][0]]
+                effect=('other',key)
             for o in entryObjectclass:
                 self.objects[o]+=1
-            dn=entry['dn'][0] if ',' in entry['dn'][0] or ('=' in entry['dn'][0] and '=' <> entry['dn'][0][-1]) else base64.b64decode(entry['dn'][0]) # guessing if it's base64
-            #treelist=dn.lower().split(',')
-            #print treelist
-            treelist=re.split(r'(?<!\\),',dn.lower()) # split by , but not \,
-            #print treelist
-            treelist.reverse()
-            #self.updateBranch(self.ldaptree,self.toBranch(treelist,1));
-            self.ldaptree=self.updateBranch(self.ldaptree,treelist);
+            self.ldaptree.add(treePath(entry['dn'][0]))
         except:
             print "\nFailure processing %s\n%s, %s" % (entry,sys.exc_info()[0],sys.exc_info()[1])
             traceback.print_exc()
             sys.exit(2)
+        # what this entry added, so it can be taken back out if the entry is gone from the next dump. See removeEntry
+        classes=tuple(entryObjectclass)
+        return (entry['dn'][0],self.classsets.setdefault(classes,classes))+effect
+
+    def comboId(self,names):
+        combo=tuple(sorted(names))
+        i=self.combos.get(combo)
+        if i is None:
+            i=self.combos[combo]=len(self.combolist)
+            self.combolist.append(combo)
+        return i
+
+    def countPerson(self,person,n):
+        # n is 1 to add a person, -1 to take one out
+        (classes,attributes,roles,ou,status)=person
+        self.peoplecount[status]+=n
+        self.peoplebyclass[classes]+=n
+        self.peoplebyattributes[attributes]+=n
+        self.peoplebyroles[roles]+=n
+        self.peoplebyou[ou]+=n
+
+    def guessService(self,servicedn):
+        # placeholder for a service that is only known from its accounts
+        serviceuid=re.search('erglobalid=(.+),ou=services',servicedn).group(1)
+        return {'name':serviceuid,'type':'unknown','url':'unknown','active accounts':0,'suspended accounts':0,'orphan accounts':0,'class':'unknown'}
+
+    def removeEntry(self,record):
+        # undo analyzeEntry or countEntry for an entry that has changed or is no longer in the ldif
+        (rawdn,classes,kind,key)=record
+        if kind == 'serviceprofile':
+            self.serviceprofiles.pop(key,None)
+        elif kind == 'service' and key in self.services: # the accounts may still be there, so go back to the guessed service
+            service=self.services[key]
+            if service['active accounts'] or service['suspended accounts'] or service['orphan accounts']:
+                guess=self.guessService(key)
+                for f in ['name','type','url','class']:
+                    service[f]=guess[f]
+            else:
+                del self.services[key]
+        elif kind == 'account':
+            (servicedn,counter)=key
+            service=self.services[servicedn]
+            service[counter]-=1
+            if service['type'] == 'unknown' and not (service['active accounts'] or service['suspended accounts'] or service['orphan accounts']):
+                del self.services[servicedn]
+        elif kind == 'other':
+            self.other[key].remove(rawdn)
+            if not self.other[key]:
+                del self.other[key]
+        elif kind == 'people':
+            self.countPerson(key,-1)
+        elif kind != 'recycled':
+            getattr(self,kind).pop(key,None) # roles, ous, ppolicies
+        for o in classes:
+            self.objects[o]-=1
+            if not self.objects[o]:
+                del self.objects[o]
+        self.ldaptree.remove(treePath(rawdn))
 
 
+def parseRange(args):
+    # runs in a pool process, parsing a byte range of the ldif
+    (filename,start,end,keephashes,entryfilter)=args
+    parser=LdifParser(filename,False,keephashes=keephashes)
+    reader=LdifReader(filename,label=None,start=start,end=end,attributes=attributes,entryfilter=entryfilter)
+    parser.plaintext=reader.plaintext
+    if keephashes:
+        parser.digests={}
+    try:
+        parser.parseEntries(reader)
+    except SystemExit: # would hang the pool
+        raise RuntimeError("Failure parsing bytes %s-%s of %s" % (start,end,filename))
+    reader.close()
+    return (parser.getState(),reader.entrycount)
+
 if __name__ == '__main__':
     # reopen stdout file descriptor with write mode and 0 as the buffer size (unbuffered output)
     sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
     if len(sys.argv) < 2:
         print __doc__
         sys.exit(1)
-    filename=sys.argv[1] if len(sys.argv) == 2 else sys.argv[2]
-    csvformat=True if sys.argv[1] == "-c" else False
-    parser=LdifParser(filename,csvformat)
+    args=sys.argv[1:]
+    metricsfile=metricsOption(args)
+    entryfilter=filterOption(args)
+    stdout=stdoutOption(args)
+    filename=args.pop() # last argument
+    csvformat=False
+    processes=1
+    usecache=True
+    fullhash=False
+    keephashes=False
+    previous=None
+    treedepth=None
+    while args:
+        arg=args.pop(0)
+        if arg == "-c":
+            csvformat=True
+        elif arg == "-n":
+            usecache=False
+        elif arg == "-f":
+            fullhash=True
+        elif arg == "-k":
+            keephashes=True
+        elif arg == "-p" and args:
+            previous=args.pop(0)
+        elif arg == "-j" and args:
+            processes=int(args.pop(0))
+        elif arg == "-d" and args:
+            treedepth=int(args.pop(0))
+        else:
+            print __doc__
+            sys.exit(1)
+    parser=LdifParser(filename,csvformat,processes,usecache,keephashes,previous,treedepth,entryfilter,stdout,fullhash)
     parser.parseOut()
+    parser.metrics.finish(metricsfile)
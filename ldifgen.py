@@ -0,0 +1,229 @@
+#!/usr/bin/python
+'''
+Generates a synthetic ISIM LDIF of a given size, to test and benchmark the tools without a production dump
+
+ldifgen.py [-p][-s <seed>][-k <PBE encryption password>] <number of entries> <name of the ldif>
+
+ -p to write the ldapsearch plaintext format instead of db2ldif
+ -s to seed the random generator, 1 by default. The same seed and size give the same file
+ -k the password to PBE encrypt the passwords with, "password" by default. Use the same one for reencrypter.py
+
+The data looks like a typical ISIM tenant: the tenant and its OUs, an org chart, service profiles, services, roles, provisioning policies,
+workflows with base64 erxml, forms, mail templates, assembly lines, people with erroles, two accounts per person on average with erservice
+and eraccountstatus, some orphan accounts and some recycle bin entries. Most of the entries are people and accounts, the rest grows slowly with the size.
+Passwords are encrypted as ISIM does it, some are one way hashed and some are junk, so reencrypter has all its cases.
+Needs Pycrypto for the passwords, without it they are random base64.
+
+'''
+import base64, sys, os, random
+
+try:
+    from Crypto.Hash import MD5
+    from Crypto.Cipher import DES
+except ImportError:
+    MD5=None
+
+class LdifGenerator:
+
+    def __init__(self,filename,count,plaintext=False,seed=1,password="password"):
+        self.ldif=filename
+        self.count=count # entries to write
+        self.plaintext=plaintext
+        self.random=random.Random(seed)
+        self.written=0
+        self.org="ou=org,dc=com"
+        self.tenant="erglobalid=00000000000000000000,"+self.org
+        self.itim="ou=itim,"+self.org
+        self.nextid=1000 # erglobalids handed out
+        self.key=None
+        if MD5 is not None: # same as reencrypter.compute_DES_key_iv
+            result=MD5.new(password+"\xC7\x73\x21\x8C\x7E\xC8\xEE\x99").digest()
+            for i in xrange(1,20):
+                result=MD5.new(result).digest()
+            self.key,self.iv=result[:8],result[8:16]
+
+    def generate(self):
+        print "Generating %s entries into %s..." % (self.count,self.ldif),
+        with open(self.ldif,'w',1024*1024) as self.out:
+            if not self.plaintext:
+                self.out.write("version: 1\n\n")
+            self.tenantEntries()
+            ous=self.orgChart(max(5,self.count/5000))
+            services=self.services(max(4,self.count/20000))
+            roles=self.roles(max(8,self.count/2000))
+            self.policies(max(3,len(roles)/2),roles,services)
+            self.workflows(max(3,self.count/50000))
+            self.config()
+            recycled=self.count/100
+            self.people(self.count-self.written-recycled,ous,roles,services)
+            self.recycleBin(recycled,services)
+        print " %s written" % self.written
+
+    def globalid(self):
+        self.nextid+=1
+        return str(self.nextid)
+
+    def encrypt(self,value):
+        # PBEWithMD5AndDES, base64 encoded
+        if self.key is None:
+            return base64.b64encode("".join([chr(self.random.randint(0,255)) for i in range(16)]))
+        pad=8-len(value)%8
+        return base64.b64encode(DES.new(self.key,DES.MODE_CBC,self.iv).encrypt(value+chr(pad)*pad))
+
+    def entry(self,dn,attributes):
+        # attributes is a list of name, value pairs. A value in a tuple is binary - base64 encoded in db2ldif
+        lines=[]
+        if self.plaintext:
+            lines.append(dn.replace("dc=com","DC=COM"))
+            for (name,value) in attributes:
+                if type(value) is tuple:
+                    value=value[0].replace("><",">\n  <") # ldapsearch prints the xml as is
+                lines.append(name+"="+value)
+        else:
+            lines.append(self.fold("dn: "+dn))
+            for (name,value) in attributes:
+                if type(value) is tuple:
+                    lines.append(self.fold(name+":: "+base64.b64encode(value[0])))
+                else:
+                    lines.append(self.fold(name+": "+value))
+        self.out.write("\n".join(lines)+"\n\n")
+        self.written+=1
+
+    def fold(self,line):
+        # db2ldif wraps the lines at 78 characters
+        if len(line) <= 78:
+            return line
+        return "\n ".join([line[:78]]+[line[i:i+77] for i in range(78,len(line),77)])
+
+    def container(self,dn,objectclass="organizationalUnit"):
+        self.entry(dn,[("objectclass","top"),("objectclass",objectclass),(dn.split(",")[0].split("=")[0],dn.split(",")[0].split("=")[1])])
+
+    def tenantEntries(self):
+        self.entry("dc=com",[("objectclass","top"),("objectclass","domain"),("dc","com")])
+        self.entry(self.org,[("objectclass","top"),("objectclass","organization"),("o","org"),("ou","org")])
+        acl="<acl name='Default ACL'><systemRole>erglobalid=5,ou=sysroles,%s</systemRole><operation name='search'/></acl>" % self.tenant
+        self.entry(self.tenant,[("objectclass","top"),("objectclass","erTenant"),("erglobalid","00000000000000000000"),("eracl",(acl,)),("ertenantname","org")])
+        for ou in ["people","accounts","orphans","services","roles","policies","workflow","sysroles","orgchart"]:
+            self.container("ou=%s,%s" % (ou,self.tenant))
+        self.container("ou=0,ou=people,"+self.tenant)
+        self.container("ou=0,ou=accounts,"+self.tenant)
+        self.container(self.itim)
+        for ou in ["config","formTemplates","category","serviceProfile","assemblyline","systemUser","recycleBin","policies"]:
+            self.container("ou=%s,%s" % (ou,self.itim))
+        self.entry("erglobalid=5,ou=sysroles,"+self.tenant,[("objectclass","top"),("objectclass","erSystemRole"),("errolename","System Administrator Group")])
+        self.entry("eruid=itim manager,ou=systemUser,"+self.itim,[("objectclass","top"),("objectclass","erSystemUser"),("eruid","itim manager"),("erpassword",self.encrypt("secret"))])
+
+    def orgChart(self,count):
+        ous=[self.tenant]
+        for i in range(count):
+            dn="erglobalid=%s,ou=orgchart,%s" % (self.globalid(),self.tenant)
+            self.entry(dn,[("objectclass","top"),("objectclass","erOrgUnitItem"),("objectclass","organizationalUnit"),("ou","Department %s" % i),("erparent",self.random.choice(ous))])
+            ous.append(dn)
+        return ous[1:]
+
+    def services(self,count):
+        profiles=[("erADService","erADAccount","com.ibm.itim.remoteservices.provider.dsml2.DSML2ServiceProviderFactory"),
+                  ("erLDAPService","erLDAPUserAccount","com.ibm.itim.remoteservices.provider.itdiprovider.ItdiServiceProviderFactory"),
+                  ("erPosixLinuxService","erPosixLinuxAccount","com.ibm.itim.remoteservices.provider.itdiprovider.ItdiServiceProviderFactory"),
+                  ("erManualService","erManualAccount","com.ibm.itim.remoteservices.provider.manualservice.ManualServiceConnectorFactory")]
+        for (serviceclass,accountclass,factory) in profiles:
+            self.entry("erobjectprofilename=%s,ou=serviceProfile,%s" % (serviceclass[2:],self.itim),[("objectclass","top"),("objectclass","erServiceProfile"),
+                ("erobjectprofilename",serviceclass[2:]),("ercustomclass",serviceclass),("eraccountclass",accountclass),("erserviceproviderfactory",factory)])
+        services=[]
+        for i in range(count):
+            (serviceclass,accountclass,factory)=profiles[i%len(profiles)]
+            dn="erglobalid=%s,ou=services,%s" % (self.globalid(),self.tenant)
+            self.entry(dn,[("objectclass","top"),("objectclass","erManagedItem"),("objectclass","erServiceItem"),("objectclass","erRemoteServiceItem"),("objectclass",serviceclass),
+                ("erservicename","%s %s" % (serviceclass[2:-7],i)),("erurl","ldap://host%s.example.com:389" % i),("erServicePassword",self.encrypt("service%s" % i)),("erparent",self.tenant)])
+            services.append((dn,accountclass))
+        return services
+
+    def roles(self,count):
+        roles=[]
+        for i in range(count):
+            dn="erglobalid=%s,ou=roles,%s" % (self.globalid(),self.tenant)
+            self.entry(dn,[("objectclass","top"),("objectclass","erRole"),("errolename","Role %s" % i),("description","Generated role %s" % i),("erparent",self.tenant)])
+            roles.append(dn)
+        return roles
+
+    def policies(self,count,roles,services):
+        for i in range(count):
+            gid=self.globalid()
+            entitlements="<ProvisioningPolicyEntitlements><Entitlement type='0'><ServiceTarget>%s</ServiceTarget>%s</Entitlement></ProvisioningPolicyEntitlements>" % (services[i%len(services)][0],"<Parameter name='erGroup'/>"*5)
+            self.entry("erglobalid=%s,ou=policies,%s" % (gid,self.tenant),[("objectclass","top"),("objectclass","erProvisioningPolicy"),("erpolicyitemname","Policy %s" % i),("erglobalid",gid),
+                ("erpolicymembership","2;"+roles[i%len(roles)]),("erpolicytarget","1;"+services[i%len(services)][0]),("erentitlements",(entitlements,)),("erenabled","true")])
+
+    def workflows(self,count):
+        for i in range(count):
+            gid=self.globalid()
+            xml="<Process name='Workflow %s'>%s</Process>" % (i,"".join(["<Activity id='a%s'><Script>var x=%s;</Script></Activity>" % (a,a) for a in range(10)]))
+            self.entry("erglobalid=%s,ou=workflow,%s" % (gid,self.tenant),[("objectclass","top"),("objectclass","erWorkflowDefinition"),("erprocessname","Workflow %s" % i),
+                ("erobjectprofilename","Person"),("ercategory","Person"),("erxml",(xml,))])
+
+    def config(self):
+        self.entry("erformname=Person,ou=formTemplates,"+self.itim,[("objectclass","top"),("objectclass","erFormTemplate"),("erformname","Person"),("erxml",("<page><body><form><formElement name='data.cn'/></form></body></page>",))])
+        self.entry("cn=New Account,ou=config,"+self.itim,[("objectclass","top"),("objectclass","erTemplate"),("cn","New Account"),("ertemplatename","New Account"),("erenabled","true"),
+            ("ersubject",("New account on $service.name",)),("ertext",("Your new account is $account.uid",))])
+        self.entry("cn=add,ou=AD,ou=assemblyline,"+self.itim,[("objectclass","top"),("objectclass","erALOperation"),("cn","add"),("eroperationnames","add"),
+            ("eralconfig",("<Config><Connector name='AD'/></Config>",)),("erassemblyline",("<AssemblyLine name='add'/>",))])
+
+    def people(self,count,ous,roles,services):
+        # people with their accounts. About a third are people, two thirds are accounts
+        written=0
+        while written < count:
+            pid=self.globalid()
+            persondn="erglobalid=%s,ou=0,ou=people,%s" % (pid,self.tenant)
+            attributes=[("objectclass","top"),("objectclass","person"),("objectclass","organizationalPerson"),("objectclass","inetOrgPerson"),("objectclass","erPersonItem")]
+            if self.random.random() < 0.3:
+                attributes.append(("objectclass","customPerson"))
+            attributes+=[("cn","Person %s" % pid),("sn","Person"),("givenname","Generated"),("mail","person%s@example.com" % pid),("erpersonstatus","1" if self.random.random() < 0.1 else "0"),
+                ("erparent",self.random.choice(ous)),("ercreatedate","201701010000Z")]
+            chance=self.random.random()
+            attributes.append(("erpassword",self.encrypt("pass%s" % pid) if chance < 0.8 else "MD5:"+base64.b64encode(pid) if chance < 0.9 else base64.b64encode("junk"+pid)))
+            for role in self.random.sample(roles,min(len(roles),self.random.randint(0,3))):
+                attributes.append(("erroles",role))
+            self.entry(persondn,attributes)
+            written+=1
+            for i in range(self.random.randint(1,3)):
+                if written >= count:
+                    break
+                (servicedn,accountclass)=self.random.choice(services)
+                if self.random.random() < 0.02:
+                    accountdn="erglobalid=%s,ou=orphans,%s" % (self.globalid(),self.tenant)
+                else:
+                    accountdn="erglobalid=%s,ou=0,ou=accounts,%s" % (self.globalid(),self.tenant)
+                self.entry(accountdn,[("objectclass","top"),("objectclass","erManagedItem"),("objectclass","erAccountItem"),("objectclass",accountclass),("eruid","user%s" % pid),
+                    ("erservice",servicedn),("eraccountstatus","1" if self.random.random() < 0.15 else "0"),("erparent",persondn),("erpassword",self.encrypt("acct%s" % pid))])
+                written+=1
+
+    def recycleBin(self,count,services):
+        for i in range(count):
+            gid=self.globalid()
+            self.entry("erglobalid=%s,ou=recycleBin,%s" % (gid,self.itim),[("objectclass","top"),("objectclass","erAccountItem"),("eruid","deleted%s" % gid),("erservice",services[0][0]),("eraccountstatus","1")])
+
+def entryCount(text):
+    # 10000, 10k, 1M
+    multiplier={'k':1000,'m':1000000}.get(text[-1].lower(),1)
+    return int(float(text.rstrip('kKmM'))*multiplier)
+
+if __name__ == '__main__':
+    sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+    args=sys.argv[1:]
+    plaintext=False
+    seed=1
+    password="password"
+    while len(args) > 2:
+        arg=args.pop(0)
+        if arg == "-p":
+            plaintext=True
+        elif arg == "-s":
+            seed=int(args.pop(0))
+        elif arg == "-k":
+            password=args.pop(0)
+        else:
+            print __doc__
+            sys.exit(1)
+    if len(args) != 2:
+        print __doc__
+        sys.exit(1)
+    LdifGenerator(args[1],entryCount(args[0]),plaintext,seed,password).generate()
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+'''
+Builds an index of an LDIF so single entries and subtrees can be pulled out of a big dump without rescanning it
+
+The index is an SQLite sidecar file <name of the ldif>.idx that maps each DN, lowercased and without the spaces around the commas, to the byte offset and length of the entry, and to its objectclasses.
+It is built once and rebuilt automatically when the ldif changes. Entries are read through mmap, so a lookup takes milliseconds regardless of the dump size.
+
+ldifindex.py [-s] <name of the ldif> [<dn>]
+
+ without a DN just builds the index
+ with a DN prints that entry
+ -s to print the entry and everything under it
+
+From code:
+    index=LdifIndex("ldapdump.ldif")
+    print index.get("erglobalid=00000000000000000000,ou=org,dc=com")
+    for text in index.subtree("ou=services,erglobalid=00000000000000000000,ou=org,dc=com"):
+        ...
+
+'''
+import base64, sys, re, os, mmap, sqlite3
+from ldifreader import LdifReader, compression, normalDn
+
+indexversion="2" # goes into the meta table, bump when the entries table changes, an older index is rebuilt
+
+def dnPath(dn):
+    # lowercased rdns from the root down, so a subtree is a range of paths
+    rdns=[r.strip() for r in re.split(r'(?<!\\),',dn.lower())] # split by , but not \,
+    rdns.reverse()
+    return ",".join(rdns)
+
+def decodeDn(dn):
+    return dn if ',' in dn or ('=' in dn and '=' <> dn[-1]) else base64.b64decode(dn) # guessing if it's base64
+
+class LdifIndex:
+
+    def __init__(self,filename):
+        self.ldif=filename
+        self.idxfile=filename+".idx"
+        self.db=None
+        self.ldiffile=None
+        self.mm=None
+
+    def open(self):
+        # use the existing index, unless it is missing or the ldif has changed since
+        if self.db is not None:
+            return
+        stat=os.stat(self.ldif)
+        if os.path.exists(self.idxfile):
+            self.db=sqlite3.connect(self.idxfile)
+            self.db.text_factory=str
+            try:
+                meta=dict(self.db.execute("select key,value from meta"))
+                if meta.get('size') == str(stat.st_size) and meta.get('mtime') == str(int(stat.st_mtime)) and meta.get('version') == indexversion:
+                    return
+            except sqlite3.DatabaseError:
+                pass
+            self.db.close()
+        self.build()
+
+    def build(self):
+        if compression(self.ldif) is not None: # entries are read back by their offset
+            raise IOError("%s is compressed, decompress it to index it" % self.ldif)
+        print "Indexing...",
+        if os.path.exists(self.idxfile):
+            os.unlink(self.idxfile)
+        stat=os.stat(self.ldif)
+        self.db=sqlite3.connect(self.idxfile)
+        self.db.text_factory=str
+        self.db.execute("pragma journal_mode=off")
+        self.db.execute("pragma synchronous=off")
+        self.db.execute("create table meta (key text primary key, value text)")
+        self.db.execute("create table entries (dn text primary key, path text, offset integer, length integer, objectclasses text)")
+        reader=LdifReader(self.ldif,label="Indexing")
+        batch=[]
+        for block in reader.blocks():
+            entry=reader.parse(block)
+            if 'dn' not in entry or 'objectclass' not in entry:
+                continue
+            dn=decodeDn(entry['dn'][0])
+            batch.append((normalDn(dn),dnPath(dn),reader.offset,len(block),",".join([o.lower() for o in entry['objectclass']])))
+            if len(batch) >= 10000:
+                self.db.executemany("insert or replace into entries values (?,?,?,?,?)",batch)
+                batch=[]
+        self.db.executemany("insert or replace into entries values (?,?,?,?,?)",batch)
+        reader.close()
+        self.db.execute("create index entries_path on entries (path)")
+        self.db.executemany("insert into meta values (?,?)",[('size',str(stat.st_size)),('mtime',str(int(stat.st_mtime))),('plaintext',str(reader.plaintext)),('version',indexversion)])
+        self.db.commit()
+        print "\n%s entries indexed into %s" % (self.count(),self.idxfile)
+
+    def count(self):
+        return self.db.execute("select count(*) from entries").fetchone()[0]
+
+    def text(self,offset,length):
+        if self.mm is None:
+            self.ldiffile=open(self.ldif,'rb')
+            self.mm=mmap.mmap(self.ldiffile.fileno(),0,access=mmap.ACCESS_READ)
+        return self.mm[offset:offset+length]
+
+    def locate(self,dn):
+        # offset, length and objectclasses of an entry, or None
+        self.open()
+        return self.db.execute("select offset,length,objectclasses from entries where dn=?",(normalDn(decodeDn(dn)),)).fetchone()
+
+    def get(self,dn):
+        # raw text of an entry, or None
+        location=self.locate(dn)
+        if location is None:
+            return None
+        return self.text(location[0],location[1])
+
+    def subtree(self,dn):
+        # raw texts of the entry and everything below it, in the ldif order
+        self.open()
+        path=dnPath(decodeDn(dn))
+        for (offset,length) in self.db.execute("select offset,length from entries where path=? or (path>? and path<?) order by offset",(path,path+",",path+"-")): # - follows , in ascii
+            yield self.text(offset,length)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.ldiffile.close()
+            self.mm=None
+        if self.db is not None:
+            self.db.close()
+            self.db=None
+
+if __name__ == '__main__':
+    sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+    args=sys.argv[1:]
+    subtree=False
+    if args and args[0] == "-s":
+        subtree=True
+        args.pop(0)
+    if len(args) < 1 or len(args) > 2:
+        print __doc__
+        sys.exit(1)
+    if not os.path.exists(args[0]):
+        print "can't open %s!" % args[0]
+        sys.exit(2)
+    index=LdifIndex(args[0])
+    try:
+        index.open()
+    except IOError:
+        print sys.exc_info()[1]
+        sys.exit(2)
+    if len(args) == 2:
+        if subtree:
+            for text in index.subtree(args[1]):
+                sys.stdout.write(text)
+        else:
+            text=index.get(args[1])
+            if text is None:
+                print "%s not found" % args[1]
+                sys.exit(3)
+            sys.stdout.write(text)
+    index.close()
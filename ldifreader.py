@@ -0,0 +1,932 @@
+#!/usr/bin/python
+'''
+Streaming LDIF reader shared by the ISIM data tools
+
+Understands both the classical LDIF format (db2ldif, softerra) and the ldapsearch plaintext format, where entries start with an erglobalid=...,DC=COM line and attributes are written as name=value.
+The file is read in large chunks that are split on entry boundaries, so most of the per-line work happens inside the string functions instead of the python loop:
+
+* db2ldif - entries are split on blank lines, continuation lines are unfolded in one go and the attribute lines are split with partition
+* plaintext - entries are split on the erglobalid DN lines found with a single multiline regex over the chunk
+
+Entries are returned from a generator as dicts of lowercased attribute names to lists of values, 'dn' being a one item list. Only entries that have an objectclass are returned.
+Tools that need only a few attributes pass their names as attributes=[...], the values of the rest are not unfolded or copied, which matters for the
+multi-megabyte erxml, eracl and such.
+Tools that copy entries through as they are use blocks() instead, the raw text of each entry, with blockDn(), rawDn() and objectClasses() to tell what
+an entry is without parsing it, and parse() only for the few they have to look into.
+
+Compressed dumps (gzip, bzip2, xz, zstd) are recognized by their first bytes and streamed through pigz/gzip, lbzip2/pbzip2/bzip2, xz or zstd running as a separate
+process, so the decompression goes on in parallel with the parsing. The progress is shown on the compressed bytes. gzip and bzip2 fall back to python in the
+child process if the tools are missing. Compressed files can only be read start to end, see seekable.
+
+- for the name of the ldif reads it from stdin, so a dump can be piped in from db2ldif, ssh or a decompressor without being saved first. A compressed
+stream is recognized the same way. stdin can only be read start to end too, and its length is not known, so the progress shows the bytes read and the
+speed instead of the share of the file. The output files of a tool are named after stdin.ldif. With --stdout the tools write their one main output to
+stdout instead, see dataOutput, and whatever they print goes to stderr:
+
+    db2ldif -o - | reencrypter.py --stdout - <PBE encryption password> <AES encryption key> | ldif2db -i /dev/stdin
+
+    from ldifreader import LdifReader
+    reader=LdifReader("ldapdump.ldif")
+    for entry in reader.entries():
+        print entry['dn'][0]
+
+The progress line shows the share of the file read, the speed in MB and entries per second and the time left. It is updated once per chunk, not per line.
+Metrics times the phases of a run (parse, remap, save...) and prints them at the end. Every tool takes -m <file> to also save them, with the sizes and
+speeds, as json:
+
+    metrics=Metrics("mytool",filename)
+    metrics.phase("parse")
+    ...
+    metrics.measure(reader)
+    metrics.phase("save")
+    ...
+    metrics.finish("metrics.json")
+
+Every tool also takes options to only look at some of the entries. The others are skipped over from their dn line, or from a look for the objectclass
+names in the text, without being parsed:
+
+ --base <dn> to read only the entries under the dn
+ --scope base|one|sub for only the base entry, only the entries right below it, or the whole subtree, the default
+ --objectclass <class> to read only the entries of the objectclass
+ --filter <ldap filter> to read only the entries matching an ldap filter, e.g. "(&(objectclass=erPersonItem)(erpersonstatus=1))". Values are compared case insensitive
+
+    reader=LdifReader("ldapdump.ldif",entryfilter=EntryFilter("ou=services,erglobalid=00000000000000000000,ou=org,dc=com","one","(erurl=*)"))
+
+ldifreader.py [-m <metrics file>][--base <dn>][--scope base|one|sub][--objectclass <class>][--filter <ldap filter>] <name of the ldif>
+ parses the ldif and reports the number of entries and the parsing speed
+
+'''
+import sys, os, re, time, hashlib, subprocess, json, base64, threading
+from collections import OrderedDict
+
+# first bytes of the compressed file -> name, decompressors to try (parallel ones first)
+compressions=[('\x1f\x8b','gzip',[['pigz','-dc'],['gzip','-dc']]),
+              ('BZh','bzip2',[['lbzip2','-dc'],['pbzip2','-dc'],['bzip2','-dc']]),
+              ('\xfd7zXZ\x00','xz',[['xz','-dc','-T0']]),
+              ('\x28\xb5\x2f\xfd','zstd',[['zstd','-dc']])]
+compressedExtensions=('.gz','.bz2','.xz','.zst')
+# name -> extension, compressors to try (parallel ones first), for the output
+compressors={'gzip':('.gz',[['pigz','-c'],['gzip','-c']]),
+             'bzip2':('.bz2',[['lbzip2','-c'],['pbzip2','-c'],['bzip2','-c']]),
+             'xz':('.xz',[['xz','-c','-T0']]),
+             'zstd':('.zst',[['zstd','-c','-q','-T0']])}
+
+def fingerprint(filename,full=False,samples=16,samplesize=65536):
+    # size, modification time to the fraction of a second, inode and a hash of the pieces sampled evenly across the file, cheap to get even for
+    # a multi-GB dump. An edit that keeps the size and the time and misses the samples goes unnoticed, full hashes the whole file instead
+    stat=os.stat(filename)
+    md5=hashlib.md5()
+    with open(filename,'rb') as f:
+        if full:
+            for data in iter(lambda: f.read(1024*1024),''):
+                md5.update(data)
+        else:
+            for i in range(samples+1):
+                f.seek(max(0,min(stat.st_size-samplesize,stat.st_size*i/samples)))
+                md5.update(f.read(samplesize))
+    return (stat.st_size,stat.st_mtime,stat.st_ino,md5.hexdigest())
+
+def compression(filename):
+    # name of the compression the file is in, None for a plain ldif
+    with open(filename,'rb') as f:
+        return streamCompression(f.read(8))
+
+def streamCompression(head):
+    # name of the compression of a stream by its first bytes, None for a plain ldif
+    for (m,name,commands) in compressions:
+        if head.startswith(m):
+            return name
+    return None
+
+def plainName(filename):
+    # file name without the compression extension, to name the output files after. stdin.ldif for -
+    if filename == "-":
+        return "stdin.ldif"
+    (base,ext)=os.path.splitext(filename)
+    return base if ext.lower() in compressedExtensions else filename
+
+def decompress(name):
+    # pure python decompression from stdin to stdout, for when the tools are missing
+    import zlib, bz2
+    new={'gzip':lambda:zlib.decompressobj(32+zlib.MAX_WBITS),'bzip2':bz2.BZ2Decompressor}[name]
+    decompressor=new()
+    while True:
+        data=sys.stdin.read(1024*1024)
+        if not data:
+            break
+        while data: # a file can have several streams one after another, e.g. from pigz or pbzip2
+            try:
+                sys.stdout.write(decompressor.decompress(data))
+            except EOFError: # bzip2 at the end of a stream
+                decompressor=new()
+                continue
+            data=decompressor.unused_data
+            if data:
+                decompressor=new()
+
+def compress(name):
+    # pure python compression from stdin to stdout, for when the tools are missing
+    import zlib, bz2
+    compressor=zlib.compressobj(6,zlib.DEFLATED,16+zlib.MAX_WBITS) if name == 'gzip' else bz2.BZ2Compressor()
+    while True:
+        data=sys.stdin.read(1024*1024)
+        if not data:
+            break
+        sys.stdout.write(compressor.compress(data))
+    sys.stdout.write(compressor.flush())
+
+def compressOption(args):
+    # takes -z <gzip|bzip2|xz|zstd> out of the command line arguments, returns the compression or None. Exits on an unknown one
+    if "-z" in args[:-1]:
+        i=args.index("-z")
+        name=args[i+1]
+        del args[i:i+2]
+        if name not in compressors:
+            print "-z should be one of %s, not %s" % (", ".join(sorted(compressors)),name)
+            sys.exit(1)
+        return name
+    return None
+
+def metricsOption(args):
+    # takes -m <metrics file> out of the command line arguments, returns the file name or None
+    if "-m" in args[:-1]:
+        i=args.index("-m")
+        metricsfile=args[i+1]
+        del args[i:i+2]
+        return metricsfile
+    return None
+
+def stdoutOption(args):
+    # takes --stdout out of the command line arguments. With it the tool writes its main output to stdout, see dataOutput
+    if "--stdout" in args:
+        args.remove("--stdout")
+        dataOutput()
+        return True
+    return False
+
+datastream=None # stdout of the process once dataOutput took it over
+
+def dataOutput():
+    # the stdout of the process for the output data. From the first call on file descriptor 1 goes to stderr instead, so the messages, the progress
+    # and anything the child processes print do not get mixed into the data
+    global datastream
+    if datastream is None:
+        sys.stdout.flush()
+        datastream=os.fdopen(os.dup(1),'wb')
+        os.dup2(2,1)
+    return datastream
+
+def filterOption(args):
+    # takes --base <dn>, --scope <base|one|sub>, --objectclass <class> and --filter <ldap filter> out of the command line arguments.
+    # Returns an EntryFilter or None if there are none. Exits on a bad scope or filter
+    options={}
+    for option in ["--base","--scope","--objectclass","--filter"]:
+        if option in args[:-1]:
+            i=args.index(option)
+            options[option]=args[i+1]
+            del args[i:i+2]
+    if not options:
+        return None
+    ldapfilter=options.get("--filter")
+    if "--objectclass" in options:
+        objectclass="(objectclass=%s)" % options["--objectclass"]
+        ldapfilter="(&%s%s)" % (objectclass,ldapfilter if ldapfilter.startswith("(") else "("+ldapfilter+")") if ldapfilter else objectclass
+    try:
+        return EntryFilter(options.get("--base"),options.get("--scope","sub"),ldapfilter)
+    except ValueError:
+        print sys.exc_info()[1]
+        sys.exit(1)
+
+def normalDn(dn):
+    # lowercase, without the spaces around the commas
+    dn=dn.lower().strip()
+    if ' ,' in dn or ', ' in dn:
+        dn=re.sub(r'\s*,\s*',',',dn)
+    return dn
+
+class EntryFilter:
+    # the entries under a base dn and/or matching an ldap filter (rfc 4515: &, |, !, =, ~=, >=, <=, presence and substrings).
+    # Values are compared case insensitive, the way ISIM attributes are defined
+
+    def __init__(self,base=None,scope="sub",ldapfilter=None):
+        if scope not in ["base","one","sub"]:
+            raise ValueError("scope should be base, one or sub, not %s" % scope)
+        self.base=normalDn(base) if base else None
+        self.scope=scope
+        self.ldapfilter=ldapfilter
+        self.filter=None # parsed, a tree of tuples
+        self.attributes=frozenset(['dn','objectclass'])
+        self.clues=[] # lowercase objectclass names an entry has to have to match, looked for in the text before parsing
+        if ldapfilter:
+            text=ldapfilter.strip()
+            if not text.startswith("("):
+                text="("+text+")"
+            (self.filter,end)=self.parseFilter(text,0)
+            if end != len(text):
+                raise ValueError("unexpected %s at the end of the filter %s" % (text[end:],ldapfilter))
+            self.attributes|=frozenset(self.filterAttributes(self.filter))
+            self.clues=self.filterClues(self.filter)
+        self.spec="base=%s scope=%s filter=%s" % (self.base,self.scope,self.ldapfilter) # tells the filters apart, for the caches
+
+    def parseFilter(self,text,i):
+        # recursive descent from text[i], which should be a '('. Returns the tree and the position after the closing ')'
+        if text[i:i+1] != "(":
+            raise ValueError("expected ( at %s in the filter %s" % (i,text))
+        i+=1
+        op=text[i:i+1]
+        if op in ["&","|"]:
+            items=[]
+            i+=1
+            while text[i:i+1] == "(":
+                (item,i)=self.parseFilter(text,i)
+                items.append(item)
+            node=(op,items)
+        elif op == "!":
+            (item,i)=self.parseFilter(text,i+1)
+            node=(op,item)
+        else:
+            end=text.find(")",i)
+            if end < 0:
+                raise ValueError("missing ) in the filter %s" % text)
+            m=re.match(r"\s*([\w.;-]+)\s*(~=|>=|<=|=)(.*)$",text[i:end])
+            if m is None:
+                raise ValueError("can't parse %s in the filter %s" % (text[i:end],text))
+            (attr,op,value)=m.groups()
+            attr=attr.lower()
+            if op == "=" and value == "*":
+                node=("*",attr)
+            elif op == "=" and "*" in value:
+                pattern=".*".join([re.escape(self.unescape(v)) for v in value.split("*")])
+                node=("sub",attr,re.compile(pattern+"$",re.I|re.S))
+            else:
+                node=("=" if op == "~=" else op,attr,self.unescape(value).lower())
+            i=end
+        if text[i:i+1] != ")":
+            raise ValueError("expected ) at %s in the filter %s" % (i,text))
+        return (node,i+1)
+
+    def unescape(self,value):
+        # \2a style escapes of rfc 4515
+        return re.sub(r"\\([0-9a-fA-F]{2})",lambda m: chr(int(m.group(1),16)),value)
+
+    def filterAttributes(self,node):
+        if node[0] in ["&","|"]:
+            return [a for item in node[1] for a in self.filterAttributes(item)]
+        if node[0] == "!":
+            return self.filterAttributes(node[1])
+        return [node[1]]
+
+    def filterClues(self,node):
+        # objectclass names are never base64 encoded or folded, so they can be looked for in the raw text
+        if node[0] == "&":
+            return [c for item in node[1] for c in self.filterClues(item)]
+        if node[0] == "=" and node[1] == "objectclass":
+            return [node[2]]
+        return []
+
+    def inScope(self,dn):
+        # dn is normalized, see normalDn
+        if self.base is None:
+            return True
+        if self.scope == "base":
+            return dn == self.base
+        if not dn.endswith(","+self.base):
+            return self.scope == "sub" and dn == self.base
+        if self.scope == "one":
+            return "," not in dn[:-len(self.base)-1].replace("\\,","")
+        return True
+
+    def match(self,entry):
+        return self.filter is None or self.matchNode(self.filter,entry)
+
+    def matchNode(self,node,entry):
+        op=node[0]
+        if op == "&":
+            return all(self.matchNode(item,entry) for item in node[1])
+        if op == "|":
+            return any(self.matchNode(item,entry) for item in node[1])
+        if op == "!":
+            return not self.matchNode(node[1],entry)
+        values=entry.get(node[1])
+        if not values:
+            return False
+        if op == "*":
+            return True
+        if op == "sub":
+            return any(node[2].match(v) for v in values)
+        value=node[2]
+        if op == "=":
+            return any(v.lower() == value for v in values)
+        for v in values:
+            (a,b)=(int(v),int(value)) if v.isdigit() and value.isdigit() else (v.lower(),value)
+            if (a >= b if op == ">=" else a <= b):
+                return True
+        return False
+
+def duration(seconds):
+    return "%d:%02d:%02d" % (seconds/3600,seconds/60%60,seconds%60)
+
+class Metrics:
+    # wall clock time of each phase of a run, the size of the ldif and the parsing speed
+
+    def __init__(self,tool,filename):
+        self.tool=tool
+        self.ldif=filename
+        self.started=time.time()
+        self.phases=OrderedDict() # phase name -> seconds
+        self.current=None
+        self.phasestart=self.started
+        self.size=0 # bytes in the file, compressed if it is
+        self.bytes=0 # bytes of the ldif text
+        self.entries=0
+        self.parsephase=None # the phase the ldif was read in, for the speeds
+
+    def phase(self,name):
+        # ends the current phase and starts the next one
+        now=time.time()
+        if self.current is not None:
+            self.phases[self.current]=self.phases.get(self.current,0)+now-self.phasestart
+        self.current=name
+        self.phasestart=now
+
+    def measure(self,reader):
+        # take the counts from a reader that is done, in the phase that read it
+        self.size=reader.size
+        self.bytes=reader.position-reader.start
+        self.entries=reader.entrycount
+        self.parsephase=self.current
+
+    def speeds(self):
+        seconds=self.phases.get(self.parsephase,0)
+        if not seconds:
+            return (0,0)
+        return (self.bytes/seconds,self.entries/seconds)
+
+    def finish(self,metricsfile=None):
+        self.phase(None)
+        total=time.time()-self.started
+        (bytespersec,entriespersec)=self.speeds()
+        timings=", ".join(["%s %.1fs" % (k,v) for (k,v) in self.phases.items()])
+        print "Done in %.1fs: %s" % (total,timings),
+        if bytespersec:
+            print "(%.1f MB/s%s)" % (bytespersec/1048576,", %.0f entries/s" % entriespersec if self.entries else ""),
+        print
+        if metricsfile is not None:
+            with open(metricsfile,'w') as f:
+                json.dump(OrderedDict([('tool',self.tool),('ldif',self.ldif),('size',self.size),('bytes',self.bytes),('entries',self.entries),
+                    ('phases',self.phases),('total',total),('bytes/s',bytespersec),('entries/s',entriespersec)]),f,indent=2)
+                f.write("\n")
+            print "Metrics saved to %s" % metricsfile
+
+class LdifWriter:
+    # an output ldif with a big buffer, optionally compressed by gzip, bzip2, xz or zstd running as a separate process, so the compression goes on in
+    # parallel with the parsing. Counts the entries and the bytes written for the manifests. add() writes whole entries, write() anything else.
+    # - for stdout, see dataOutput
+
+    def __init__(self,filename,compression=None,buffersize=1024*1024):
+        self.compression=compression
+        self.entries=0
+        self.bytes=0 # uncompressed
+        self.softspace=0 # for print >>
+        self.process=None
+        if compression is None:
+            self.filename=filename
+            self.out=self.file=dataOutput() if filename == "-" else open(filename,'wb',buffersize)
+            return
+        (ext,commands)=compressors[compression]
+        self.filename=filename+ext if filename != "-" else filename
+        self.file=dataOutput() if filename == "-" else open(self.filename,'wb')
+        for command in commands:
+            try:
+                self.process=subprocess.Popen(command,stdin=subprocess.PIPE,stdout=self.file,bufsize=buffersize,close_fds=True) # not to hold the pipes of the other files open
+                break
+            except OSError: # not installed
+                pass
+        if self.process is None:
+            if compression not in ['gzip','bzip2']:
+                self.file.close()
+                os.remove(self.filename)
+                raise IOError("can't compress %s, install %s" % (self.filename,commands[0][0]))
+            code="import sys; sys.path.insert(0,%r); import ldifreader; ldifreader.compress(%r)" % (os.path.dirname(os.path.abspath(__file__)),compression)
+            self.process=subprocess.Popen([sys.executable,'-c',code],stdin=subprocess.PIPE,stdout=self.file,bufsize=buffersize,close_fds=True)
+        self.out=self.process.stdin
+
+    def add(self,text):
+        self.entries+=1
+        self.bytes+=len(text)
+        self.out.write(text)
+
+    def write(self,text):
+        self.bytes+=len(text)
+        self.out.write(text)
+
+    def close(self):
+        self.out.close()
+        if self.process is not None:
+            status=self.process.wait()
+            self.file.close()
+            if status != 0:
+                raise IOError("failed to compress %s" % self.filename)
+
+    def manifest(self):
+        # what went into the file, the size is on the disk, None for stdout
+        size=os.path.getsize(self.filename) if self.filename != "-" else None
+        return OrderedDict([('entries',self.entries),('bytes',self.bytes),('size',size),('compression',self.compression)])
+
+def digest(block):
+    # hash of the entry text, the same wherever the entry is in the file
+    return hashlib.md5(block.rstrip('\r\n')).digest()
+
+class LdifReader:
+
+    def __init__(self,filename,label="Parsing",chunksize=8*1024*1024,start=0,end=None,attributes=None,entryfilter=None):
+        self.ldif=filename
+        # lowercase names of the attributes a tool needs the values of, None for all. The other attributes are still in the entries with no values,
+        # so the names can be told, but their values and continuation lines are skipped over without being made into strings
+        self.attributes=None if attributes is None else frozenset(attributes) | frozenset(['dn','objectclass'])
+        self.entryfilter=entryfilter # EntryFilter, the entries it does not match are skipped over by blocks() and entries()
+        self.label=label # progress prefix, None to stay quiet
+        self.chunksize=chunksize
+        self.keys={} # attribute name -> lowercased and interned attribute name
+        self.plaintext=False # false for db2ldif, true for ldapsearch formatted files
+        self.crlf=False # true for files with windows line endings
+        self.plaindn=re.compile(r"^erglobalid=[^\n]*DC=COM\r?$",re.I|re.M) # start of a plaintext entry
+        self.plainattr=re.compile(r"[a-zA-Z]+=.*[^;]$") # it's so specific to make sure we ignore any javascript - the side effect is skipping the ldap attributes that have values ending in ;
+        self.attrline=re.compile(r"\n([^ #\r\n][^:\n]*):") # start of an attribute line, continuation lines start with a space
+        self.attrvalue=re.compile(r".*(?:\n .*)*") # value with its continuation lines
+        self.dnline=re.compile(r"^dn:(:?)(.*(?:\n .*)*)",re.I|re.M)
+        self.dnvalue=re.compile(r"[A-Za-z][\w.-]*=[^,=\r\n;<>\"'&]*(?:, *[A-Za-z][\w.-]*=[^,=\r\n;<>\"'&]*)+") # a dn in a value, also inside xml or after 2; like in erpolicymembership
+        self.referencelines={} # frozenset of attribute names -> regex for their lines, see attributeReferences
+        self.base64line=re.compile(r"\n([^ #\r\n:][^:\n]*):: *([^\r\n]*)") # base64 values of the unfolded entry
+        # objectclass lines of both formats, never the first line of an entry. The names are never base64 or folded. Spelled out case by case, it's faster than re.I
+        self.classline=re.compile(r"\n[oO][bB][jJ][eE][cC][tT][cC][lL][aA][sS][sS][:=][ \t]*([^\r\n]*?)[ \t]*\r?(?=\n|\Z)")
+        self.stdin=filename == "-" # the length is not known and nothing can be read back
+        self.size=os.path.getsize(filename) if not self.stdin else None
+        self.start=start # byte range to read, see split()
+        self.end=self.size if end is None else end
+        self.position=0 # file position of the next read
+        self.offset=0 # byte offset of the last returned block
+        self.entrycount=0
+        self.last=-1
+        self.started=time.time()
+        self.process=None # decompressor
+        self.feeder=None # thread passing stdin on to the decompressor
+        self.fed=0 # compressed bytes passed on
+        if self.stdin:
+            if start or end is not None:
+                raise ValueError("stdin can only be read as a whole")
+            self.ldiffile=sys.stdin
+            head=self.ldiffile.read(self.chunksize) # the first bytes tell the compression, there is no going back to read them again
+            self.compression=streamCompression(head)
+        else:
+            self.ldiffile=open(filename,'rb')
+            self.compression=compression(filename)
+        self.seekable=self.compression is None and not self.stdin # offsets point into the file and it can be split
+        if self.compression is not None:
+            if start or end is not None:
+                raise ValueError("%s is %s compressed, it can only be read as a whole" % (filename,self.compression))
+            self.stream=self.decompressor(head if self.stdin else None)
+            self.pending=self.read()
+        elif self.stdin:
+            self.stream=self.ldiffile
+            self.position=len(head)
+            self.pending=head
+        else:
+            self.stream=self.ldiffile
+            self.pending=self.read()
+        self.detectFormat(self.pending) # always from the beginning of the file
+        if start:
+            self.ldiffile.seek(start)
+            self.position=start
+            self.pending=self.read()
+        self.separator='\r\n\r\n' if self.crlf else '\n\n'
+
+    def decompressor(self,head=None):
+        # the decompressor reads the file from its stdin, sharing the file offset with us, which is how the progress is told.
+        # A compressed stdin is passed on to it by a thread instead, starting with the head already read from it
+        for (m,name,commands) in compressions:
+            if name == self.compression:
+                break
+        source=self.ldiffile if head is None else subprocess.PIPE
+        for command in commands:
+            try:
+                self.process=subprocess.Popen(command,stdin=source,stdout=subprocess.PIPE,bufsize=-1,close_fds=True)
+                break
+            except OSError: # not installed
+                pass
+        if self.process is None:
+            if name not in ['gzip','bzip2']:
+                raise IOError("can't decompress %s, install %s" % (self.ldif if not self.stdin else "stdin",commands[0][0]))
+            code="import sys; sys.path.insert(0,%r); import ldifreader; ldifreader.decompress(%r)" % (os.path.dirname(os.path.abspath(__file__)),name)
+            self.process=subprocess.Popen([sys.executable,'-c',code],stdin=source,stdout=subprocess.PIPE,bufsize=-1,close_fds=True)
+        if head is not None:
+            self.feeder=threading.Thread(target=self.feed,args=(head,))
+            self.feeder.daemon=True
+            self.feeder.start()
+        return self.process.stdout
+
+    def feed(self,data):
+        # copies stdin to the decompressor, in its own thread
+        try:
+            while data:
+                self.process.stdin.write(data)
+                self.fed+=len(data)
+                data=self.ldiffile.read(1024*1024)
+        except IOError: # the decompressor is gone, read() tells why
+            pass
+        finally:
+            self.process.stdin.close()
+
+    def read(self):
+        if self.compression is not None:
+            chunk=self.stream.read(self.chunksize)
+            if not chunk and self.process.wait() != 0: # a broken file would otherwise look like a short one
+                raise IOError("failed to decompress %s" % (self.ldif if not self.stdin else "stdin"))
+        elif self.end is None: # stdin
+            chunk=self.stream.read(self.chunksize)
+        else:
+            chunk=self.stream.read(min(self.chunksize,self.end-self.position))
+        self.position+=len(chunk)
+        return chunk
+
+    def progress(self):
+        # bytes of the file read so far
+        if self.feeder is not None:
+            return self.fed
+        if self.compression is not None:
+            return os.lseek(self.ldiffile.fileno(),0,os.SEEK_CUR)
+        return self.position
+
+    def sizeText(self):
+        # for the opening message
+        return "%s bytes" % self.size if not self.stdin else "stdin"
+
+    def detectFormat(self,chunk):
+        # mimics the line parsers - a line starting with erglobalid= before any attribute line means plaintext
+        for line in chunk.split('\n'):
+            if line.startswith("erglobalid="):
+                self.plaintext=True
+                break
+            if line.startswith("#"):
+                continue
+            if ":" in line:
+                self.crlf=line.endswith('\r')
+                break
+
+    def close(self):
+        if self.process is not None:
+            if self.process.poll() is None: # stopped before the end
+                self.process.kill()
+            self.stream.close()
+            self.process.wait()
+        if not self.stdin:
+            self.ldiffile.close()
+
+    def showProgress(self):
+        # called once per chunk
+        if self.label is None or self.end == self.start:
+            return
+        if self.stdin:
+            self.showStreamProgress()
+            return
+        done=float(self.progress()-self.start)/(self.end-self.start)
+        percent=int(done*1000) # in tenth of a percent
+        if percent > self.last:
+            elapsed=time.time()-self.started
+            speed=""
+            if elapsed > 1 and done < 1:
+                speed=" %5.1f MB/s" % ((self.position-self.start)/elapsed/1048576)
+                if self.entrycount:
+                    speed+=" %6.0f entries/s" % (self.entrycount/elapsed)
+                speed+=" %s left" % duration(elapsed/done-elapsed)
+            sys.stdout.write('\r%s %s: %s%s   ' % (self.label, self.ldif, "{:>5.1f}%".format(percent/10.0), speed))
+            self.last=percent
+
+    def showStreamProgress(self):
+        # the length of stdin is not known, only how much of it was read and how fast
+        read=self.progress()
+        megabytes=read/1048576
+        if megabytes > self.last:
+            elapsed=time.time()-self.started
+            speed=""
+            if elapsed > 1:
+                speed=" %5.1f MB/s" % (read/elapsed/1048576)
+                if self.entrycount:
+                    speed+=" %6.0f entries/s" % (self.entrycount/elapsed)
+            sys.stdout.write('\r%s stdin: %s MB read%s   ' % (self.label, megabytes, speed))
+            self.last=megabytes
+
+    def entries(self,raw=False):
+        # parsed entries with an objectclass. raw=True keeps the original text of the entry in entry['raw']
+        parse=self.parsePlaintext if self.plaintext else self.parseBlock
+        for block in self.blocks():
+            entry=parse(block)
+            if 'objectclass' in entry:
+                if raw:
+                    entry['raw']=self.rawText(block)
+                self.entrycount+=1
+                yield entry
+
+    def parse(self,block,attributes=None):
+        # parse a block returned by blocks() into an entry. attributes to parse other attributes than the reader was made for
+        if self.plaintext:
+            return self.parsePlaintext(block,attributes)
+        return self.parseBlock(block,attributes)
+
+    def rawText(self,block):
+        # entry text ending with a blank line. The last entry in the file may be missing it
+        return block if block.endswith(self.separator) else block.rstrip('\r\n')+self.separator
+
+    def blocks(self):
+        # raw text of every entry, including the blank line(s) after it. Joined together the blocks give back the original file, unless filtered
+        blocks=self.plaintextBlocks() if self.plaintext else self.ldifBlocks()
+        if self.entryfilter is not None:
+            return self.filtered(blocks)
+        return blocks
+
+    def filtered(self,blocks):
+        # the dn line tells if an entry is in the scope, a look for the objectclass names if it can match the filter. Only then it is parsed
+        entryfilter=self.entryfilter
+        for block in blocks:
+            if entryfilter.base is not None:
+                dn=self.blockDn(block)
+                if dn is None or not entryfilter.inScope(dn):
+                    continue
+            if entryfilter.filter is not None:
+                if entryfilter.clues:
+                    lowered=block.lower()
+                    if [c for c in entryfilter.clues if c not in lowered]:
+                        continue
+                if not entryfilter.match(self.parse(block,entryfilter.attributes)):
+                    continue
+            yield block
+
+    def blockDn(self,block):
+        # the normalized dn of a block without parsing the rest, None if there is none
+        dn=self.rawDn(block)
+        return normalDn(dn) if dn is not None else None
+
+    def rawDn(self,block):
+        # the dn of a block as it is written, base64 decoded. None if there is none
+        if self.plaintext:
+            dn=block.partition('\n')[0].rstrip('\r')
+            if not self.plaindn.match(dn):
+                return None
+            return dn
+        m=self.dnline.search(block)
+        if m is None:
+            return None
+        dn=m.group(2).replace('\r\n ','').replace('\n ','').strip(' \r')
+        if m.group(1):
+            dn=base64.b64decode(dn)
+        return dn
+
+    def objectClasses(self,block):
+        # lowercase objectclass names of a block without parsing the rest
+        return [c.lower() for c in self.classline.findall(block)]
+
+    def references(self,block,attributes=None):
+        # (lowercase attribute name, normalized dn) of the dns in the values of an entry, base64 encoded values like erxml and eracl included.
+        # Anything that looks like a dn is returned, whether it is in the ldif or not. attributes to look only in the values of a few, it's quicker
+        if attributes is not None:
+            return self.attributeReferences(block,attributes)
+        if '\n ' in block:
+            block=block.replace('\r\n ','').replace('\n ','')
+        start=block.find('\n') # not the dn of the entry itself
+        found=[]
+        for m in self.dnvalue.finditer(block,start+1 if start >= 0 else len(block)):
+            line=block[block.rfind('\n',0,m.start())+1:m.start()]
+            found.append((re.split(r'[:=]',line,1)[0].strip().lower(),normalDn(m.group())))
+        if not self.plaintext and '::' in block:
+            for (attr,value) in self.base64line.findall(block):
+                try:
+                    value=base64.b64decode(value)
+                except TypeError:
+                    continue
+                for m in self.dnvalue.finditer(value):
+                    found.append((self.lowerKey(attr),normalDn(m.group())))
+        return found
+
+    def attributeReferences(self,block,attributes):
+        pattern=self.referencelines.get(attributes)
+        if pattern is None:
+            # the attribute lines with their continuation lines, the names spelled out case by case, it's faster than re.I
+            names="|".join(["".join(["[%s%s]" % (c.lower(),c.upper()) if c.isalpha() else re.escape(c) for c in name]) for name in attributes])
+            pattern=self.referencelines[attributes]=re.compile(r"\n(%s)()=(.*(?:\n(?![A-Za-z][\w-]*=).*)*)" % names if self.plaintext else r"\n(%s)(:?):[ \t]*(.*(?:\n .*)*)" % names)
+        found=[]
+        match=self.dnvalue.match
+        for (attr,encoded,value) in pattern.findall(block):
+            if '\n ' in value:
+                value=value.replace('\r\n ','').replace('\n ','')
+            if encoded:
+                try:
+                    value=base64.b64decode(value)
+                except TypeError:
+                    continue
+            if value[:1] == '<': # xml
+                for m in self.dnvalue.finditer(value):
+                    found.append((self.lowerKey(attr),normalDn(m.group())))
+            else: # the dn is the value, maybe after a 2; like in erpolicymembership
+                m=match(value,value.find(';',0,4)+1)
+                if m is not None:
+                    found.append((self.lowerKey(attr),normalDn(m.group())))
+        return found
+
+    def ldifBlocks(self):
+        sep=self.separator
+        seplen=len(sep)
+        data=self.pending
+        self.pending=''
+        base=self.start # file offset of data[0]
+        while True:
+            find=data.find
+            pos=0
+            while True:
+                i=find(sep,pos)
+                if i < 0:
+                    break
+                i+=seplen
+                self.offset=base+pos
+                yield data[pos:i]
+                pos=i
+            chunk=self.read()
+            self.showProgress()
+            if not chunk: # the end
+                if pos < len(data):
+                    self.offset=base+pos
+                    yield data[pos:]
+                break
+            base+=pos
+            data=data[pos:]+chunk
+
+    def plaintextBlocks(self):
+        # plaintext entries can have blank lines in the multiline values, so the entries are split on the dn lines instead
+        data=self.pending
+        self.pending=''
+        base=self.start
+        start=0 # start of the current entry in data
+        scanned=0
+        while True:
+            chunk=self.read()
+            end=len(data) if not chunk else data.rfind('\n')+1 # only look at the complete lines
+            for m in self.plaindn.finditer(data,scanned,end):
+                if m.start() > start:
+                    self.offset=base+start
+                    yield data[start:m.start()]
+                    start=m.start()
+            self.showProgress()
+            if not chunk:
+                if start < len(data):
+                    self.offset=base+start
+                    yield data[start:]
+                break
+            scanned=max(end-start,0)
+            base+=start
+            data=data[start:]+chunk
+            start=0
+
+    def split(self,parts):
+        # cut the file into byte ranges of about the same size that start and end on the entry boundaries, so they can be parsed in parallel
+        bounds=[0]
+        for i in range(1,parts):
+            bound=self.boundary(self.size*i/parts)
+            if bounds[-1] < bound < self.size:
+                bounds.append(bound)
+        bounds.append(self.size)
+        return zip(bounds[:-1],bounds[1:])
+
+    def boundary(self,offset):
+        # offset of the first entry that starts at or after the given offset
+        with open(self.ldif,'rb') as f:
+            if self.plaintext:
+                f.seek(offset)
+                data=f.readline() # skip to the beginning of a line
+                pos=offset+len(data)
+                for line in f:
+                    if self.plaindn.match(line):
+                        return pos
+                    pos+=len(line)
+            else:
+                back=min(offset,len(self.separator)) # the separator may end right at the offset
+                f.seek(offset-back)
+                pos=offset-back
+                data=f.read(self.chunksize)
+                while data:
+                    i=data.find(self.separator)
+                    if i >= 0:
+                        return pos+i+len(self.separator)
+                    pos+=len(data)-len(self.separator)+1 # in case the separator is cut by the read
+                    data=data[-len(self.separator)+1:]+f.read(self.chunksize)
+                    if len(data) < len(self.separator):
+                        break
+        return self.size
+
+    def lowerKey(self,key):
+        lkey=self.keys.get(key)
+        if lkey is None:
+            lkey=self.keys[key]=intern(key.lower()) # ldap is case insensitive
+        return lkey
+
+    def parseBlock(self,block,attributes=None):
+        # classical format (softerra, db2ldif)
+        wanted=self.attributes if attributes is None else attributes
+        if wanted is not None and len(block) > 1024 and '\n ' in block: # long folded values, cheaper to skip over with the regex
+            return self.parseProjected(block,wanted)
+        if self.crlf:
+            block=block.replace('\r\n ','')
+        if '\n ' in block:
+            block=block.replace('\n ','') # unfold the continuation lines
+        entry={}
+        keys=self.keys
+        lowerKey=self.lowerKey
+        for line in block.splitlines():
+            (key,sep,value)=line.partition(':')
+            if sep and line[0] != '#': # skip blanks and comments
+                key=keys.get(key) or lowerKey(key)
+                if wanted is not None and key not in wanted:
+                    if key not in entry:
+                        entry[key]=[]
+                elif key in entry:
+                    entry[key].append(value.strip(': ')) # double colon means base64 encoded value
+                else:
+                    entry[key]=[value.strip(': ')]
+        return entry
+
+    def parseProjected(self,block,wanted):
+        # classical format, only the values of the wanted attributes are unfolded and split out, the regex engine skips over the rest
+        text='\n'+block
+        entry={}
+        keys=self.keys
+        valuematch=self.attrvalue.match
+        for m in self.attrline.finditer(text):
+            key=m.group(1)
+            key=keys.get(key) or self.lowerKey(key)
+            if key in wanted:
+                value=valuematch(text,m.end()).group()
+                if '\n ' in value:
+                    value=value.replace('\r\n ','').replace('\n ','')
+                value=value.strip(': \r') # double colon means base64 encoded value
+                if key in entry:
+                    entry[key].append(value)
+                else:
+                    entry[key]=[value]
+            elif key not in entry:
+                entry[key]=[]
+        return entry
+
+    def parsePlaintext(self,block,attributes=None):
+        # ldapsearch plaintext format
+        lines=block.split('\n')
+        dn=lines[0].rstrip('\r')
+        if not self.plaindn.match(dn): # the beginning of the file before the first entry
+            return {}
+        entry={'dn':[dn]}
+        key=''
+        tagged=[] # continuation lines of the current value
+        attrmatch=self.plainattr.match
+        wanted=self.attributes if attributes is None else attributes
+        for i in xrange(1,len(lines)):
+            line=lines[i].rstrip('\r')
+            if attrmatch(line):
+                if tagged:
+                    entry[key][-1]+="".join(tagged)
+                    tagged=[]
+                (key,value)=line.split("=",1)
+                key=self.lowerKey(key)
+                if wanted is not None and key not in wanted:
+                    entry.setdefault(key,[])
+                    key=None # skips the continuation lines
+                    continue
+                value=value.strip("=")
+                if value <> "NOT ASCII": # this means this value is lost in ldapsearch export
+                    if key in entry:
+                        entry[key].append(value)
+                    else:
+                        entry[key]=[value]
+            elif len(line) > 0 and key in entry: # tag line onto the last value. Skipping empty lines to make sure we dont duplicate \n, but the sideeffect is removal of blank lines from the multiline attribute values
+                tagged.append(line+"\n") # add \n for readability (it's plaintext not base64)
+        if tagged:
+            entry[key][-1]+="".join(tagged)
+        return entry
+
+if __name__ == '__main__':
+    sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+    args=sys.argv[1:]
+    metricsfile=metricsOption(args)
+    entryfilter=filterOption(args)
+    if len(args) != 1:
+        print __doc__
+        sys.exit(1)
+    metrics=Metrics("ldifreader",args[0])
+    metrics.phase("parse")
+    try:
+        reader=LdifReader(args[0],entryfilter=entryfilter)
+    except IOError:
+        print "can't open %s!" % args[0]
+        sys.exit(2)
+    for entry in reader.entries():
+        pass
+    reader.close()
+    metrics.measure(reader)
+    print "\n%s entries, %s bytes" % (reader.entrycount, reader.position)
+    metrics.finish(metricsfile)
@@ -5,11 +5,30 @@ Go over an ldap extract and convert it from PBEWithMD5AndDES to AES (AES/ECB/PKC
 the password is either in enRole.properties as enrole.encryption.password or inside encryptionKey.properties as encryption.password
 you can get the password from {ITIM}/data/keystore/itimKeystore.jceks using JCEKStractor from the ITIM Crypto Seer repo
 
-reencrypter.py [-x] <name of the ldif> <PBE encryption password> <AES encryption key>
+reencrypter.py [-x][-j <processes>][--resume][--checkpoint <seconds>][--stdout][-m <metrics file>][<entry filter options>] <name of the ldif> <PBE encryption password> <AES encryption key>
 
 <AES encryption key> should be base64 encoded. It comes from a JCEKS key store. You will need to extract it first with JCEKStractor
 
--x will cause it to check if the key is already correctly encrypted and thus should not be touched. Warning - it may cause false positives, for example in the case where last byte of the decrypted value (padding) is 1
+-x will cause it to check if the key is already correctly encrypted and thus should not be touched. Warning - it may cause false positives. When the last byte of the decrypted value (padding) is 1
+   the value also has to be text for it to count, which leaves about one in 50000 of the random values. A value both keys decrypt is taken for the one it decrypts to text with,
+   AES if both, so -x over an ldif reencrypted before leaves it as it is
+
+-j to reencrypt the values in parallel with the given number of processes. The entries are still read and written by one, in the same order, so the output is the same
+
+--resume to go on from where an interrupted run stopped. A checkpoint is saved to <name of the ldif>.checkpoint every minute, the output files are cut back
+   to how they were then and the ldif is read on from there. Not with - or --stdout, a stream can't be read again. The checkpoint keeps the fingerprint of the ldif
+   and a hash of the keys, a run on a changed ldif or with other keys is not resumed
+
+--checkpoint to save the checkpoints every so many seconds instead of every 60
+
+--stdout to write the reencrypted ldif to stdout, for ldif2db down a pipe. The -mod ldif is not written then. - for the name of the ldif reads it from stdin:
+
+   db2ldif -o - | reencrypter.py --stdout - <PBE encryption password> <AES encryption key> | ldif2db -i /dev/stdin
+
+-m to save the timings and the processing speed to a json file
+
+The entry filter options --base <dn>, --scope base|one|sub, --objectclass <class> and --filter <ldap filter> limit it to some of the entries, see ldifreader.py.
+The other entries are left out of the output
 
 Saves to <name of the ldif>-rec to use with ldif2db and -mod to use with ldapmodify, depending on what you prefer
 
@@ -22,9 +41,15 @@ apt install python-crypto
 
 '''
 from __future__ import print_function
-import base64,sys,os,subprocess,math,re
+import base64,sys,os,re,multiprocessing,time,json
+from collections import deque, OrderedDict
+from itertools import izip
 from Crypto.Hash import MD5,SHA256
 from Crypto.Cipher import DES,AES
+from Crypto.Util.strxor import strxor
+from ldifreader import LdifReader, Metrics, plainName, metricsOption, filterOption, stdoutOption, dataOutput, compression, fingerprint
+
+schemes=["PBE","PBE double base64","AES","one way hash","not base64","unknown"] # what the values can be encrypted with, see Reencryptor.classify
 
 # default encrypted attributes
 encryptedAttributes=["erpassword"]
@@ -32,152 +57,127 @@ encryptedAttributes=["erpassword"]
 # grep password.attributes /opt/IBM/isim/data/enRole.properties + erpassword
 encryptedAttributes.extend(["ersynchpassword","erServicePassword","erServicePwd1","erServicePwd2","erServicePwd3","erServicePwd4","erADDomainPassword","erPersonPassword","erNotesPasswdAddCert","eritamcred","erep6umds","erposixpassphrase"])
 
-class LdifParser:
+def resumeOption(args):
+    # takes --resume out of the command line arguments
+    if "--resume" in args:
+        args.remove("--resume")
+        return True
+    return False
 
-    def __init__(self,filename,decryptpass,encryptkey,testWithNewKey=False,debug=False):
+def checkpointOption(args):
+    # takes --checkpoint <seconds> out of the command line arguments, returns the seconds between the checkpoints, 60 by default
+    if "--checkpoint" in args[:-1]:
+        i=args.index("--checkpoint")
+        seconds=float(args[i+1])
+        del args[i:i+2]
+        return seconds
+    return 60
+
+class Reencryptor:
+    # decrypts a value with the old PBE key and encrypts it with the new AES one. Apart from the ldif, so each process of -j has its own
+
+    def __init__(self,decryptpass,encryptkey,testWithNewKey=False,debug=False):
         salt = "\xC7\x73\x21\x8C\x7E\xC8\xEE\x99" # magic
         iterations=20
         self.blocksize=16
-        self.ldif=filename
         self.key, self.iv = self.compute_DES_key_iv(decryptpass, salt, iterations)
+        self.decoder = DES.new(self.key, DES.MODE_ECB) # CBC is done by hand, so one object does for all the values
         self.encoder = AES.new(encryptkey, AES.MODE_ECB)
+        self.control=re.compile(r'[\x00-\x1f\x7f]')
+        self.base64=re.compile(r'^[A-Za-z0-9+/]*={0,2}$')
         self.testWithNewKey=testWithNewKey
         #self.autogen=re.compile(r'(?=.*?[a-z])(?=.*?[A-Z])(?=.*?[^a-zA-Z]).{8,}') # Minimum eight characters, at least one uppercase letter, one lowercase letter and one number:
         self.autogen=re.compile(r'(?=.*?[a-z].*[a-z])(?=.*?[A-Z].*[A-Z])(?=.*?[0-9].*[0-9]).{8,}') # eight char, two of each
         self.alphanumchar=re.compile(r'^[A-Za-z0-9"~`!@#$%^&*()_+={}:>;\'.,</?*"\[\]\-\|\\/ ]*$')
         self.debug=debug
 
-    def parseOut(self):
-        i=0
-        last=-1
-        invalid=0
-        oneway=0
-        skipped=0
-        encryptedcount=0
-        encryptedAttributesTuple=tuple([e.lower()+":" for e in encryptedAttributes])
-        if debug:
-            self.debugf=open(self.ldif+".debug","w")
-        recfname=os.path.splitext(self.ldif)[0]+"-rec"+os.path.splitext(self.ldif)[1]
-        delfname=os.path.splitext(self.ldif)[0]+"-mod"+os.path.splitext(self.ldif)[1]
-        with open(self.ldif,"r") as inf, open(recfname,"w") as outf, open(delfname,"w") as outmodf:
-            print("Opening...",end="")
-            # fastest line count using wc
-            p = subprocess.Popen(['wc', '-l', self.ldif], stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-            result, err = p.communicate()
-            if p.returncode != 0:
-                raise IOError(err)
-            num_lines=int(result.strip().split()[0]) # 118593960
-            print("%s lines." % num_lines)
-            encryptedAttr=False
-            continuedAttr=False
-            for line in inf:
-                if line.lower().startswith("dn:"):
-                    self.currentdn=line.rstrip(' \n\r')
-                if encryptedAttr: # previously saw an encrypted attribute
-                    if line.startswith(" "): # continuation
-                        val+=line.strip()
-                        continuedAttr=True
-                    else: # decode and write
-                        newline=attr+": "+val+"\n" # assume by default we're keeping it as is
-                        if val.startswith("MD5:") or val.startswith("SHA-256:"):
-                            oneway+=1
-                            if debug:
-                                self.debugf.write(self.currentdn+" =| "+val+"\n")
-                        else:
-                            try:
-                                newval = self.reencrypt(val)
-                                #except KeyboardInterrupt:
-                                #    print("Aborted")
-                                #    sys.exit(99)
-                            except:      # if could not decrypt
-                                try:
-                                    newval = self.reencrypt(base64.b64decode(val)) # some attributes could be a double base64 encoded. Try it again.
-                                    newval = base64.b64encode(newval) # double base64 decoding worked - recode back with the additional base 64
-                                #except KeyboardInterrupt:
-                                #    print("Aborted")
-                                #    sys.exit(99)
-                                except:
-                                    #print("%s: %s on %s" % (sys.exc_info()[0],sys.exc_info()[1],val))
-                                    newval = None
-                            if newval == None and self.testWithNewKey: # # cant re-encrypt. check if it's already correctly encrypted, i.e. has been re-encrypted before
-                                try:
-                                    newval=self.unpad(self.encoder.decrypt(base64.b64decode(val))) # may occasionally cause a false positive - e.g. last byte/padding is 1
-                                    skipped+=1  # no need to reencrypt
-                                    if debug:
-                                        self.debugf.write(self.currentdn+" =! "+newval+"\n")
-                                except: # test for new encryption failed
-                                    newval = None
-                            if newval == None: # still no luck
-                                invalid+=1
-                                if debug:
-                                    self.debugf.write(self.currentdn+" =? "+val+"\n")
-                                outmodf.write("# invalid encoding\n")
-                                outmodf.write(self.currentdn+"\n")
-                                outmodf.write("changetype: modify\n")
-                                outmodf.write("delete: "+attr+"\n")
-                                outmodf.write(line) # this line is needed in case there are multiple attribute values. It also helps identify bad encryption values.
-                                outmodf.write("\n")
-                            else:
-                                newline=attr+": "+newval+"\n" # reencrypted value
-                                outmodf.write("# reencoded\n")
-                                outmodf.write(self.currentdn+"\n")
-                                outmodf.write("changetype: modify\n")
-                                outmodf.write("replace: "+attr+"\n")
-                                outmodf.write(line)
-                                outmodf.write("\n")
-                                #self.debugf.write(attr)
-                        encryptedcount+=1
-                        encryptedAttr=False
-                        continuedAttr=False
-                        outf.write(newline) # write out and continue
-                        #print("Writing out "+newline)
-                if not continuedAttr:
-                    if line.lower().startswith(encryptedAttributesTuple):
-                        attr= line.split(":",1)[0].strip()
-                        val = line.split(":",1)[1][1:].strip()
-                        encryptedAttr=len(val)>0 # sometimes encrypted values are empty so we just skip it
-                        #print("Encrypted "+line)
-                    else:
-                        encryptedAttr=False
-                        outf.write(line)
-                #if debug and line.lower().startswith(('eruid','cn')):
-                #    self.debugf.write(line)
-                # show progress
-                percent = math.ceil(i/float(num_lines)*100*1000)/1000 # round to the tenth of a percent
-                if percent > last :# cant simply use modulus because of the freaky float imprecision
-                    sys.stdout.write('\rParsing %s: %s' % (self.ldif, "{:>5.1f}%".format(percent)))
-                    last=percent
-                i+=1
-        print(" done.\nSaved to %s and %s" %(recfname,delfname))
-        if encryptedcount == 0:
-            print("No changes")
-            os.unlink(outf.name)
-            if debug:
-                os.unlink(self.debugf.name)
-        else:
-            print("%s encrypted values found, %s reencrypted, %s skipped (already with new encryption), %s invalid, %s one way hashed." % (encryptedcount,encryptedcount-invalid-skipped-oneway,skipped,invalid,oneway))
+    def convertValues(self,values):
+        # [(new value or None, what was done with it, debug note or None, scheme)] of a batch of values. The note is the marker and the text that goes to
+        # the debug file after the dn. The decrypted values are encrypted with the new key in one go, ECB encrypts each block on its own
+        converted=[None]*len(values)
+        decrypted=[] # (number of the value, padded text, debug note, scheme)
+        for (n,val) in enumerate(values):
+            (scheme,text)=self.classify(val)
+            if scheme == "one way hash":
+                converted[n]=(None,"oneway","=| "+val,scheme)
+            elif scheme == "AES": # already encrypted with the new key, no need to reencrypt
+                converted[n]=(val,"skipped","=! "+text,scheme)
+            elif text is None:
+                converted[n]=(None,"invalid","=? "+val,scheme)
+            else:
+                decrypted.append((n,self.pad(text),self.note(text),scheme))
+        if decrypted:
+            encrypted=self.encoder.encrypt("".join([padded for (n,padded,note,scheme) in decrypted]))
+            start=0
+            for (n,padded,note,scheme) in decrypted:
+                newval=base64.b64encode(encrypted[start:start+len(padded)])
+                start+=len(padded)
+                if scheme == "PBE double base64":
+                    newval=base64.b64encode(newval) # recode back with the additional base 64
+                converted[n]=(newval,"reencrypted",note,scheme)
+        return converted
 
-        #except:
-        #    print "\nFailure processing %s\n%s, %s" % (entry,sys.exc_info()[0],sys.exc_info()[1])
-        #    traceback.print_exc()
-        #    sys.exit(2)
+    def classify(self,val):
+        # (scheme, decrypted text or None). Each value is tried only for what it can be: base64 of whole cipher blocks that decrypt to a right padding,
+        # so there are no exceptions for the ones it is not. With -x a value the old key and the new one both take is the one that decrypts to text,
+        # AES if both do, so the values reencrypted before are never encrypted twice
+        if val.startswith("MD5:") or val.startswith("SHA-256:"):
+            return ("one way hash",None)
+        data=self.b64decode(val)
+        if data is None:
+            return ("not base64",None)
+        newtext=self.newKeyDecrypt(data) if self.testWithNewKey else None # already correctly encrypted, i.e. has been re-encrypted before
+        text=self.decrypt(data)
+        if text is not None and (newtext is None or self.isText(text) and not self.isText(newtext)):
+            return ("PBE",text)
+        if newtext is not None:
+            return ("AES",newtext)
+        inner=self.b64decode(data) # some attributes could be a double base64 encoded
+        text=self.decrypt(inner) if inner is not None else None
+        if text is not None:
+            return ("PBE double base64",text)
+        return ("unknown",None)
 
-    def reencrypt(self, data):
+    def b64decode(self,val):
+        # the decoded value, None if it's not strictly base64. b64decode skips the characters that are not, so they are checked first
+        if len(val) % 4 or self.base64.match(val) is None:
+            return None
+        return base64.b64decode(val)
+
+    def isText(self,text):
+        # utf-8 without control characters
         try:
-            self.decoder = DES.new(self.key, DES.MODE_CBC, self.iv) # need to reinit it each time because of CBC
-            decrypted=self.unpad(self.decoder.decrypt(base64.b64decode(data)))
-            if debug:
-                if len(decrypted)==8 and re.match(self.autogen,decrypted) is not None:
-                    self.debugf.write(self.currentdn+" =* "+decrypted+"\n")
-                elif re.match(self.alphanumchar,decrypted) is not None:
-                    self.debugf.write(self.currentdn+" => "+decrypted+"\n")
-                else:
-                    self.debugf.write(self.currentdn+" =x "+decrypted+"\n")
-            encrypted=self.encoder.encrypt(self.pad(decrypted))
-            newdata=base64.b64encode(encrypted)
-            return newdata
-        except:
-            raise
+            return self.control.search(text.decode("utf-8")) is None
+        except UnicodeDecodeError:
+            return False
+
+    def decrypt(self,data):
+        # the value decrypted with the old key, None if it's not
+        if not data or len(data) % 8:
+            return None
+        return self.unpad(strxor(self.decoder.decrypt(data),self.iv+data[:-8])) # CBC, each block is xored with the cipher text before it
+
+    def newKeyDecrypt(self,data):
+        # the value decrypted with the new key, None if it's not. A padding of 1 happens to be right for one in 256 values encrypted with something else,
+        # so then the text has to be utf-8 without control characters too
+        if not data or len(data) % self.blocksize:
+            return None
+        padded=self.encoder.decrypt(data)
+        text=self.unpad(padded)
+        if text is not None and padded[-1] == "\x01" and not self.isText(text):
+            return None
+        return text
+
+    def note(self,decrypted):
+        # the debug note on a decrypted value
+        if not self.debug:
+            return None
+        if len(decrypted)==8 and re.match(self.autogen,decrypted) is not None:
+            return "=* "+decrypted
+        elif re.match(self.alphanumchar,decrypted) is not None:
+            return "=> "+decrypted
+        else:
+            return "=x "+decrypted
 
     def compute_DES_key_iv(self,password, salt, iterations=20):
         hasher = MD5.new()
@@ -190,18 +190,311 @@ class LdifParser:
             result = hasher.digest()
         return result[:8], result[8:16]
 
-    def unpad(self,text): # pkcs7
+    def unpad(self,text): # pkcs7, None if the padding is wrong
         pad_val = ord(text[-1])
         pos = len(text) - pad_val
         if pad_val == 0 or text[-pad_val:] != chr(pad_val) * pad_val:
-            raise ValueError("Invalid padding")
+            return None
         return text[:pos]
 
     def pad(self,s): # per standard PKCS#5 is padding to blocksize 8, PKCS#7 is for any block size 1 to 255
         return s + (self.blocksize - len(s) % self.blocksize) * chr(self.blocksize - len(s) % self.blocksize)
 
+reencryptor=None # of a -j process
+
+def startProcess(decryptpass,encryptkey,testWithNewKey,debug):
+    global reencryptor
+    reencryptor=Reencryptor(decryptpass,encryptkey,testWithNewKey,debug)
+
+def convertValues(values):
+    # a batch of values in a -j process
+    return reencryptor.convertValues(values)
+
+class LdifParser:
+
+    def __init__(self,filename,decryptpass,encryptkey,testWithNewKey=False,debug=False,entryfilter=None,processes=1,resume=False,stdout=False,checkpointinterval=60):
+        self.ldif=filename
+        self.entryfilter=entryfilter
+        self.decryptpass=decryptpass
+        self.encryptkey=encryptkey
+        self.reencryptor=Reencryptor(decryptpass,encryptkey,testWithNewKey,debug)
+        self.testWithNewKey=testWithNewKey
+        self.debug=debug
+        self.invalid=0
+        self.oneway=0
+        self.skipped=0
+        self.encryptedcount=0
+        self.encryptedAttr=False
+        self.continuedAttr=False
+        self.encryptedAttributesTuple=tuple([e.lower()+":" for e in encryptedAttributes])
+        self.encryptedLine=re.compile("^(?:%s):" % "|".join(encryptedAttributes),re.I|re.M) # to quickly skip over the entries without encrypted attributes
+        self.processes=processes
+        self.pool=None
+        self.batchsize=1000 # values reencrypted at a time, by a process with -j
+        self.outputsize=10000 # blocks and lines kept for a batch at most, for the ldifs with few encrypted values
+        self.batches=deque() # (values, their results, output) of the batches sent to the processes, oldest first
+        self.cache={} # value -> its result in a list, empty until its batch is reencrypted. The same values are reencrypted once
+        self.cachesize=50000
+        self.hits=0
+        self.misses=0
+        self.schemes=dict([(scheme,0) for scheme in schemes])
+        self.resume=resume
+        self.checkpointfile=plainName(filename)+".checkpoint"
+        self.checkpointinterval=checkpointinterval # seconds
+        self.stdout=stdout # the reencrypted ldif goes to stdout and there is no -mod one
+        self.resumable=not stdout and filename != "-" # the output files and the ldif are there to go back to
+        self.metrics=Metrics("reencrypter",filename)
+
+    def parseOut(self):
+        self.metrics.phase("reencrypt")
+        checkpoint=self.loadCheckpoint() if self.resume else None
+        start=checkpoint['offset'] if checkpoint is not None else 0
+        if self.processes > 1:
+            # the values are reencrypted by the processes, the output waits for them in the order it is written. Started before the ldif is opened,
+            # so they do not hold on to the pipe a decompressor reads stdin from
+            self.pool=multiprocessing.Pool(self.processes,startProcess,(self.decryptpass,self.encryptkey,self.testWithNewKey,self.debug))
+        print("Opening...",end="")
+        reader=LdifReader(self.ldif,entryfilter=self.entryfilter,start=start if start and compression(self.ldif) is None else 0) # a compressed one is read again up to the checkpoint
+        print("%s." % reader.sizeText())
+        if checkpoint is not None:
+            print("Resuming from byte %s, %s encrypted values done." % (start,self.encryptedcount))
+        self.openFiles(checkpoint)
+        self.nextcheckpoint=time.time()+self.checkpointinterval if self.resumable else float('inf')
+        for block in reader.blocks():
+            if reader.offset < start:
+                continue
+            self.processBlock(block)
+            if time.time() >= self.nextcheckpoint and not self.encryptedAttr:
+                self.saveCheckpoint(reader.offset+len(block))
+        reader.close()
+        self.closeFiles()
+        if os.path.exists(self.checkpointfile): # done, nothing to resume
+            os.unlink(self.checkpointfile)
+        self.metrics.measure(reader)
+
+    def loadCheckpoint(self):
+        # the state saved by saveCheckpoint, None if there is none
+        if not os.path.exists(self.checkpointfile):
+            print("No checkpoint in %s, starting from the beginning." % self.checkpointfile)
+            return None
+        with open(self.checkpointfile) as f:
+            checkpoint=json.load(f)
+        if checkpoint['ldif'] != self.ldif or checkpoint['testWithNewKey'] != self.testWithNewKey or checkpoint['debug'] != self.debug:
+            print("%s was saved by a run of %s with other options, resume it with the same -x and -d" % (self.checkpointfile,checkpoint['ldif']))
+            sys.exit(2)
+        if checkpoint.get('fingerprint') != list(fingerprint(self.ldif)):
+            print("%s has changed since %s was saved, can't resume" % (self.ldif,self.checkpointfile))
+            sys.exit(2)
+        if checkpoint.get('keys') != self.keysDigest():
+            print("%s was saved by a run with other keys, resume it with the same PBE password and AES key" % self.checkpointfile)
+            sys.exit(2)
+        for (name,size) in checkpoint['files'].items():
+            if not os.path.exists(name) or os.path.getsize(name) < size:
+                print("%s is shorter than at the checkpoint, can't resume" % name)
+                sys.exit(2)
+        for counter in ['encryptedcount','invalid','skipped','oneway','hits','misses','schemes']:
+            setattr(self,counter,checkpoint[counter])
+        return checkpoint
+
+    def saveCheckpoint(self,offset):
+        # everything before offset is reencrypted and on the disk, so --resume can go on from there
+        self.sendBatch()
+        while self.batches:
+            self.writeBatch()
+        files=[self.outf,self.outmodf]+([self.debugf] if self.debug else [])
+        for f in files:
+            f.flush()
+            os.fsync(f.fileno())
+        checkpoint=OrderedDict([('ldif',self.ldif),('fingerprint',list(fingerprint(self.ldif))),('keys',self.keysDigest()),('offset',offset),
+            ('testWithNewKey',self.testWithNewKey),('debug',self.debug),
+            ('files',OrderedDict([(f.name,f.tell()) for f in files]))])
+        for counter in ['encryptedcount','invalid','skipped','oneway','hits','misses','schemes']:
+            checkpoint[counter]=getattr(self,counter)
+        with open(self.checkpointfile+".tmp","w") as f:
+            json.dump(checkpoint,f,indent=1)
+        os.rename(self.checkpointfile+".tmp",self.checkpointfile) # a crash while saving it leaves the last one
+        self.nextcheckpoint=time.time()+self.checkpointinterval
+
+    def keysDigest(self):
+        # tells the keys apart without keeping them in the checkpoint
+        return SHA256.new(SHA256.new(self.decryptpass).digest()+self.encryptkey).hexdigest()
+
+    def reopen(self,name,checkpoint):
+        # an output file, cut back to where it was at the checkpoint to go on from there
+        if checkpoint is None:
+            return open(name,"w")
+        f=open(name,"r+")
+        f.truncate(checkpoint['files'][name])
+        f.seek(0,os.SEEK_END)
+        return f
+
+    def openFiles(self,checkpoint=None):
+        if self.debug:
+            self.debugf=self.reopen(plainName(self.ldif)+".debug",checkpoint)
+        (base,ext)=os.path.splitext(plainName(self.ldif)) # the output is not compressed
+        self.recfname=base+"-rec"+ext
+        self.delfname=base+"-mod"+ext
+        if self.stdout:
+            self.outf=dataOutput()
+            self.outmodf=None
+        else:
+            self.outf=self.reopen(self.recfname,checkpoint)
+            self.outmodf=self.reopen(self.delfname,checkpoint)
+        self.newBatch()
+
+    def processBlock(self,block):
+        if self.encryptedAttr or self.encryptedLine.search(block):
+            self.reencryptBlock(block)
+        else:
+            self.write(block)
+            if len(self.output) >= self.outputsize:
+                self.sendBatch()
+
+    def newBatch(self):
+        # the output is kept as text and (attribute, value, next line, dn, result) until the values are reencrypted
+        self.output=[]
+        self.values=[] # the ones not in the cache
+        self.results=[]
+        self.write=self.output.append
+
+    def sendBatch(self):
+        if self.pool is None:
+            converted=self.reencryptor.convertValues(self.values)
+        else:
+            converted=self.pool.apply_async(convertValues,(self.values,))
+        self.batches.append((converted,self.results,self.output))
+        self.newBatch()
+        while len(self.batches) > (self.processes*2 if self.pool is not None else 0): # enough to keep the processes busy
+            self.writeBatch()
+
+    def writeBatch(self):
+        (converted,results,output)=self.batches.popleft()
+        if self.pool is not None:
+            converted=converted.get()
+        for (result,value) in izip(results,converted):
+            result.append(value)
+        write=self.outf.write
+        for text in output:
+            if type(text) is tuple:
+                self.writeValue(*text)
+            else:
+                write(text)
+
+    def closeFiles(self):
+        if self.encryptedAttr: # the file ended right after an encrypted value
+            self.reencryptValue("")
+        self.sendBatch()
+        while self.batches:
+            self.writeBatch()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        self.outf.close()
+        if self.stdout:
+            print(" done.\nWritten to stdout")
+        else:
+            self.outmodf.close()
+            print(" done.\nSaved to %s and %s" %(self.recfname,self.delfname))
+        if self.encryptedcount == 0:
+            print("No changes")
+            if not self.stdout:
+                os.unlink(self.outf.name)
+            if self.debug:
+                os.unlink(self.debugf.name)
+        else:
+            print("%s encrypted values found, %s reencrypted, %s skipped (already with new encryption), %s invalid, %s one way hashed, %s cache hits, %s misses." % (self.encryptedcount,self.encryptedcount-self.invalid-self.skipped-self.oneway,self.skipped,self.invalid,self.oneway,self.hits,self.misses))
+            print("By encryption: %s." % ", ".join(["%s %s" % (self.schemes[scheme],scheme) for scheme in schemes]))
+
+        #except:
+        #    print "\nFailure processing %s\n%s, %s" % (entry,sys.exc_info()[0],sys.exc_info()[1])
+        #    traceback.print_exc()
+        #    sys.exit(2)
+
+    def reencryptBlock(self,block):
+        # go over the lines of an entry, reencrypting the values of the encrypted attributes
+        for line in block.splitlines(True):
+            if line.lower().startswith("dn:"):
+                self.currentdn=line.rstrip(' \n\r')
+            if self.encryptedAttr: # previously saw an encrypted attribute
+                if line.startswith(" "): # continuation
+                    self.val+=line.strip()
+                    self.continuedAttr=True
+                else: # decode and write
+                    self.reencryptValue(line)
+            if not self.continuedAttr:
+                if line.lower().startswith(self.encryptedAttributesTuple):
+                    self.attr= line.split(":",1)[0].strip()
+                    self.val = line.split(":",1)[1][1:].strip()
+                    self.encryptedAttr=len(self.val)>0 # sometimes encrypted values are empty so we just skip it
+                    #print("Encrypted "+line)
+                else:
+                    self.encryptedAttr=False
+                    self.write(line)
+            #if self.debug and line.lower().startswith(('eruid','cn')):
+            #    self.debugf.write(line)
+
+    def reencryptValue(self,line):
+        # line is the one following the encrypted value
+        val=self.val
+        result=self.cache.get(val)
+        if result is None:
+            self.misses+=1
+            if len(self.cache) >= self.cachesize: # start over, the values that repeat a lot are back in soon
+                self.cache.clear()
+            result=self.cache[val]=[]
+            self.values.append(val)
+            self.results.append(result)
+        else:
+            self.hits+=1
+        self.output.append((self.attr,val,line,self.currentdn,result))
+        if len(self.values) >= self.batchsize or len(self.output) >= self.outputsize:
+            self.sendBatch()
+        self.encryptedcount+=1
+        self.encryptedAttr=False
+        self.continuedAttr=False
+
+    def writeValue(self,attr,val,line,currentdn,result):
+        (newval,outcome,note,scheme)=result[0]
+        self.schemes[scheme]+=1
+        outmodf=self.outmodf
+        newline=attr+": "+val+"\n" # assume by default we're keeping it as is
+        if self.debug and note is not None:
+            self.debugf.write(currentdn+" "+note+"\n")
+        if outcome == "oneway":
+            self.oneway+=1
+        elif outcome == "skipped":
+            self.skipped+=1
+        elif outcome == "invalid":
+            self.invalid+=1
+        if outmodf is None: # --stdout
+            pass
+        elif outcome == "invalid":
+            outmodf.write("# invalid encoding\n")
+            outmodf.write(currentdn+"\n")
+            outmodf.write("changetype: modify\n")
+            outmodf.write("delete: "+attr+"\n")
+            outmodf.write(line) # this line is needed in case there are multiple attribute values. It also helps identify bad encryption values.
+            outmodf.write("\n")
+        elif outcome in ["reencrypted","skipped"]:
+            outmodf.write("# reencoded\n")
+            outmodf.write(currentdn+"\n")
+            outmodf.write("changetype: modify\n")
+            outmodf.write("replace: "+attr+"\n")
+            outmodf.write(line)
+            outmodf.write("\n")
+            #self.debugf.write(attr)
+        if outcome in ["reencrypted","skipped"]:
+            newline=attr+": "+newval+"\n" # reencrypted value
+        self.outf.write(newline) # write out and continue
+        #print("Writing out "+newline)
+
 if __name__ == '__main__':
     sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+    metricsfile=metricsOption(sys.argv)
+    entryfilter=filterOption(sys.argv)
+    resume=resumeOption(sys.argv)
+    checkpointinterval=checkpointOption(sys.argv)
+    stdout=stdoutOption(sys.argv)
     if len(sys.argv)<4:
         print (__doc__)
         sys.exit(1)
@@ -213,11 +506,20 @@ if __name__ == '__main__':
     if sys.argv[1] == "-x":
         sys.argv.pop(0)
         crosstest=True
+    processes=1
+    if sys.argv[1] == "-j" and len(sys.argv) > 2:
+        processes=int(sys.argv[2])
+        sys.argv.pop(0)
+        sys.argv.pop(0)
+    if resume and (stdout or sys.argv[1] == "-"):
+        print("--resume can't go on with - or --stdout, a stream can't be read again")
+        sys.exit(1)
     try:
         encryptkey=base64.b64decode(sys.argv[3])
     except TypeError:
         print("TypeError: %s on %s.\nIs this a valid base64 encoded encryption key?" % (sys.exc_info()[1],sys.argv[3]))
         sys.exit(2)
-    parser=LdifParser(sys.argv[1],sys.argv[2],encryptkey,testWithNewKey=crosstest, debug=debug)
+    parser=LdifParser(sys.argv[1],sys.argv[2],encryptkey,testWithNewKey=crosstest, debug=debug, entryfilter=entryfilter, processes=processes, resume=resume, stdout=stdout, checkpointinterval=checkpointinterval)
     parser.parseOut()
+    parser.metrics.finish(metricsfile)
  
\ No newline at end of file
@@ -0,0 +1,160 @@
+#!/usr/bin/python
+'''
+Runs several of the tools over an LDIF in a single pass. The LDIF is read and parsed once and every entry is handed to each of the selected tools in turn.
+Produces the same files as running the tools one after another, in a fraction of the time on big dumps.
+
+runall.py [-i][-c][-e][-s][-a][-d][-z <compression>][--rules <rules file>][-r <PBE encryption password> <AES encryption key>][-x][-m <metrics file>][<entry filter options>] <name of the ldif>
+
+ -i to inspect the data, same as inspector.py. Add -c to output stats as csv files
+ -e to extract the code, same as codeextractor.py
+ -s to split out the data into subfiles, same as dataextractor.py. Add -a to extract all data, -d to create removal ldifs, -z to compress
+   the files with gzip, bzip2, xz or zstd and --rules for other routing rules
+ -r to reencrypt the passwords, same as reencrypter.py. Add -x to check if the values are already encrypted with the new key
+ -m to save the timings of the phases and the parsing speed to a json file
+ The entry filter options --base <dn>, --scope base|one|sub, --objectclass <class> and --filter <ldap filter> limit it to some of the entries, see ldifreader.py
+ - for the name of the ldif reads it from stdin, the files are named after stdin.ldif then
+
+See each tool for the details on its options and output
+
+'''
+import base64, sys, os, traceback
+from ldifreader import LdifReader, Metrics, metricsOption, filterOption, compressOption
+from dataextractor import rulesOption
+
+if __name__ == '__main__':
+    # reopen stdout file descriptor with write mode and 0 as the buffer size (unbuffered output)
+    sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+    args=sys.argv[1:]
+    metricsfile=metricsOption(args)
+    entryfilter=filterOption(args)
+    rulesfile=rulesOption(args)
+    compression=compressOption(args)
+    if len(args) < 2:
+        print __doc__
+        sys.exit(1)
+    filename=args.pop() # last argument
+    inspect=codeextract=dataextract=reencrypt=csvformat=allpeople=deldata=crosstest=False
+    while args:
+        arg=args.pop(0)
+        if arg == "-i":
+            inspect=True
+        elif arg == "-c":
+            csvformat=True
+        elif arg == "-e":
+            codeextract=True
+        elif arg == "-s":
+            dataextract=True
+        elif arg == "-a":
+            allpeople=True
+        elif arg == "-d":
+            deldata=True
+        elif arg == "-x":
+            crosstest=True
+        elif arg == "-r" and len(args) >= 2:
+            reencrypt=True
+            decryptpass=args.pop(0)
+            try:
+                encryptkey=base64.b64decode(args.pop(0))
+            except TypeError:
+                print "TypeError: %s.\nIs this a valid base64 encoded encryption key?" % sys.exc_info()[1]
+                sys.exit(2)
+        else:
+            print __doc__
+            sys.exit(1)
+    if not (inspect or codeextract or dataextract or reencrypt):
+        print "Nothing to do. Select at least one of -i, -e, -s or -r"
+        sys.exit(1)
+    # the tools are only loaded when needed since they need different libraries
+    if inspect:
+        import inspector
+        inspectparser=inspector.LdifParser(filename,csvformat)
+    if codeextract:
+        import codeextractor
+        codeparser=codeextractor.LdifParser(filename,entryfilter) # the files of the entries filtered out are kept
+    if dataextract:
+        import dataextractor
+        try:
+            dataparser=dataextractor.LdifParser(filename,allpeople,deldata,rulesfile=rulesfile,compression=compression)
+        except (IOError,ValueError):
+            print sys.exc_info()[1]
+            sys.exit(1)
+    if reencrypt:
+        import reencrypter
+        reencryptparser=reencrypter.LdifParser(filename,decryptpass,encryptkey,testWithNewKey=crosstest)
+    # only the attribute values the selected tools read are parsed. The data extraction copies the entries as they are written in the ldif
+    attributes=(inspector.attributes if inspect else [])+(codeextractor.attributes if codeextract else [])+(dataextractor.attributes if dataextract else [])
+    metrics=Metrics("runall",filename)
+    metrics.phase("parse")
+    try:
+        print "Opening...",
+        reader=LdifReader(filename,attributes=attributes,entryfilter=entryfilter)
+    except IOError:
+        print "can't open %s!" % filename
+        sys.exit(2)
+    print "%s%s." % (reader.sizeText()," plaintext format" if reader.plaintext else "")
+    if inspect:
+        inspectparser.plaintext=reader.plaintext
+    if codeextract:
+        codeparser.plaintext=reader.plaintext
+    if dataextract:
+        dataparser.plaintext=reader.plaintext
+        dataparser.reader=reader
+        try:
+            dataparser.openFiles()
+        except IOError:
+            print sys.exc_info()[1]
+            sys.exit(2)
+    if reencrypt:
+        reencryptparser.openFiles()
+    if codeextract:
+        codeparser.openFiles()
+    parse=reader.parse
+    entry={}
+    try:
+        for block in reader.blocks():
+            if reencrypt:
+                reencryptparser.processBlock(block)
+            if not (inspect or codeextract):
+                if dataextract and dataparser.dumpBlock(block): # copies the block through, parses it only if it has to
+                    reader.entrycount+=1
+                continue
+            entry=parse(block)
+            if 'objectclass' not in entry:
+                continue
+            reader.entrycount+=1
+            if dataextract: # already parsed, so it is not looked into again
+                dataparser.dumpBlock(block,entry)
+            if "ou=recycleBin" in entry['dn'][0]: # trash is only counted in the ldap tree
+                if inspect:
+                    inspectparser.countEntry(entry)
+                continue
+            if inspect:
+                inspectparser.analyzeEntry(entry)
+            if codeextract:
+                codeparser.analyzeEntry(entry)
+    except:
+        print "\nFailure pasing %s at byte %s\n%s, %s" % (entry, reader.offset, sys.exc_info()[0],sys.exc_info()[1])
+        traceback.print_exc()
+        sys.exit(2)
+    reader.close()
+    metrics.measure(reader)
+    print "\n%s entries." % reader.entrycount
+    if reencrypt:
+        metrics.phase("reencrypt")
+        print "Reencryption",
+        reencryptparser.closeFiles()
+    if codeextract:
+        print "Code extraction done."
+        codeparser.closeFiles()
+        codeparser.printSkipped()
+    if dataextract:
+        metrics.phase("people")
+        print "Data extraction",
+        dataparser.dumpPeople()
+        dataparser.closeFiles()
+        print "done"
+    if inspect:
+        metrics.phase("inspect")
+        print "Inspection",
+        inspectparser.saveStats()
+    metrics.finish(metricsfile)